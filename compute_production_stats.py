@@ -10,9 +10,15 @@ import yaml
 import json
 import distance
 import operator
+import pandas as pd
 import time
+import functools
+import multiprocessing.pool
 from datetime import  date
 from datetime import  datetime
+from datetime import  timedelta
+from flowcell_snapshot import stream_docs, stream_contributions, parse_run_date
+from report_output import ReportOutput, OUTPUT_FORMATS
 try:
     import ConfigParser
 except ImportError:
@@ -33,6 +39,65 @@ def setupServer(conf):
     return couchdb.Server(url)
 
 
+def flowcell_docs(db_name, instrument_type=None, since=None, until=None):
+    """Stream the documents of a flowcell database
+
+    If a snapshot is configured (--snapshot) the documents are served from the
+    local snapshot, refreshed first unless --offline is given. If an instrument
+    type or run dates (YYMMDD) are given only the matching runs are streamed,
+    filtered by statusdb through the by_instrument_date view.
+    """
+    snapshot_conf = CONFIG.get('snapshot', {})
+    offline = snapshot_conf.get('offline', False)
+    couch = None if offline else setupServer(CONFIG)
+    instrument_types = [instrument_type] if instrument_type is not None else None
+    return stream_docs(couch, db_name, snapshot_conf.get('path'), offline,
+                       instrument_types=instrument_types, since=since, until=until)
+
+
+#names under which the part of each flowcell used by a report is kept in the
+#snapshot, to be changed whenever the corresponding *_contribution function changes
+PRODUCTION_STATS_REPORT = 'production_stats.1'
+INSTRUMENT_USAGE_REPORT = 'instrument_usage.1'
+YEAR_STATS_REPORT = 'year_stats.2'
+RUN_ID_REPORT = 'run_id.1'
+
+
+def flowcell_contributions(db_name, report, compute, instrument_type=None, since=None, until=None):
+    """Stream compute(doc) for the documents flowcell_docs would stream
+
+    With a snapshot (--snapshot) the results are stored in it per document
+    revision, so only the flowcells added or changed since the previous run are
+    computed and the others are served from the stored results.
+    """
+    snapshot_conf = CONFIG.get('snapshot', {})
+    offline = snapshot_conf.get('offline', False)
+    couch = None if offline else setupServer(CONFIG)
+    instrument_types = [instrument_type] if instrument_type is not None else None
+    return stream_contributions(couch, db_name, report, compute, snapshot_conf.get('path'), offline,
+                                instrument_types=instrument_types, since=since, until=until)
+
+
+def concurrent_contributions(db_names, report, compute, instrument_type=None, since=None, until=None):
+    """Collect the flowcell_contributions of several databases, streamed concurrently
+
+    Each database is streamed from its own thread, so the scan takes about as
+    long as the largest database alone.
+
+    :param list db_names: the databases to scan, e.g. flowcells and x_flowcells
+    :param compute: function of a document and of the name of its database
+    :returns: one list of contributions per database, in the order of db_names
+    """
+    def collect(db_name):
+        return list(flowcell_contributions(db_name, report, functools.partial(compute, db_name=db_name),
+                                           instrument_type, since, until))
+    pool = multiprocessing.pool.ThreadPool(len(db_names))
+    try:
+        return pool.map(collect, db_names)
+    finally:
+        pool.close()
+        pool.join()
+
 
 def load_yaml_config(config_file):
     """Load YAML config file
@@ -67,60 +132,158 @@ def get_FC_type(FCid):
     return FC_type
 
 
+#project metadata kept from the project/summary view, top level and details fields
+PROJECT_FIELDS = ('reference_genome', 'open_date', 'close_date')
+PROJECT_DETAILS_FIELDS = ('sequencing_platform', 'sequencing_setup', 'sequence_units_ordered_(lanes)', 'aborted')
+#hours after which the --project-cache is refetched from statusdb
+PROJECT_CACHE_TTL = 24
 
 
-def parse_flowcell_db():
-    couch       = setupServer(CONFIG)
-    #fetch info about proejcts (reference type)
-    projectsDB = couch["projects"]
-    project_summary = projectsDB.view("project/summary")
+def fetch_project_metadata():
+    """Fetch the metadata of all projects from the project/summary view
+
+    :returns: dict project name -> dict with the PROJECT_FIELDS and
+        PROJECT_DETAILS_FIELDS present in the project summary
+    """
+    couch = setupServer(CONFIG)
     projects = {}
-    for row in project_summary:
+    for row in couch["projects"].view("project/summary"):
         if "project_name" not in row.value:
             print("somehting is wrong here... I guess I am going to fail")
-        if "reference_genome" in row.value:
-            projects[row.value["project_name"]] = row.value["reference_genome"]
+            continue
+        details = row.value.get('details', {})
+        metadata = dict((field, row.value[field]) for field in PROJECT_FIELDS if field in row.value)
+        metadata.update((field, details[field]) for field in PROJECT_DETAILS_FIELDS if field in details)
+        projects[row.value["project_name"]] = metadata
+    return projects
+
+
+def project_metadata():
+    """Metadata of all projects, keyed by project name
+
+    If a project cache is configured (--project-cache) the metadata is read from
+    that JSON file as long as it is younger than its TTL (or whatever its age with
+    --offline), otherwise it is fetched from statusdb and the cache rewritten.
+
+    :raises ValueError: with --offline, if there is no project cache to read
+    """
+    cache_conf = CONFIG.get('project_cache', {})
+    cache_path = cache_conf.get('path')
+    offline = CONFIG.get('snapshot', {}).get('offline', False)
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as cache:
+            cached = json.load(cache)
+        age = time.time() - cached['fetched']
+        if offline or age < cache_conf.get('ttl', PROJECT_CACHE_TTL) * 3600:
+            return cached['projects']
+    if offline and cache_path is None:
+        raise ValueError("offline mode reads the project metadata from --project-cache, none was given")
+    if offline:
+        raise ValueError("project cache {} does not exist, run once without --offline to create it".format(cache_path))
+    projects = fetch_project_metadata()
+    if cache_path is not None:
+        with open(cache_path, 'w') as cache:
+            json.dump({'fetched': time.time(), 'projects': projects}, cache)
+    return projects
+
+
+_normalized_project_names = {}
+
+
+def normalize_project_name(project):
+    """Correct a project name as written in the samplesheets to its statusdb form
+
+    J_Doe_16_01 or J__Doe_16_01 become J.Doe_16_01, and the first part of the
+    name is upper cased. Each distinct name is corrected only once.
+    """
+    if project not in _normalized_project_names:
+        name = project.strip()
+        if "." not in name:
+            name = name.replace("__", "_").replace("_", ".", 1)
+        if "." in name:
+            project_pieaces = name.split(".")
+            name = "{}.{}".format(project_pieaces[0].upper(), project_pieaces[1])
+        _normalized_project_names[project] = name
+    return _normalized_project_names[project]
+
+
+#production-stats reports on the runs of 2016 unless --since/--until are given
+PRODUCTION_STATS_SINCE = "160101"
+PRODUCTION_STATS_UNTIL = "170101"
+
+
+def production_stats_contribution(fc_doc):
+    """Projects of each samplesheet row of a x_flowcells document, as used by production-stats
+
+    :returns: dict with the run id (None without RunInfo) and the [lane, project]
+        of each samplesheet row (None without samplesheet), project is None if the
+        row has none
+    """
+    run_id = fc_doc["RunInfo"]["Id"] if "RunInfo" in fc_doc else None
+    if "samplesheet_csv" not in fc_doc:
+        return {'run_id': run_id, 'samples': None}
+    instrument_type = get_FC_type(run_id)
+    samples = []
+    for sample_lane in fc_doc["samplesheet_csv"]:
+        if instrument_type == "MiSeq":
+            lane = "1"
+        else:
+            lane = sample_lane["Lane"]
+        if "Sample_Project"  in sample_lane:
+            project = normalize_project_name(sample_lane["Sample_Project"])
+        elif "Project" in sample_lane:
+            project = normalize_project_name(sample_lane["Project"])
         else:
-            projects[row.value["project_name"]] = "None"
+            project = None
+        samples.append([lane, project])
+    return {'run_id': run_id, 'samples': samples}
+
+
+def classify_lane(references):
+    """Classify a lane from the reference genomes of its projects
+
+    :returns: human if all projects are on hg19, mixed if the projects have
+        different references, non_human otherwise (also for lanes without projects)
+    """
+    references = set(references)
+    if len(references) > 1:
+        return "mixed"
+    if references == set(["hg19"]):
+        return "human"
+    return "non_human"
+
+
+def parse_flowcell_db(selected_instrument_type=None, since=PRODUCTION_STATS_SINCE, until=PRODUCTION_STATS_UNTIL, output=None):
+    #fetch info about proejcts (reference type)
+    projects = {}
+    for project_name, metadata in project_metadata().items():
+        projects[project_name] = metadata.get("reference_genome", "None")
 
-    flowcell_db = couch["x_flowcells"]
     flowcells   = {}
 
     instrument_types = ["HiSeqX", "MiSeq", "HiSeq2500"]
     for instrument_type in instrument_types:
         flowcells[instrument_type] = {}
 
-    for fc_doc in flowcell_db:
-        try:
-            samplesheet_csv = flowcell_db[fc_doc]["samplesheet_csv"]
-        except KeyError:
-            if "RunInfo" in flowcell_db[fc_doc]:
-                print("{}".format(flowcell_db[fc_doc]["RunInfo"]["Id"]))
+    #only the runs between since and until are downloaded
+    contributions = flowcell_contributions("x_flowcells", PRODUCTION_STATS_REPORT, production_stats_contribution,
+                                           selected_instrument_type, since, until)
+    for contribution in contributions:
+        if contribution['samples'] is None:
+            if contribution['run_id'] is not None:
+                print("{}".format(contribution['run_id']))
             continue
-        flowcell_id     = flowcell_db[fc_doc]["RunInfo"]["Id"]
+        flowcell_id     = contribution['run_id']
         instrument_type = get_FC_type(flowcell_id)
         if flowcell_id not in flowcells[instrument_type]:
             flowcells[instrument_type][flowcell_id] = {}
 
-        for sample_lane in samplesheet_csv:
-            if instrument_type == "MiSeq":
-                lane = "1"
-            else:
-                lane = sample_lane["Lane"]
+        for lane, project in contribution['samples']:
             if lane not in flowcells[instrument_type][flowcell_id]:
                 flowcells[instrument_type][flowcell_id][lane] = {}
-            if "Sample_Project"  in sample_lane:
-                project = sample_lane["Sample_Project"].strip()
-            elif "Project" in sample_lane:
-                project = sample_lane["Project"].strip()
-            else:
+            if project is None:
                 print("WRONG")
-            # now correct the project
-            if "." not in project:
-                project = project.replace("__", "_").replace("_", ".", 1)
-            if "." in project:
-                project_pieaces = project.split(".")
-                project = "{}.{}".format(project_pieaces[0].upper(), project_pieaces[1])
+                continue
 
             if project not in projects:
                 print("{} not found in projects".format(project))
@@ -134,13 +297,13 @@ def parse_flowcell_db():
 
     #now in flowcell I have a full list of instrument/FCid/lanes/Project and organism
     #now i can pull all the stats I want
-    date_low_limit = date(16,1,1)
-    date_upper_limit = date(17,1,1)
     total_number_FC    = 0
     total_number_lanes = 0
     total_number_human_lanes     = 0
     total_number_non_human_lanes = 0
     total_number_mixed_lanes     = 0
+    #one row per instrument type, then the totals
+    rows = []
     for instrument_type in flowcells:
         instrument_number_FC    = 0
         instrument_number_lanes = 0
@@ -148,74 +311,105 @@ def parse_flowcell_db():
         instrument_number_non_human_lanes = 0
         instrument_number_mixed_lanes     = 0
         for flowcell_id in flowcells[instrument_type]:
-            start_date_string = flowcell_id
-            year = start_date_string[0:2]
-            month = start_date_string[2:4]
-            day = start_date_string[4:6]
-            fc_date = date(int(year), int(month), int(day))
-            if fc_date >= date_low_limit and fc_date < date_upper_limit:
-                total_number_FC += 1
-                instrument_number_FC += 1
-                for lane in flowcells[instrument_type][flowcell_id]:
-                    total_number_lanes += 1
-                    instrument_number_lanes += 1
-                    lane_type = ""
-                    for project in flowcells[instrument_type][flowcell_id][lane]:
-                        if lane_type == "":
-                            lane_type = flowcells[instrument_type][flowcell_id][lane][project]
-                        elif lane_type !=  flowcells[instrument_type][flowcell_id][lane][project]:
-                            lane_type = "mixed"
-                        else:
-                            lane_type = flowcells[instrument_type][flowcell_id][lane][project]
-                    if lane_type == "mixed":
-                        total_number_mixed_lanes += 1
-                        instrument_number_mixed_lanes += 1
-                    elif lane_type == "hg19":
-                        total_number_human_lanes += 1
-                        instrument_number_human_lanes += 1
-                    else:
-                        total_number_non_human_lanes += 1
-                        instrument_number_non_human_lanes += 1
-            else:
-                continue
-        print("{}".format(instrument_type))
-        print("\tNumber of FC: {}".format(instrument_number_FC))
-        print("\tNumber of lanes: {}".format(instrument_number_lanes))
-        print("\tNumber of Human lanes: {}".format(instrument_number_human_lanes))
-        print("\tNumber of Non-Human lanes: {}".format(instrument_number_non_human_lanes))
-        print("\tNumber of Mixed lanes: {}".format(instrument_number_mixed_lanes))
-    print("TOTAL")
-    print("\tNumber of FC: {}".format(total_number_FC))
-    print("\tNumber of lanes: {}".format(total_number_lanes))
-    print("\tNumber of Human lanes: {}".format(total_number_human_lanes))
-    print("\tNumber of Non-Human lanes: {}".format(total_number_non_human_lanes))
-    print("\tNumber of Mixed lanes: {}".format(total_number_mixed_lanes))
-
-
+            total_number_FC += 1
+            instrument_number_FC += 1
+            for lane in flowcells[instrument_type][flowcell_id]:
+                total_number_lanes += 1
+                instrument_number_lanes += 1
+                lane_type = classify_lane(flowcells[instrument_type][flowcell_id][lane].values())
+                if lane_type == "mixed":
+                    total_number_mixed_lanes += 1
+                    instrument_number_mixed_lanes += 1
+                elif lane_type == "human":
+                    total_number_human_lanes += 1
+                    instrument_number_human_lanes += 1
+                else:
+                    total_number_non_human_lanes += 1
+                    instrument_number_non_human_lanes += 1
+        rows.append((instrument_type, instrument_number_FC, instrument_number_lanes, instrument_number_human_lanes,
+                     instrument_number_non_human_lanes, instrument_number_mixed_lanes))
+    rows.append(("TOTAL", total_number_FC, total_number_lanes, total_number_human_lanes,
+                 total_number_non_human_lanes, total_number_mixed_lanes))
+    table = pd.DataFrame(rows, columns=['instrument_type', 'flowcells', 'lanes', 'human_lanes', 'non_human_lanes', 'mixed_lanes'])
+
+    def render(table):
+        text = []
+        for row in table.itertuples(index=False):
+            text.append("{}\n".format(row.instrument_type))
+            text.append("\tNumber of FC: {}\n".format(row.flowcells))
+            text.append("\tNumber of lanes: {}\n".format(row.lanes))
+            text.append("\tNumber of Human lanes: {}\n".format(row.human_lanes))
+            text.append("\tNumber of Non-Human lanes: {}\n".format(row.non_human_lanes))
+            text.append("\tNumber of Mixed lanes: {}\n".format(row.mixed_lanes))
+        return "".join(text)
+    (output or ReportOutput()).write([('production_stats', table)], render)
+
+
+
+
+def instrument_usage_contribution(fc_doc, db_name="x_flowcells"):
+    """Instrument, run date and sequenced samples of a flowcell document, as used by instrument-usage
+
+    flowcells documents predate x_flowcells ones and name the sample and project
+    fields differently.
+
+    :returns: None to skip the document, a dict with a message to print and skip it,
+        or a dict with the instrument, the run date and the [project, sample, lane]
+        of each demultiplexed sample, project is None if the sample has none
+    """
+    if 'RunInfo' not in fc_doc:
+        return None
+    if db_name == "flowcells":
+        if 'Date' not in fc_doc['RunInfo']:
+            return None
+        year = int(fc_doc['RunInfo']['Date'][0:2])
+        if year < 13:
+            return {'message': "run {} too old".format(fc_doc['RunInfo']['Id'])}
+        if 'Instrument' not in fc_doc["RunInfo"]:
+            print("ERROR: Instrument not found in RunInfo: how is this possible?")
+        sample_field, project_field, doc_name = 'Sample ID', 'Description', " {}".format(fc_doc["_id"])
+    else:
+        sample_field, project_field, doc_name = 'Sample', 'Sample_Project', ""
+    instrument = fc_doc["RunInfo"]['Instrument']
+    if 'illumina' not in fc_doc:
+        return {'message': "Not illumina field found in doc{}".format(doc_name)}
+    if 'Demultiplex_Stats' not in  fc_doc['illumina']:
+        return {'message': "Not Demultiplex_Stats field found in doc{}".format(doc_name)}
+    if 'Barcode_lane_statistics' not in fc_doc['illumina']['Demultiplex_Stats']:
+        return {'message': "Not Barcode_lane_statistics field found in doc{}".format(doc_name)}
+    samples = []
+    for sample_lane in fc_doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']:
+        if sample_lane[sample_field] == 'unknown' :
+            continue
+        if project_field in sample_lane:
+            project = normalize_project_name(sample_lane[project_field])
+        elif "Project" in sample_lane:
+            project = normalize_project_name(sample_lane["Project"])
+        else:
+            project = None
+        samples.append([project, sample_lane[sample_field], sample_lane['Lane']])
+    return {'instrument': instrument, 'date': fc_doc['RunInfo']['Date'], 'samples': samples}
 
 
-def instrument_usage():
-    couch       = setupServer(CONFIG)
+def instrument_usage(instrument_type=None, since=None, until=None, output=None):
     #fetch info about proejcts (reference type)
-    projectsDB = couch["projects"]
-    project_summary = projectsDB.view("project/summary")
     projects = {}
     instruments = {}
-    for row in project_summary:
-        if "close_date" not in row.value:
+    for project_name, metadata in project_metadata().items():
+        if "close_date" not in metadata:
             continue
-        if 'aborted' in row.value['details'] and row.value['details']['aborted']:
+        if metadata.get('aborted'):
             continue
-        year_close_date = int(row.value["close_date"].split("-")[0])
+        year_close_date = int(metadata["close_date"].split("-")[0])
         if year_close_date >= 2013:
-            if 'sequencing_platform' not in  row.value['details']:
+            if 'sequencing_platform' not in metadata:
                 continue
             else:
-                instrument = row.value['details']['sequencing_platform']
-            if 'sequencing_setup' not in row.value['details']:
+                instrument = metadata['sequencing_platform']
+            if 'sequencing_setup' not in metadata:
                 continue
             else:
-                sequencing_setup = row.value['details']['sequencing_setup']
+                sequencing_setup = metadata['sequencing_setup']
             if sequencing_setup == "special" or  sequencing_setup == "Special":
                 continue
             pattern = re.compile("^[0-9]+x[0-9]+")
@@ -229,172 +423,69 @@ def instrument_usage():
                     instruments[instrument]['setup'][sequencing_setup] = 1
                 else:
                     instruments[instrument]['setup'][sequencing_setup] += 1
-            project_name = row.value["project_name"]
             projects[project_name] = {'sequencing_platform': instrument,
                                         'sequencing_setup' :  sequencing_setup,
                                         'samples_sequenced': set(),
                                         'lanes': 0,
                                         'sequencers' : set()
                                         }
-    flowcell_db = couch["x_flowcells"]
     project_sequenced = {}
-    instrument_runs_per_week = {}
-    for fc_doc in flowcell_db:
-        if 'RunInfo' not in flowcell_db[fc_doc]:
-            continue
-        instrument = flowcell_db[fc_doc]["RunInfo"]['Instrument']
-        if 'illumina' not in flowcell_db[fc_doc]:
-            print("Not illumina field found in doc")
-            continue
-        if 'Demultiplex_Stats' not in  flowcell_db[fc_doc]['illumina']:
-            print("Not Demultiplex_Stats field found in doc")
-            continue
-        if 'Barcode_lane_statistics' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
-            print("Not Barcode_lane_statistics field found in doc")
-            continue
-        projects_in_lanes = {}
-        for sample_lane in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']:
-            if sample_lane['Sample'] == 'unknown' :
-                continue
-            if "Sample_Project"  in sample_lane:
-                project = sample_lane["Sample_Project"].strip()
-            elif "Project" in sample_lane:
-                project = sample_lane["Project"].strip()
-            else:
-                print("WRONG")
-            # now correct the project
-            if "." not in project:
-                project = project.replace("__", "_").replace("_", ".", 1)
-            if "." in project:
-                project_pieaces = project.split(".")
-                project = "{}.{}".format(project_pieaces[0].upper(), project_pieaces[1])
-
-            if project == "default":
+    instrument_runs_per_month = {}
+    db_names = ["x_flowcells", "flowcells"]
+    db_contributions = concurrent_contributions(db_names, INSTRUMENT_USAGE_REPORT, instrument_usage_contribution, instrument_type, since, until)
+    for db_name, contributions in zip(db_names, db_contributions):
+        for contribution in contributions:
+            if contribution is None:
                 continue
-            elif project not in projects:
+            if 'message' in contribution:
+                print(contribution['message'])
                 continue
-            projects[project]['samples_sequenced'].update([sample_lane['Sample']])
-            projects[project]['sequencers'].update([instrument])
-            lane = sample_lane['Lane']
-            if lane not in projects_in_lanes:
-                projects_in_lanes[lane] = {}
-            if project not in projects_in_lanes[lane] :
-                projects_in_lanes[lane][project] = 1
-            else:
-                projects_in_lanes[lane][project] += 1
-        year  = int("20" + flowcell_db[fc_doc]['RunInfo']['Date'][0:2])
-        month =  int(flowcell_db[fc_doc]['RunInfo']['Date'][2:4])
-        day   = int(flowcell_db[fc_doc]['RunInfo']['Date'][4:6])
-        date_seq = datetime(year , month , day )
-        if instrument not in instrument_runs_per_week:
-            instrument_runs_per_week[instrument] = {}
-        date_entry = "{}_{}".format(year, month) #date_seq.isocalendar()[1]) # year plus week number
-        if date_entry not in instrument_runs_per_week[instrument]:
-            instrument_runs_per_week[instrument][date_entry] = 1
-        else:
-            instrument_runs_per_week[instrument][date_entry] += 1
-        for lane in projects_in_lanes:
-            for project in projects_in_lanes[lane]:
-                projects[project]['lanes'] += 1
-                if 'date' in projects[project]:
-                    if projects[project]['date'] < date_seq:
-                        projects[project]['date'] = date_seq
+            instrument = contribution['instrument']
+            projects_in_lanes = {}
+            for project, sample, lane in contribution['samples']:
+                if project is None:
+                    print("WRONG")
+                    continue
+                if project == "default":
+                    continue
+                elif project not in projects:
+                    continue
+                elif db_name == "flowcells" and len(projects[project]['samples_sequenced']) > 0:
+                    continue #it means I have already saw this i x_flowcell db
+                projects[project]['samples_sequenced'].update([sample])
+                projects[project]['sequencers'].update([instrument])
+                if lane not in projects_in_lanes:
+                    projects_in_lanes[lane] = {}
+                if project not in projects_in_lanes[lane] :
+                    projects_in_lanes[lane][project] = 1
                 else:
-                    projects[project]['date'] = date_seq
-    flowcell_db = couch["flowcells"]
-    for fc_doc in flowcell_db:
-        if 'RunInfo' not in flowcell_db[fc_doc]:
-            continue
-        if 'Date' not in flowcell_db[fc_doc]['RunInfo']:
-            continue
-        year = int(flowcell_db[fc_doc]['RunInfo']['Date'][0:2])
-        if year < 13:
-            print("run {} too old".format(flowcell_db[fc_doc]['RunInfo']['Id']))
-            continue
-        if 'Instrument' not in flowcell_db[fc_doc]["RunInfo"]:
-            print("ERROR: Instrument not found in RunInfo: how is this possible?")
-            exit
-
-        instrument = flowcell_db[fc_doc]["RunInfo"]['Instrument']
-        if 'illumina' not in flowcell_db[fc_doc]:
-            print("Not illumina field found in doc {}".format(fc_doc))
-            continue
-        if 'Demultiplex_Stats' not in  flowcell_db[fc_doc]['illumina']:
-            print("Not Demultiplex_Stats field found in doc {}".format(fc_doc))
-            continue
-        if 'Barcode_lane_statistics' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
-            print("Not Barcode_lane_statistics field found in doc {}".format(fc_doc))
-            continue
-
-        projects_in_lanes = {}
-        for sample_lane in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']:
-            if sample_lane['Sample ID'] == 'unknown' :
-                continue
-            if "Description"  in sample_lane:
-                project = sample_lane["Description"].strip()
-            elif "Project" in sample_lane:
-                project = sample_lane["Project"].strip()
-            else:
-                print("WRONG")
-            # now correct the project
-            if "." not in project:
-                project = project.replace("__", "_").replace("_", ".", 1)
-            if "." in project:
-                project_pieaces = project.split(".")
-                project = "{}.{}".format(project_pieaces[0].upper(), project_pieaces[1])
-
-            if project == "default":
-                continue
-            elif project not in projects:
-                continue
-            elif len(projects[project]['samples_sequenced']) > 0:
-                continue #it means I have already saw this i x_flowcell db
-            projects[project]['samples_sequenced'].update([sample_lane['Sample ID']])
-            projects[project]['sequencers'].update([instrument])
-            lane = sample_lane['Lane']
-            if lane not in projects_in_lanes:
-                projects_in_lanes[lane] = {}
-            if project not in projects_in_lanes[lane] :
-                projects_in_lanes[lane][project] = 1
+                    projects_in_lanes[lane][project] += 1
+            year  = int("20" + contribution['date'][0:2])
+            month =  int(contribution['date'][2:4])
+            day   = int(contribution['date'][4:6])
+            date_seq = datetime(year , month , day )
+            if instrument not in instrument_runs_per_month:
+                instrument_runs_per_month[instrument] = {}
+            date_entry = "{}_{}".format(year, month) # year plus month, runs per week are counted by runs_per_week
+            if date_entry not in instrument_runs_per_month[instrument]:
+                instrument_runs_per_month[instrument][date_entry] = 1
             else:
-                projects_in_lanes[lane][project] += 1
-        year  = int("20" + flowcell_db[fc_doc]['RunInfo']['Date'][0:2])
-        month =  int(flowcell_db[fc_doc]['RunInfo']['Date'][2:4])
-        day   = int(flowcell_db[fc_doc]['RunInfo']['Date'][4:6])
-        date_seq = datetime(year , month , day )
-        if instrument not in instrument_runs_per_week:
-            instrument_runs_per_week[instrument] = {}
-        date_entry = "{}_{}".format(year, month) #date_seq.isocalendar()[1]) # year plus week number
-        if date_entry not in instrument_runs_per_week[instrument]:
-            instrument_runs_per_week[instrument][date_entry] = 1
-        else:
-            instrument_runs_per_week[instrument][date_entry] += 1
-
-        for lane in projects_in_lanes:
-            for project in projects_in_lanes[lane]:
-                projects[project]['lanes'] += 1
-                if 'date' in projects[project]:
-                    if projects[project]['date'] < date_seq:
+                instrument_runs_per_month[instrument][date_entry] += 1
+            for lane in projects_in_lanes:
+                for project in projects_in_lanes[lane]:
+                    projects[project]['lanes'] += 1
+                    if 'date' in projects[project]:
+                        if projects[project]['date'] < date_seq:
+                            projects[project]['date'] = date_seq
+                    else:
                         projects[project]['date'] = date_seq
-                else:
-                    projects[project]['date'] = date_seq
 
     years = [2013, 2014, 2015, 2016, 2017]
-    sys.stdout.write('date,')
-    for instrument in sorted(instrument_runs_per_week):
-        sys.stdout.write('{},'.format(instrument))
-    sys.stdout.write('\n')
-    for year in years:
-        for week in range(1,13):
-            date_to_search = "{}_{}".format(year, week)
-            sys.stdout.write('{},'.format(date_to_search))
-            for instrument in sorted(instrument_runs_per_week):
-                if date_to_search in instrument_runs_per_week[instrument]:
-                    sys.stdout.write('{},'.format(instrument_runs_per_week[instrument][date_to_search]))
-                else:
-                    sys.stdout.write('0,')
-            sys.stdout.write('\n')
-    sys.stdout.write('\n')
+    #one row per month, one column per instrument
+    runs_per_month = pd.DataFrame([["{}_{}".format(year, week)] +
+                                   [instrument_runs_per_month[instrument].get("{}_{}".format(year, week), 0) for instrument in sorted(instrument_runs_per_month)]
+                                   for year in years for week in range(1,13)],
+                                  columns=['date'] + sorted(instrument_runs_per_month))
 
     years = [2013, 2014, 2015, 2016, 2017]
     sequencers_year_setup = {}
@@ -417,91 +508,324 @@ def instrument_usage():
                 sequencers_year_setup[sequencer][year][sequencing_setup] += samples
 
 
+    #one row per sequencer and setup, one column per year with the number of samples
+    rows = []
     for sequencer in sorted(sequencers_year_setup):
-        sys.stdout.write('{}\n'.format(sequencer))
         for setup in sorted(sequencers_setup):
-            sys.stdout.write('{},'.format(setup))
+            row = [sequencer, setup]
             for year in sorted(years):
-                if year not in sequencers_year_setup[sequencer]:
-                    #this sequencer, this year had no runs
-                    sys.stdout.write('0,')
-                else:
-                     if setup not in sequencers_year_setup[sequencer][year]:
-                        #it means that this sequencer this year has not such setup
-                        sys.stdout.write('0,')
-                     else:
-                        sys.stdout.write('{},'.format(sequencers_year_setup[sequencer][year][setup]))
-            sys.stdout.write('\n')
+                #0 if this sequencer, this year had no runs or no runs with this setup
+                row.append(sequencers_year_setup[sequencer].get(year, {}).get(setup, 0))
+            rows.append(row)
+    setup_samples = pd.DataFrame(rows, columns=['sequencer', 'setup'] + [str(year) for year in sorted(years)])
+
+    def render(runs_per_month, setup_samples):
+        text = ["".join('{},'.format(column) for column in runs_per_month.columns) + '\n']
+        for row in runs_per_month.itertuples(index=False):
+            text.append("".join('{},'.format(value) for value in row) + '\n')
+        text.append('\n')
+        previous = None
+        for row in setup_samples.itertuples(index=False):
+            if row[0] != previous:
+                text.append('{}\n'.format(row[0]))
+                previous = row[0]
+            text.append("".join('{},'.format(value) for value in row[1:]) + '\n')
+        return "".join(text)
+    (output or ReportOutput()).write([('instrument_runs_per_month', runs_per_month), ('instrument_setup_samples', setup_samples)], render)
+
+
+def year_stats_contribution(fc_doc, db_name="x_flowcells"):
+    """Flowcell, run date, instrument type and MBases produced of a flowcell document, as used by year-stats
+
+    :returns: None to skip the document, otherwise [flowcell, run date, instrument type, yield]
+        with yield None if the run is too old or has no yield statistics
+    """
+    if 'RunInfo' not in fc_doc:
+        return None
+    if 'Flowcell' not in fc_doc['RunInfo']:
+        return None
+    fc_name = fc_doc['RunInfo']['Flowcell']
+    run_date = fc_doc['RunInfo']['Date']
+    fc_type = get_FC_type(fc_doc['RunInfo']['Id'])
+    year  = int(run_date[0:2])
+    if year < 12:
+        return [fc_name, run_date, fc_type, None]
+    yield_MBases = 0
+    if 'illumina' not in fc_doc:
+        return [fc_name, run_date, fc_type, None]
+    if 'Demultiplex_Stats' not in fc_doc['illumina']:
+        return [fc_name, run_date, fc_type, None]
+    if db_name == "x_flowcells":
+        if 'Flowcell_stats' not in fc_doc['illumina']['Demultiplex_Stats']:
+            return [fc_name, run_date, fc_type, None]
+        if 'Yield (MBases)' not in fc_doc['illumina']['Demultiplex_Stats']['Flowcell_stats']:
+            return [fc_name, run_date, fc_type, None]
+        yield_MBases = int(fc_doc['illumina']['Demultiplex_Stats']['Flowcell_stats']['Yield (MBases)'].replace(',', ''))
+    else:
+        if 'Barcode_lane_statistics' not in  fc_doc['illumina']['Demultiplex_Stats']:
+            return [fc_name, run_date, fc_type, None]
+        for sample  in fc_doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']:
+            yield_MBases +=  int(sample['Yield (Mbases)'].replace(',', ''))
+    return [fc_name, run_date, fc_type, yield_MBases]
 
 
-def year_bp_production():
-    couch       = setupServer(CONFIG)
+def flowcell_yields(instrument_type=None, since=None, until=None):
+    """Yield the year_stats_contribution of each flowcell of flowcells and x_flowcells
+
+    A flowcell found in both databases is only yielded for the first one. The
+    two databases are streamed concurrently.
+    """
     db_names = ['flowcells', 'x_flowcells']
     flowcells   = {}
-    production_stats = {}
-    for db_name in db_names:
-        flowcell_db = couch[db_name]
-        for fc_doc in flowcell_db:
-            if 'RunInfo' not in flowcell_db[fc_doc]:
-                continue
-            if 'Flowcell' not in flowcell_db[fc_doc]['RunInfo']:
+    #both databases are scanned at once, then merged in order
+    db_contributions = concurrent_contributions(db_names, YEAR_STATS_REPORT, year_stats_contribution, instrument_type, since, until)
+    for contributions in db_contributions:
+        for contribution in contributions:
+            if contribution is None:
                 continue
-            fc_name = flowcell_db[fc_doc]['RunInfo']['Flowcell']
+            fc_name = contribution[0]
             if fc_name in flowcells:
                 continue
             else:
                 flowcells[fc_name] = 0
-            year  = int(flowcell_db[fc_doc]['RunInfo']['Date'][0:2])
-            month = int(flowcell_db[fc_doc]['RunInfo']['Date'][2:4])
-            if year < 12:
-                continue
-            yield_MBases = 0
-            if 'illumina' not in flowcell_db[fc_doc]:
-                continue
-            if 'Demultiplex_Stats' not in flowcell_db[fc_doc]['illumina']:
+            yield contribution
+
+
+def year_bp_production(instrument_type=None, since=None, until=None, output=None):
+    production_stats = {}
+    for fc_name, run_date, fc_type, yield_MBases in flowcell_yields(instrument_type, since, until):
+        if yield_MBases is None:
+            continue
+        year  = int(run_date[0:2])
+        month = int(run_date[2:4])
+        if year not in production_stats:
+            production_stats[year] = month_production = [0]*12
+        production_stats[year][month-1] += yield_MBases
+    #one row per month, one column per year with the MBases produced
+    table = pd.DataFrame([[month+1] + [production_stats[year][month] for year in sorted(production_stats)] for month in range(0,12,1)],
+                         columns=['month'] + [str(year) for year in sorted(production_stats)])
+
+    def render(table):
+        text = [',' + "".join('{},'.format(year) for year in table.columns[1:]) + '\n']
+        for row in table.itertuples(index=False):
+            text.append("".join('{},'.format(value) for value in row) + '\n')
+        text.append('\n')
+        return "".join(text)
+    (output or ReportOutput()).write([('year_stats', table)], render)
+
+
+
+#metrics of the daily production table, summed over the periods of period-stats
+PRODUCTION_METRICS = ['runs', 'lanes', 'human_lanes', 'non_human_lanes', 'mixed_lanes', 'yield_mbases']
+#pandas period of each period-stats period
+PERIODS = {'day': 'D', 'week': 'W', 'month': 'M', 'quarter': 'Q', 'year': 'Y'}
+
+
+def daily_production(instrument_type=None, since=None, until=None):
+    """Production per run day and instrument type, the base table of period-stats
+
+    Runs and MBases produced come from both flowcell databases, each flowcell
+    counted once as in year-stats. Lanes are classified from the x_flowcells
+    samplesheets as in production-stats.
+
+    :returns: pandas.DataFrame with the date, instrument_type and PRODUCTION_METRICS
+        columns, one row per day and instrument type with at least one run
+    """
+    rows = []
+    for fc_name, run_date, fc_type, yield_MBases in flowcell_yields(instrument_type, since, until):
+        rows.append({'date': run_date, 'instrument_type': fc_type, 'runs': 1, 'yield_mbases': yield_MBases or 0})
+    references = dict((project, metadata.get("reference_genome", "None")) for project, metadata in project_metadata().items())
+    run_ids = set()
+    contributions = flowcell_contributions("x_flowcells", PRODUCTION_STATS_REPORT, production_stats_contribution,
+                                           instrument_type, since, until)
+    for contribution in contributions:
+        if contribution['samples'] is None or contribution['run_id'] in run_ids:
+            continue
+        run_ids.add(contribution['run_id'])
+        lanes = {}
+        for lane, project in contribution['samples']:
+            lanes.setdefault(lane, set())
+            if project in references:
+                lanes[lane].add(references[project])
+        #run ids start with the run date
+        row = {'date': contribution['run_id'][0:6], 'instrument_type': get_FC_type(contribution['run_id']), 'lanes': len(lanes)}
+        for lane_references in lanes.values():
+            lane_type = "{}_lanes".format(classify_lane(lane_references))
+            row[lane_type] = row.get(lane_type, 0) + 1
+        rows.append(row)
+    daily = pd.DataFrame(rows, columns=['date', 'instrument_type'] + PRODUCTION_METRICS)
+    daily[PRODUCTION_METRICS] = daily[PRODUCTION_METRICS].fillna(0).astype(int)
+    daily['date'] = pd.to_datetime(daily['date'], format='%y%m%d')
+    return daily.groupby(['date', 'instrument_type'], as_index=False)[PRODUCTION_METRICS].sum()
+
+
+def production_by_period(daily, period='month', rolling=None):
+    """Sum the daily production table over calendar periods
+
+    :param pandas.DataFrame daily: table returned by daily_production
+    :param str period: one of PERIODS
+    :param int rolling: if given, each period holds the sum over this many
+        periods ending with it (e.g. 52 for a rolling year of weeks)
+    :returns: pandas.DataFrame with the period, instrument_type and PRODUCTION_METRICS
+        columns, ordered by period and instrument type
+    """
+    freq = PERIODS[period]
+    table = daily.assign(period=daily['date'].dt.to_period(freq))
+    table = table.groupby(['period', 'instrument_type'])[PRODUCTION_METRICS].sum()
+    if rolling and len(table):
+        #every period of the range, so that the window spans periods rather than rows
+        periods = table.index.get_level_values('period')
+        all_periods = pd.period_range(periods.min(), periods.max(), freq=freq)
+        frames = []
+        for fc_type, group in table.groupby(level='instrument_type'):
+            group = group.droplevel('instrument_type').reindex(all_periods, fill_value=0)
+            group = group.rolling(rolling, min_periods=1).sum().astype(int)
+            frames.append(group.rename_axis('period').assign(instrument_type=fc_type).set_index('instrument_type', append=True))
+        table = pd.concat(frames).sort_index()
+    table = table.reset_index()
+    table['period'] = table['period'].astype(str)
+    return table[['period', 'instrument_type'] + PRODUCTION_METRICS]
+
+
+def period_stats(instrument_type=None, since=None, until=None, periods=('month',), rolling=None, output=None):
+    """Report the production over each of the requested periods
+
+    The flowcells are read once into the daily production table, every period is
+    then aggregated from it.
+    """
+    daily = daily_production(instrument_type, since, until)
+    names = []
+    tables = []
+    for period in periods:
+        names.append(period if not rolling else "{}_rolling_{}".format(period, rolling))
+        tables.append(('production_by_{}'.format(names[-1]), production_by_period(daily, period, rolling)))
+
+    def render(*tables):
+        text = []
+        for name, table in zip(names, tables):
+            text.append('{}\n'.format(name))
+            text.append(",".join(table.columns) + '\n')
+            for row in table.itertuples(index=False):
+                text.append(",".join('{}'.format(value) for value in row) + '\n')
+            text.append('\n')
+        return "".join(text)
+    (output or ReportOutput()).write(tables, render)
+
+
+#directories holding the run folders of the sequencers, glob patterns allowed
+RUN_ROOTS = ['/proj/ngi2016003/*/']
+#run folder names: run date, instrument, run number and flowcell, e.g. 170101_ST-E00201_0001_AHXXX
+RUN_FOLDER = re.compile(r'^(\d{6})_([^_]+)_(\d+)_([^_]+)$')
+
+
+def list_run_folders(run_roots=RUN_ROOTS):
+    """Find the run folders in the run roots, listing each root once
+
+    :param list run_roots: directories holding the run folders, glob patterns allowed
+    :returns: dict run id (the folder name) -> run date (YYMMDD)
+    """
+    runs = {}
+    for pattern in run_roots:
+        for root in sorted(glob.glob(pattern)):
+            if not os.path.isdir(root):
                 continue
-            if db_name == "x_flowcells":
-                if 'Flowcell_stats' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
-                    continue
-                if 'Yield (MBases)' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Flowcell_stats']:
-                    continue
-                yield_MBases = int(flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Flowcell_stats']['Yield (MBases)'].replace(',', ''))
-            else:
-                if 'Barcode_lane_statistics' not in  flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
-                    continue
-                for sample  in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']:
-                    yield_MBases +=  int(sample['Yield (Mbases)'].replace(',', ''))
+            for name in os.listdir(root):
+                match = RUN_FOLDER.match(name)
+                if match is not None:
+                    runs[name] = match.group(1)
+    return runs
+
+
+def run_id_contribution(fc_doc):
+    """Run id of a flowcell document, None if it has none"""
+    return fc_doc.get('RunInfo', {}).get('Id')
 
-            if year not in production_stats:
-                production_stats[year] = month_production = [0]*12
-            production_stats[year][month-1] += yield_MBases
-    sys.stdout.write(',')
-    for year in sorted(production_stats):
-        sys.stdout.write('{},'.format(year))
-    sys.stdout.write('\n')
-    for month in range(0,12,1):
-        sys.stdout.write('{},'.format(month+1))
-        for year in sorted(production_stats):
-            sys.stdout.write('{},'.format(production_stats[year][month]))
-        sys.stdout.write('\n')
-    sys.stdout.write('\n')
 
+def runs_per_week(run_roots=RUN_ROOTS, since=None, until=None, selected_instrument_type=None, with_statusdb=False, output=None):
+    """Report the number of runs per week and instrument type
+
+    Runs are found from their folders in the run roots and, with with_statusdb,
+    from the run ids of x_flowcells, so runs whose folder has been removed are
+    counted too. Weeks start on Monday and are numbered as by strftime's %W: the
+    days before the first Monday of a year are its week 0.
+
+    :param str since: first run date (YYMMDD) to count, defaults to the first run found
+    :param str until: run date (YYMMDD) before which runs are counted, defaults to after the last run found
+    """
+    runs = list_run_folders(run_roots)
+    if with_statusdb:
+        for run_id in flowcell_contributions("x_flowcells", RUN_ID_REPORT, run_id_contribution, selected_instrument_type, since, until):
+            if run_id is not None and run_id not in runs:
+                #run ids start with the run date
+                runs[run_id] = run_id[0:6]
+    instrument_types = [instrument_type for instrument_type in ["HiSeqX", "HiSeq2500", "MiSeq"]
+                        if selected_instrument_type in (None, instrument_type)]
+    week_runs = {}
+    run_days = []
+    for run_id, run_date in runs.items():
+        if (since is not None and run_date < since) or (until is not None and run_date >= until):
+            continue
+        instrument_type = get_FC_type(run_id)
+        if instrument_type not in instrument_types:
+            continue
+        try:
+            day = datetime.strptime(run_date, '%y%m%d')
+        except ValueError:
+            print("{} has no valid run date".format(run_id))
+            continue
+        run_days.append(day)
+        week = (day.year, int(day.strftime('%W')))
+        if week not in week_runs:
+            week_runs[week] = dict((instrument_type, 0) for instrument_type in instrument_types)
+        week_runs[week][instrument_type] += 1
+    #every week of the range, including the ones without runs
+    rows = []
+    if run_days:
+        day = datetime.strptime(since, '%y%m%d') if since is not None else min(run_days)
+        last_day = datetime.strptime(until, '%y%m%d') - timedelta(days=1) if until is not None else max(run_days)
+        while day <= last_day:
+            week = (day.year, int(day.strftime('%W')))
+            if not rows or tuple(rows[-1][0:2]) != week:
+                rows.append(list(week) + [week_runs.get(week, {}).get(instrument_type, 0) for instrument_type in instrument_types])
+            day += timedelta(days=1)
+    table = pd.DataFrame(rows, columns=['year', 'week'] + instrument_types)
+
+    def render(table):
+        text = [",".join(table.columns) + '\n']
+        for row in table.itertuples(index=False):
+            text.append(",".join('{}'.format(value) for value in row) + '\n')
+        return "".join(text)
+    (output or ReportOutput()).write([('runs_per_week', table)], render)
 
 
 def main(args):
     configuration_file = args.config
     load_yaml_config(configuration_file)
-    configuration_file = args.config
-    load_yaml_config(configuration_file)
+    if args.snapshot is not None:
+        CONFIG['snapshot'] = {'path': args.snapshot, 'offline': args.offline}
+    elif args.offline:
+        sys.exit("--offline requires --snapshot")
+    if args.project_cache is not None:
+        CONFIG['project_cache'] = {'path': args.project_cache, 'ttl': args.project_cache_ttl}
+
+    output = ReportOutput(args.output_format, args.output_dir)
 
     if args.mode == 'production-stats':
-        projects = parse_flowcell_db()
+        projects = parse_flowcell_db(args.instrument_type, args.since or PRODUCTION_STATS_SINCE, args.until or PRODUCTION_STATS_UNTIL, output)
 
     if args.mode == 'instrument-usage':
-        instrument_usage()
+        instrument_usage(args.instrument_type, args.since, args.until, output)
 
     if args.mode == 'year-stats':
-        year_bp_production()
+        year_bp_production(args.instrument_type, args.since, args.until, output)
+
+    if args.mode == 'period-stats':
+        period_stats(args.instrument_type, args.since, args.until, args.period or ['month'], args.rolling, output)
+
+    if args.mode == 'runs-per-week':
+        #the runs of the current year by default
+        since = args.since or date.today().strftime('%y0101')
+        runs_per_week(args.run_root or RUN_ROOTS, since, args.until, args.instrument_type, args.with_statusdb, output)
 
 
 
@@ -515,9 +839,24 @@ if __name__ == '__main__':
          - production-stats: for each instrument type it prints number of FCs, number of lanes, etc. It then prints a summary of all stats
          - instrument-usage: for each instrument type and year it prints different run set-ups and samples run with that set-up
          - year-stats: cumulative data production by month
+         - period-stats: runs, lanes and data production per instrument type by week, month, quarter or year
+         - runs-per-week: number of runs per week and instrument type, from the run folders
         """)
     parser.add_argument('--config', help="configuration file", type=str,  required=True)
-    parser.add_argument('--mode', help="define what action needs to be executed", type=str, required=True, choices=('production-stats', 'instrument-usage', 'year-stats'))
+    parser.add_argument('--mode', help="define what action needs to be executed", type=str, required=True, choices=('production-stats', 'instrument-usage', 'year-stats', 'period-stats', 'runs-per-week'))
+    parser.add_argument('--instrument-type', help="only consider runs on this type of instrument", type=str, default=None, choices=('HiSeqX', 'MiSeq', 'HiSeq2500'))
+    parser.add_argument('--since', help="only consider runs from this date on (YYYY-MM-DD, production-stats defaults to 2016-01-01, runs-per-week to the current year)", type=parse_run_date, default=None)
+    parser.add_argument('--until', help="only consider runs before this date (YYYY-MM-DD, production-stats defaults to 2017-01-01)", type=parse_run_date, default=None)
+    parser.add_argument('--period', help="period-stats periods to aggregate over, can be repeated (default month)", type=str, action='append', choices=sorted(PERIODS))
+    parser.add_argument('--rolling', help="with period-stats, sum each period with the preceding ones over this many periods (e.g. 52 weeks)", type=int, default=None)
+    parser.add_argument('--run-root', help="with runs-per-week, directory holding run folders, glob patterns allowed, can be repeated (default {})".format(" ".join(RUN_ROOTS)), type=str, action='append')
+    parser.add_argument('--with-statusdb', help="with runs-per-week, also count the x_flowcells runs whose folder is not found", action='store_true')
+    parser.add_argument('--output-format', help="write the report as text on stdout (default) or as one file per report table in this format", type=str, default='text', choices=OUTPUT_FORMATS)
+    parser.add_argument('--output-dir', help="directory where the report files are written, with --output-format", type=str, default='.')
+    parser.add_argument('--snapshot', help="local snapshot file of the flowcell databases, only documents changed since the last run are downloaded", type=str, default=None)
+    parser.add_argument('--offline', help="run against the local snapshot without contacting statusdb (requires --snapshot)", action='store_true')
+    parser.add_argument('--project-cache', help="JSON file caching the project metadata of statusdb between runs", type=str, default=None)
+    parser.add_argument('--project-cache-ttl', help="hours after which the project cache is refetched (default %(default)s, never with --offline)", type=float, default=PROJECT_CACHE_TTL)
 
     args = parser.parse_args()
     main(args)
@@ -8,8 +8,13 @@ import logging
 import argparse
 import yaml
 import json
-import distance
-import operator
+import itertools
+import functools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from flowcell_snapshot import stream_docs, open_snapshot, parse_run_date, undetermined_count
+from report_output import ReportOutput, OUTPUT_FORMATS
 try:
     import ConfigParser
 except ImportError:
@@ -30,6 +35,32 @@ def setupServer(conf):
     return couchdb.Server(url)
 
 
+def flowcell_docs(db_name, instrument_type=None, since=None, until=None):
+    """Stream the documents of a flowcell database
+
+    If a snapshot is configured (--snapshot) the documents are served from the
+    local snapshot, refreshed first unless --offline is given. If an instrument
+    type or run dates (YYMMDD) are given only the matching runs are streamed,
+    filtered by statusdb through the by_instrument_date view.
+    """
+    snapshot_conf = CONFIG.get('snapshot', {})
+    offline = snapshot_conf.get('offline', False)
+    couch = None if offline else setupServer(CONFIG)
+    instrument_types = [instrument_type] if instrument_type is not None else None
+    return stream_docs(couch, db_name, snapshot_conf.get('path'), offline,
+                       instrument_types=instrument_types, since=since, until=until)
+
+
+def flowcell_snapshot(db_name):
+    """Open the configured snapshot (refreshed unless --offline), None if no --snapshot is given"""
+    snapshot_conf = CONFIG.get('snapshot', {})
+    if snapshot_conf.get('path') is None:
+        return None
+    offline = snapshot_conf.get('offline', False)
+    couch = None if offline else setupServer(CONFIG)
+    return open_snapshot(couch, db_name, snapshot_conf['path'], offline)
+
+
 
 def load_yaml_config(config_file):
     """Load YAML config file
@@ -67,7 +98,22 @@ class Indexes:
     #index_seq: ((index_name, index_type, kit_name), ....)
     indexes = {}
 
+    #2-bit code of each base (A=00, C=01, G=10, T=11, the complement of a base is 3 - code),
+    #N is encoded as A and flagged in a separate mask
+    BASE_CODES = np.zeros(256, dtype=np.uint8)
+    for base, code in zip('ACGTacgt', (0, 1, 2, 3, 0, 1, 2, 3)):
+        BASE_CODES[ord(base)] = code
+    #low bit of every 2-bit base
+    LOW_BITS = np.uint64(0x5555555555555555)
+
     def __init__(self, indexes_file):
+        #a fresh index centric object per instance (the class attribute would be shared)
+        self.indexes = {}
+        #reverse complements already computed
+        self.reverse_complements = {}
+        #hash of the sequences close to known indexes, see _build_neighbourhood
+        self.neighbourhood = {}
+        self.neighbourhood_mismatches = -1
         try:
             with open(indexes_file, 'r') as f:
                 self.indexes_by_kit = yaml.load(f)
@@ -86,12 +132,15 @@ class Indexes:
 
     #computes reverse complement
     def _reverse_complement(self, index):
+        if index in self.reverse_complements:
+            return self.reverse_complements[index]
         for base in index:
             if base not in 'ATCGNatcgn':
                 print("Error: NOT a DNA sequence")
                 return None
         complement_dict = {"A":"T", "C":"G", "G":"C", "T":"A", "N":"N", "a":"t", "c":"g", "g":"c", "t":"a", "n":"n" }
-        return "".join([complement_dict[base] for base in reversed(index)])
+        self.reverse_complements[index] = "".join([complement_dict[base] for base in reversed(index)])
+        return self.reverse_complements[index]
 
     #check if index exists in the  indexes list
     def is_index(self, index):
@@ -112,8 +161,115 @@ class Indexes:
         #add the information
         self.indexes[index_to_modify].append(index_obj)
 
-
-
+    #encodes equally long sequences as a matrix of 2-bit base codes and a matrix flagging the Ns
+    @classmethod
+    def _encode(cls, sequences):
+        length = len(sequences[0])
+        if length > 32 or any(len(sequence) != length for sequence in sequences):
+            raise ValueError("sequences must all have the same length, of at most 32 bases")
+        chars = np.frombuffer("".join(sequences).encode('ascii'), dtype=np.uint8).reshape(len(sequences), length)
+        return cls.BASE_CODES[chars], (chars == ord('N')) | (chars == ord('n'))
+
+    #packs encoded sequences into one uint64 per sequence (first base in the highest bits)
+    #together with the N mask, that flags the low bit of the N bases
+    @staticmethod
+    def _pack(codes, unknown):
+        shifts = np.arange(2 * (codes.shape[1] - 1), -1, -2, dtype=np.uint64)
+        packed = np.bitwise_or.reduce(codes.astype(np.uint64) << shifts, axis=1)
+        unknown_packed = np.bitwise_or.reduce(unknown.astype(np.uint64) << shifts, axis=1)
+        return packed, unknown_packed
+
+    #reverse complement of encoded sequences
+    @staticmethod
+    def _reverse_complement_codes(codes, unknown):
+        return 3 - codes[:, ::-1], unknown[:, ::-1]
+
+    #encoded sequences shifted one base to the left, an A entering on the right
+    @staticmethod
+    def _left_shift_codes(codes, unknown):
+        padding = np.zeros((codes.shape[0], 1), dtype=codes.dtype)
+        return np.hstack((codes[:, 1:], padding)), np.hstack((unknown[:, 1:], padding.astype(bool)))
+
+    #number of set bits of each element of an uint64 array
+    @staticmethod
+    def _popcount(values):
+        if hasattr(np, 'bitwise_count'):
+            return np.bitwise_count(values).astype(np.int64)
+        byte_counts = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int64)
+        return byte_counts[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1)
+
+    #pairwise Hamming distances between two lists of packed sequences of the same length
+    @classmethod
+    def _hamming_matrix(cls, packed_a, packed_b):
+        (seqs_a, unknown_a), (seqs_b, unknown_b) = packed_a, packed_b
+        diff = seqs_a[:, None] ^ seqs_b[None, :]
+        #a base differs if any of its two bits differs, or if only one of the two is an N
+        mismatches = ((diff | (diff >> np.uint64(1))) & cls.LOW_BITS) | (unknown_a[:, None] ^ unknown_b[None, :])
+        return cls._popcount(mismatches)
+
+    def hamming_matrix(self, sequences_a, sequences_b):
+        """Return the matrix of Hamming distances between two lists of sequences of the same length"""
+        return self._hamming_matrix(self._pack(*self._encode(sequences_a)), self._pack(*self._encode(sequences_b)))
+
+    #yields every sequence at Hamming distance 0 to max_mismatches from seq, with its distance
+    @staticmethod
+    def _variants(seq, max_mismatches):
+        for mismatches in range(max_mismatches + 1):
+            for positions in itertools.combinations(range(len(seq)), mismatches):
+                substitutions = [[base for base in 'ACGTN' if base != seq[position]] for position in positions]
+                for bases in itertools.product(*substitutions):
+                    variant = list(seq)
+                    for position, base in zip(positions, bases):
+                        variant[position] = base
+                    yield "".join(variant), mismatches
+
+    def _build_neighbourhood(self, max_mismatches):
+        #neighbourhood maps every sequence within max_mismatches of a known index (as it is or
+        #reverse complemented) to (index_seq, mismatches, orientation) of the closest one,
+        #index_seq and orientation are None if two different indexes are equally close
+        self.neighbourhood = {}
+        self.neighbourhood_mismatches = max_mismatches
+        self.index_lengths = sorted(set(len(index_seq) for index_seq in self.indexes), reverse=True)
+        for index_seq in self.indexes:
+            for orientation, seq in (('forward', index_seq), ('reverse_complement', self._reverse_complement(index_seq))):
+                for variant, mismatches in self._variants(seq, max_mismatches):
+                    known = self.neighbourhood.get(variant)
+                    if known is None or mismatches < known[1]:
+                        self.neighbourhood[variant] = (index_seq, mismatches, orientation)
+                    elif mismatches == known[1] and known[0] not in (None, index_seq):
+                        self.neighbourhood[variant] = (None, mismatches, None)
+
+    def classify_index(self, seq, max_mismatches=1):
+        """Find the known index closest to a single index sequence
+
+        The lookup goes through a hash of all the sequences within max_mismatches of
+        a known index or of its reverse complement, built on first use.
+
+        Sequences longer than the known indexes (e.g. a 6 bases index read in 8 cycles)
+        that do not match as a whole are matched on their first bases.
+
+        :param str seq: the index sequence, e.g. CTTGTAAT
+        :param int max_mismatches: the largest Hamming distance accepted
+        :returns: (index_seq, mismatches, orientation) of the closest known index, with
+                  index_seq and orientation set to None if several are equally close,
+                  or None if no known index is within max_mismatches
+        """
+        if self.neighbourhood_mismatches < max_mismatches:
+            self._build_neighbourhood(max_mismatches)
+        seq = seq.upper()
+        for candidate in [seq] + [seq[:length] for length in self.index_lengths if length < len(seq)]:
+            match = self.neighbourhood.get(candidate)
+            if match is not None and match[1] <= max_mismatches:
+                return match
+        return None
+
+    def classify(self, barcode, max_mismatches=1):
+        """Classify each part of a, possibly dual (i7+i5 or i7-i5), barcode with classify_index"""
+        return [self.classify_index(seq, max_mismatches) for seq in re.split('[+-]', barcode)]
+
+    #returns the kit and name of the indexes with sequence index_seq
+    def kits_of(self, index_seq):
+        return ",".join("{}:{}".format(index_obj['kit_type'], index_obj['name']) for index_obj in self.indexes[index_seq])
 
     #returns all kits
     def return_kits(self):
@@ -122,17 +278,50 @@ class Indexes:
             kits.append(kit_type)
         return kits
 
-    #still to be defined
     def check_left_shift_conflicts(self):
         #checks if indexes from the same library after a left shift are conflicting
         for kit_type in self.indexes_by_kit: #for each lib kit type
             for index_type in self.indexes_by_kit[kit_type]: # for each type of indexes
-                for index_name, index_seq in self.indexes_by_kit[kit_type][index_type].items():
-                    fake_index = index_seq[1:] + "A"
-                    for index_name_check, index_seq_check in self.indexes_by_kit[kit_type][index_type].items():
-                        hamming_dist = distance.hamming(index_seq_check, fake_index)
-                        if hamming_dist <= 2:
-                            print("{} {} {} {} {}".format(index_seq, index_seq_check, fake_index, hamming_dist, kit_type))
+                index_seqs = list(self.indexes_by_kit[kit_type][index_type].values())
+                codes = self._encode(index_seqs)
+                shifted = self._left_shift_codes(*codes)
+                hamming_dists = self._hamming_matrix(self._pack(*shifted), self._pack(*codes))
+                for index, index_check in zip(*np.nonzero(hamming_dists <= 2)):
+                    fake_index = index_seqs[index][1:] + "A"
+                    print("{} {} {} {} {}".format(index_seqs[index], index_seqs[index_check], fake_index, hamming_dists[index, index_check], kit_type))
+
+    def collisions(self, max_distance=2):
+        """Find all pairs of known indexes, across all kits, that are at most max_distance apart
+
+        Indexes are compared to the indexes of the same length as they are, reverse
+        complemented and, for the index on the left, shifted one base to the left.
+        Each variant is computed for all pairs at once on the 2-bit packed sequences.
+
+        :param int max_distance: the largest Hamming distance reported
+        :returns: a list of (index_seq, other_index_seq, variant, distance) tuples,
+                  variant being one of forward, reverse_complement and left_shift
+        """
+        by_length = {}
+        for index_seq in self.indexes:
+            by_length.setdefault(len(index_seq), []).append(index_seq)
+        collisions = []
+        for length in sorted(by_length):
+            index_seqs = sorted(by_length[length])
+            codes = self._encode(index_seqs)
+            packed = self._pack(*codes)
+            variants = (('forward', packed),
+                        ('reverse_complement', self._pack(*self._reverse_complement_codes(*codes))),
+                        ('left_shift', self._pack(*self._left_shift_codes(*codes))))
+            for variant, packed_variant in variants:
+                hamming_dists = self._hamming_matrix(packed_variant, packed)
+                if variant == 'left_shift':
+                    #a shift is compared with all other indexes, the symmetric variants only once per pair
+                    close = (hamming_dists <= max_distance) & ~np.eye(len(index_seqs), dtype=bool)
+                else:
+                    close = np.triu(hamming_dists <= max_distance, 1)
+                for index, other_index in zip(*np.nonzero(close)):
+                    collisions.append((index_seqs[index], index_seqs[other_index], variant, int(hamming_dists[index, other_index])))
+        return collisions
 
 
 
@@ -149,359 +338,785 @@ def get_FC_type(FCid):
 import time
 from datetime import  date
 
-def check_single_sample_lanes(instrument_type):
-    couch=setupServer(CONFIG)
-    flowcell_db = couch["x_flowcells"]
-    flowcell_docs = {}
+#single_sample_lanes only reports runs from this date (YYMMDD) on, unless --since is given
+SINGLE_SAMPLE_LANES_SINCE = "160301"
+
+
+def single_sample_lanes_of(fc_doc, instrument_type, since=SINGLE_SAMPLE_LANES_SINCE):
+    """Extract, for check_single_sample_lanes, the single sample lanes of a flowcell with high undetermined
 
-    for fc_doc in flowcell_db:
+    Returns None if the flowcell is not considered, otherwise
+    (FCid, instrument_name, indexes of the single sample lanes with more than 10% undetermined),
+    the indexes being left empty for runs before since (YYMMDD)
+    """
+    # first check that I have all necessary info to extract information
+    if "Undetermined" not in fc_doc:
+        return None
+    FCid = fc_doc["RunInfo"]["Id"]
+    FC_type = get_FC_type(FCid)
+    #if a instrument type is specifed process only FCs run on that instrument
+    if instrument_type is not None:
+        if instrument_type != FC_type:
+            return None
+    instrument_name = fc_doc['RunInfo']['Instrument']
+    high_undet_indexes = []
+    #this is working only HiSeqX
+    #only recent runs, usually already filtered out by statusdb (see run_modes)
+    if fc_doc['RunInfo']['Date'] < since:
+        return FCid, instrument_name, high_undet_indexes
+    #understand which ones are the FCs with a single sample per lane
+    single_sample_lanes = []
+    lanes = {}
+    if 'samplesheet_csv' not in fc_doc:
+        return FCid, instrument_name, high_undet_indexes
+    for sample in fc_doc['samplesheet_csv']:
+        if sample['Lane'] not in lanes:
+            lanes[sample['Lane']] = []
+        lanes[sample['Lane']].append(sample['index'])
+    for lane in lanes:
+        #if only one sample per lane
+        if len(lanes[lane]) == 1:
+            single_sample_lanes.append([lane, lanes[lane][0]])
+    #now I know what are the lanes with a single index
+    #now collect stats
+    for lane_index in single_sample_lanes:
+        lane = lane_index[0]
+        index = lane_index[1]
+        #get percentage of undetermined
+        if lane not in fc_doc["Undetermined"]:
+            continue #it means this lane has no undetermined
+        pc_undet = [sample['% of thelane'] for sample in fc_doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics'] if sample['Lane']==lane and sample['Barcode sequence']=='unknown'][0]
         try:
-            undetermined = flowcell_db[fc_doc]["Undetermined"]
-        except KeyError:
+            pc_undet = float(pc_undet)
+        except ValueError: #sometimes it is empty
             continue
-        flowcell_docs[flowcell_db[fc_doc]["RunInfo"]["Id"]] = fc_doc
+        if pc_undet > 10:
+            high_undet_indexes.append(index)
+    return FCid, instrument_name, high_undet_indexes
+
+
+def check_single_sample_lanes(single_sample_lanes, output=None):
+    """Report, per instrument, the number of single sample lanes with high undetermined for each index
+
+    :param list single_sample_lanes: the single_sample_lanes_of results, in document order
+    :param ReportOutput output: where to write the report, stdout by default
+    """
+    #FCid -> [instrument_name, indexes of single sample lanes with high undetermined]
+    flowcells = {}
+    for FCid, instrument_name, high_undet_indexes in single_sample_lanes:
+        flowcells[FCid] = [instrument_name, high_undet_indexes]
 
     undet_stats = {}
     indexes = {}
-    date_limit = date(16,3,1)
-    for FCid in sorted(flowcell_docs):
-        # first check that I have all necessary info to extract information
-        fc_doc = flowcell_docs[FCid]
-        FC_type = get_FC_type(FCid)
-        #if a instrument type is specifed process only FCs run on that instrument
-        if instrument_type is not None:
-            if instrument_type != FC_type:
-                continue
-        instrument_name = flowcell_db[fc_doc]['RunInfo']['Instrument']
+    for FCid in sorted(flowcells):
+        instrument_name, high_undet_indexes = flowcells[FCid]
         if instrument_name not in undet_stats:
             undet_stats[instrument_name] = {}
-        #this is working only HiSeqX
-        #only recent runs
-
-        start_date_string = flowcell_db[fc_doc]['RunInfo']['Date']
-        year = start_date_string[0:2]
-        month = start_date_string[2:4]
-        day = start_date_string[4:6]
-        fc_date = date(int(year), int(month), int(day))
-        if fc_date < date_limit:
+        for index in high_undet_indexes:
+            if index not in undet_stats[instrument_name]:
+                undet_stats[instrument_name][index] = 0 #initialiaze this
+                indexes[index] = 0 #mark this as seen
+            undet_stats[instrument_name][index] += 1 # seen a lane with high amount of undetermined
+
+    #one row per instrument, one column per index
+    table = pd.DataFrame([[instrument] + [undet_stats[instrument].get(index, 0) for index in indexes] for instrument in undet_stats],
+                         columns=['instrument'] + list(indexes))
+
+    def render(table):
+        lines = [", " + "".join("{}, ".format(index) for index in table.columns[1:])]
+        for row in table.itertuples(index=False):
+            lines.append("".join("{}, ".format(value) for value in row))
+        return "\n".join(lines) + "\n\n"
+    (output or ReportOutput()).write([('single_sample_lanes', table)], render)
+
+
+
+
+
+def undetermined_index_lanes_of(fc_doc, index_to_be_searched, instrument_type):
+    """Extract, for check_undet_index, the count of the index in each lane with undetermined statistics
+
+    The count sums the undetermined barcodes equal to the index or having it as one part
+    of a dual index, the same matching as the snapshot lookups.
+    Returns None if the flowcell is not considered, otherwise (FCid, [[lane, count], ...])
+    """
+    # first check that I have all necessary info to extract information
+    if "Undetermined" not in fc_doc:
+        return None
+    FCid = fc_doc["RunInfo"]["Id"]
+    FC_type = get_FC_type(FCid)
+    #if a instrument type is specifed process only FCs run on that instrument
+    if instrument_type is not None:
+        if instrument_type != FC_type:
+            return None
+    undetermined = fc_doc["Undetermined"]
+    lanes_undet = []
+    for lane in ['1','2','3','4','5','6','7','8']:
+        if lane not in undetermined:
+            continue
+        lanes_undet.append([lane, undetermined_count(undetermined[lane], index_to_be_searched)])
+    return FCid, lanes_undet
+
+
+def undetermined_time_line(undetermined_index_lanes):
+    """Collect the undetermined_index_lanes_of results (in document order) in a dict FCid -> [[lane, count], ...]"""
+    time_line = {}
+    for FCid, lanes_undet in undetermined_index_lanes:
+        if len(lanes_undet) > 0:
+            time_line[FCid] = lanes_undet
+        elif FCid in time_line:
+            del time_line[FCid]
+    return time_line
+
+
+def in_run_dates(run_date, since=None, until=None):
+    """Return True if run_date (YYMMDD) is not before since and before until, both optional"""
+    return (since is None or run_date >= since) and (until is None or run_date < until)
+
+
+def undetermined_time_line_from_index(snapshot, index_to_be_searched, instrument_type, mismatches=0, prefix=False, since=None, until=None):
+    """Count the index in every lane with undetermined statistics, using the snapshot inverted index
+
+    Counts of all undetermined barcodes matching the index in a lane are summed.
+    Only runs between since and until (YYMMDD, optional) are considered.
+    Returns a dict FCid -> [[lane, count], ...]
+    """
+    #doc_id -> [FCid, {lane: count}]
+    lanes_by_doc = {}
+    for doc_id, FCid, lane, run_date in snapshot.undetermined_lanes("x_flowcells"):
+        if lane not in ['1','2','3','4','5','6','7','8']:
             continue
-        #understand which ones are the FCs with a single sample per lane
-        single_sample_lanes = []
-        lanes = {}
-        if 'samplesheet_csv' not in flowcell_db[fc_doc]:
+        if instrument_type is not None and instrument_type != get_FC_type(FCid):
             continue
-        for sample in flowcell_db[fc_doc]['samplesheet_csv']:
-            if sample['Lane'] not in lanes:
-                lanes[sample['Lane']] = []
-            lanes[sample['Lane']].append(sample['index'])
-        for lane in lanes:
-            #if only one sample per lane
-            if len(lanes[lane]) == 1:
-                single_sample_lanes.append([lane, lanes[lane][0]])
-        #now I know what are the lanes with a single index
-        #now collect stats
-        for lane_index in single_sample_lanes:
-            lane = lane_index[0]
-            index = lane_index[1]
-            #get percentage of undetermined
-            if lane not in flowcell_db[fc_doc]["Undetermined"]:
-                continue #it means this lane has no undetermined
-            pc_undet = [sample['% of thelane'] for sample in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics'] if sample['Lane']==lane and sample['Barcode sequence']=='unknown'][0]
-            try:
-                pc_undet = float(pc_undet)
-            except ValueError: #sometimes it is empty
-                continue
-            if pc_undet > 10:
-                if index not in undet_stats[instrument_name]:
-                    undet_stats[instrument_name][index] = 0 #initialiaze this
-                    indexes[index] = 0 #mark this as seen
-                undet_stats[instrument_name][index] += 1 # seen a lane with high amount of undetermined
-
-    print(",", end=' ')
-    for index in indexes:
-        print("{},".format(index), end=' ')
-    print("")
-    for instrument in undet_stats:
-        print("{},".format(instrument), end=' ')
-        for index in indexes:
-            if index in undet_stats[instrument]:
-                print("{},".format(undet_stats[instrument][index]), end=' ')
-            else:
-                print("0,", end=' ')
-        print("")
-    print("")
-
-
-
-
-
-def find_undetermined_index_over_time(index_to_be_searched, instrument_type):
-    couch=setupServer(CONFIG)
-    flowcell_db = couch["x_flowcells"]
-    flowcell_docs = {}
-    for fc_doc in flowcell_db:
-        try:
-            undetermined = flowcell_db[fc_doc]["Undetermined"]
-        except KeyError:
+        if not in_run_dates(run_date, since, until):
             continue
-        flowcell_docs[flowcell_db[fc_doc]["RunInfo"]["Id"]] = fc_doc
+        if doc_id not in lanes_by_doc:
+            lanes_by_doc[doc_id] = [FCid, {}]
+        lanes_by_doc[doc_id][1][lane] = 0
+    for barcode, doc_id, FCid, lane, count, run_date in snapshot.lookup_undetermined("x_flowcells", index_to_be_searched, mismatches, prefix):
+        if doc_id in lanes_by_doc and lane in lanes_by_doc[doc_id][1]:
+            lanes_by_doc[doc_id][1][lane] += count
+    time_line = {}
+    #documents ordered by id, as in a scan the last document of a flowcell wins
+    for doc_id in sorted(lanes_by_doc):
+        FCid, lanes = lanes_by_doc[doc_id]
+        time_line[FCid] = [[lane, lanes[lane]] for lane in sorted(lanes)]
+    return time_line
 
 
-    time_line = []
+def find_undetermined_index_over_time(time_line, output=None):
+    """Report the count of the searched index for each flowcell lane, ordered by flowcell"""
+    table = pd.DataFrame([(FCid, lane, count) for FCid in sorted(time_line) for lane, count in time_line[FCid]],
+                         columns=['flowcell', 'lane', 'count'])
 
-    for FCid in sorted(flowcell_docs):
-        # first check that I have all necessary info to extract information
-        fc_doc = flowcell_docs[FCid]
-        FC_type = get_FC_type(FCid)
-        #if a instrument type is specifed process only FCs run on that instrument
-        if instrument_type is not None:
-            if instrument_type != FC_type:
-                continue
-        undetermined = flowcell_db[fc_doc]["Undetermined"]
-        lanes_undet = [FCid, []]
-        for lane in ['1','2','3','4','5','6','7','8']:
-            if lane not in undetermined:
-                continue
-            index_to_be_searched_count = 0
-            for undetermined_index in undetermined[lane]:
-                if index_to_be_searched in undetermined_index:
-                    index_to_be_searched_count = undetermined[lane][undetermined_index]
-            lanes_undet[1].append([lane, index_to_be_searched_count])
-        if len(lanes_undet[1]) > 0:
-            time_line.append(lanes_undet)
+    def render(table):
+        return "".join("{}_{} {}\n".format(FCid, lane, count) for FCid, lane, count in table.itertuples(index=False))
+    (output or ReportOutput()).write([('check_undet_index', table)], render)
 
-    for FC in time_line:
-        FCid = FC[0]
-        for lane in FC[1]:
-            print("{}_{} {}".format(FCid, lane[0], lane[1]))
 
 
 
+def lane_samples(fc_doc, lane):
+    """Return (FCid, lane, samples, projects) for a lane, as listed in the samplesheet"""
+    name = 'SampleName'
+    for samplesheet_entry in fc_doc["samplesheet_csv"]:
+        if 'SampleName' not in samplesheet_entry:
+             name = 'Sample_Name'
+    samples_with_undet_in_lane  = set([samplesheet_entry[name] for samplesheet_entry in  fc_doc["samplesheet_csv"] if samplesheet_entry['Lane']==lane])
+    projects_with_undet_in_lane = set([samplesheet_entry[name].split("_")[0] for samplesheet_entry in  fc_doc["samplesheet_csv"] if samplesheet_entry['Lane']==lane])
+    return fc_doc["RunInfo"]["Id"], lane, samples_with_undet_in_lane, projects_with_undet_in_lane
 
-def undet_index_to_projects(index_to_be_searched, instrument_type, min_occurences=0):
-    status_db = setupServer(CONFIG)
-    workset_db = status_db['worksets']
-    workset_project_view = workset_db.view('project/ws_proj')
 
+def lanes_with_undet_index_of(fc_doc, index_to_be_searched, instrument_type, min_occurences=0):
+    """Extract, for workset_undet, the lanes where the index was seen more than min_occurences times in undetermined
 
-    flowcell_db = status_db["x_flowcells"]
-    flowcell_docs = {}
-    counter = 0
-    projects_with_undet_in_fc_set = set()
-    worksets_with_undet_in_fc     = {}
-    for fc_doc in flowcell_db:
-        try:
-            undetermined = flowcell_db[fc_doc]["Undetermined"]
-        except KeyError:
+    Barcodes are matched and counted as in undetermined_index_lanes_of.
+    Returns a list of lane_samples tuples, None if the flowcell is not considered
+    """
+    if "Undetermined" not in fc_doc:
+        return None
+    FCid = fc_doc["RunInfo"]["Id"]
+    #if a instrument type is specifed process only FCs run on that instrument
+    if instrument_type is not None and instrument_type != get_FC_type(FCid):
+        return None
+    undetermined = fc_doc["Undetermined"]
+    lanes = []
+    for lane in ['1','2','3','4','5','6','7','8']:
+        if lane not in undetermined:
             continue
-        FCid = flowcell_db[fc_doc]["RunInfo"]["Id"]
-        # first check that I have all necessary info to extract information
-        FC_type = get_FC_type(FCid)
-        #if a instrument type is specifed process only FCs run on that instrument
-        if instrument_type is not None:
-            if instrument_type != FC_type:
-                continue
-        undetermined = flowcell_db[fc_doc]["Undetermined"]
-        for lane in ['1','2','3','4','5','6','7','8']:
-            if lane not in undetermined:
-                continue
-            index_to_be_searched_count = 0
-            if  index_to_be_searched in undetermined[lane] and undetermined[lane][index_to_be_searched] > min_occurences:
-                name = 'SampleName'
-                for samplesheet_entry in flowcell_db[fc_doc]["samplesheet_csv"]:
-                    if 'SampleName' not in samplesheet_entry:
-                         name = 'Sample_Name'
-                samples_with_undet_in_lane  = set([samplesheet_entry[name] for samplesheet_entry in  flowcell_db[fc_doc]["samplesheet_csv"] if samplesheet_entry['Lane']==lane])
-                projects_with_undet_in_lane = set([samplesheet_entry[name].split("_")[0] for samplesheet_entry in  flowcell_db[fc_doc]["samplesheet_csv"] if samplesheet_entry['Lane']==lane])
-                projects_with_undet_in_fc_set.update(projects_with_undet_in_lane)
-                #find out which workset contains these samples
-                for project in projects_with_undet_in_lane:
-                    #for each proejct look which workset has been involved
-                    #if len(workset_project_view[project].rows) > 1:
-                    #    import pdb
-                    #    pdb.set_trace()
-
-                    samples_with_undet_ws  = {}
-                    for sample in samples_with_undet_in_lane:
-                        #now I need to figure out in which WS the samples were... might be more than one as samples might be pooled
-                        for row in workset_project_view[project].rows:
-                            ws_doc_id = row.id
-                            ws_id = list(row.value.keys())[0] #I am pretty sure that for each row I have a sinlge entry
-                            if sample in list(row.value[ws_id]['samples'].keys()):
-                                location = row.value[ws_id]['samples'][sample]['location']
-                                #now I know that this sample in this lane in this FC was affected by index presence and I know the position
-                                if ws_id not in worksets_with_undet_in_fc:
-                                    worksets_with_undet_in_fc[ws_id] = {}
-                                if FCid not in  worksets_with_undet_in_fc[ws_id]:
-                                    worksets_with_undet_in_fc[ws_id][FCid] = {}
-                                if lane not in worksets_with_undet_in_fc[ws_id][FCid]:
-                                    worksets_with_undet_in_fc[ws_id][FCid][lane] = set()
-                                worksets_with_undet_in_fc[ws_id][FCid][lane].add((sample,location))
+        if undetermined_count(undetermined[lane], index_to_be_searched) > min_occurences:
+            lanes.append(lane_samples(fc_doc, lane))
+    return lanes
 
-    for ws_id in sorted(worksets_with_undet_in_fc):
-        print(ws_id)
-        for run_id in sorted(worksets_with_undet_in_fc[ws_id]):
-            print("\t{}".format(run_id))
-            for lane in sorted(worksets_with_undet_in_fc[ws_id][run_id]):
-                sys.stdout.write("\t\t{}: ".format(lane))
-                for sample_location in worksets_with_undet_in_fc[ws_id][run_id][lane]:
-                    sys.stdout.write("({},{}) ".format(sample_location[0], sample_location[1]))
-                sys.stdout.write('\n')
-
-
-
-
-
-
-def fetch_undermined_stats():
-    #initialise
-    couch=setupServer(CONFIG)
-    flowcell_db = couch["x_flowcells"]
-    #initialise counters for all FCs
-    MostOccurringUndetIndexes = {}
-    FC_num = 0
-    lanes_num = 0
-    MostOccurringUndetIndexes["Total"] = {}
-    #for HiSeqX FCs
-    FC_XTen_num = 0
-    lanes_Xten_num = 0
-    MostOccurringUndetIndexes["HiSeqX"] = {}
-    #for MiSeq FCs
-    FC_MiSeq_num = 0
-    lanes_MiSeq_num = 0
-    MostOccurringUndetIndexes["MiSeq"] = {}
-    #for HiSeq2500 FCs
-    FC_HiSeq_num = 0
-    lanes_HiSeq_num = 0
-    MostOccurringUndetIndexes["HiSeq2500"] = {}
-    for fc_doc in sorted(flowcell_db):
-        # first check that I have all necessary info to extract information
-        try:
-            undetermined = flowcell_db[fc_doc]["Undetermined"]
-        except KeyError:
+
+def lanes_with_undet_index_from_index(snapshot, index_to_be_searched, instrument_type, min_occurences=0, mismatches=0, prefix=False, since=None, until=None):
+    """Find the lanes where the index was seen more than min_occurences times in undetermined, using the snapshot inverted index
+
+    Only runs between since and until (YYMMDD, optional) are considered and only the
+    matching flowcell documents are loaded. Returns a list of lane_samples tuples.
+    """
+    #(doc_id, lane) -> summed count of the matching barcodes
+    lane_counts = {}
+    for barcode, doc_id, FCid, lane, count, run_date in snapshot.lookup_undetermined("x_flowcells", index_to_be_searched, mismatches, prefix):
+        if lane not in ['1','2','3','4','5','6','7','8']:
             continue
-        FCid = flowcell_db[fc_doc]["RunInfo"]["Id"]
-        FC_type = get_FC_type(FCid)
-        FC_num += 1
-        if FC_type == "HiSeqX":
-            FC_XTen_num += 1
-        elif FC_type == "HiSeq2500":
-            FC_HiSeq_num += 1
-        elif FC_type == "MiSeq":
-            FC_MiSeq_num += 1
-        #we can use the illumina Demultiplex_Stats Barcode_lane_statistics to fetch info about indexes
-        for lane in undetermined:
-            #for each lane
-            if len(undetermined[lane]) > 1: # if there are elements (there is the NoIndex case)
-                if 'TOTAL' in undetermined[lane]:
-                    del undetermined[lane]['TOTAL']
-                most_occuring_undet = sorted(list(undetermined[lane].items()), key=operator.itemgetter(1), reverse=True)[0]
-                lanes_num += 1
-                if FC_type == "HiSeqX":
-                    lanes_Xten_num += 1
-                elif FC_type == "HiSeq2500":
-                    lanes_HiSeq_num += 1
-                elif FC_type == "MiSeq":
-                    lanes_MiSeq_num += 1
-
-                if most_occuring_undet[0] not in MostOccurringUndetIndexes[FC_type]:
-                    MostOccurringUndetIndexes[FC_type][most_occuring_undet[0]] = 0
-                MostOccurringUndetIndexes[FC_type][most_occuring_undet[0]] += 1
-                if most_occuring_undet[0] not in MostOccurringUndetIndexes["Total"]:
-                    MostOccurringUndetIndexes["Total"][most_occuring_undet[0]] = 0
-                MostOccurringUndetIndexes["Total"][most_occuring_undet[0]] += 1
-
-
-
-    print("Flowcells (lanes): {} ({})".format(FC_num, lanes_num))
-    print("HiSeqX (lanes): {} ({})".format(FC_XTen_num, lanes_Xten_num))
-    print("HiSeq2500 (lanes): {} ({})".format(FC_HiSeq_num, lanes_HiSeq_num))
-    print("MiSeq (lanes): {} ({})".format(FC_MiSeq_num, lanes_MiSeq_num))
-
-    print("Most occuring undetermined (seen in #lanes)")
-    print("All Flowcells:")
-    for twenty_most_occuring_undet in sorted(list(MostOccurringUndetIndexes["Total"].items()), key=operator.itemgetter(1), reverse=True)[0:10]:
-        print("{}\t{}\t{}".format(twenty_most_occuring_undet[0], twenty_most_occuring_undet[1], twenty_most_occuring_undet[1]/float(lanes_num)))
-    print("All HiSeqX:")
-    for twenty_most_occuring_undet in sorted(list(MostOccurringUndetIndexes["HiSeqX"].items()), key=operator.itemgetter(1), reverse=True)[0:10]:
-        print("{}\t{}\t{}".format(twenty_most_occuring_undet[0], twenty_most_occuring_undet[1], twenty_most_occuring_undet[1]/float(lanes_Xten_num)))
-    print("All HiSeq2500:")
-    for twenty_most_occuring_undet in sorted(list(MostOccurringUndetIndexes["HiSeq2500"].items()), key=operator.itemgetter(1), reverse=True)[0:10]:
-        print("{}\t{}\t{}".format(twenty_most_occuring_undet[0], twenty_most_occuring_undet[1], twenty_most_occuring_undet[1]/float(lanes_HiSeq_num)))
-    print("All MiSeq:")
-    for twenty_most_occuring_undet in sorted(list(MostOccurringUndetIndexes["MiSeq"].items()), key=operator.itemgetter(1), reverse=True)[0:10]:
-        print("{}\t{}\t{}".format(twenty_most_occuring_undet[0], twenty_most_occuring_undet[1], twenty_most_occuring_undet[1]/float(lanes_MiSeq_num)))
-
-
-
-
-def fetch_pooled_projects(instrument_type):
-    status_db = setupServer(CONFIG)
-    flowcell_db = status_db["x_flowcells"]
-    counter = 0
-    projects_pooled = {}
-    for fc_doc in flowcell_db:
-        if 'RunInfo' not in flowcell_db[fc_doc]:
+        if instrument_type is not None and instrument_type != get_FC_type(FCid):
             continue
-        FCid = flowcell_db[fc_doc]["RunInfo"]["Id"]
-        # first check that I have all necessary info to extract information
-        FC_type = get_FC_type(FCid)
-        #if a instrument type is specifed process only FCs run on that instrument
-        if instrument_type is not None:
-            if instrument_type != FC_type:
-                continue
-        if 'illumina' not in flowcell_db[fc_doc]:
-            print("Not illumina field found in doc")
+        if not in_run_dates(run_date, since, until):
             continue
-        if 'Demultiplex_Stats' not in  flowcell_db[fc_doc]['illumina']:
-            print("Not Demultiplex_Stats field found in doc")
+        lane_counts[(doc_id, lane)] = lane_counts.get((doc_id, lane), 0) + count
+    lanes = []
+    fc_doc = None
+    for doc_id, lane in sorted(lane_counts):
+        if lane_counts[(doc_id, lane)] <= min_occurences:
             continue
-        if 'Barcode_lane_statistics' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
-            print("Not Barcode_lane_statistics field found in doc")
+        if fc_doc is None or fc_doc["_id"] != doc_id:
+            fc_doc = snapshot.get("x_flowcells", doc_id)
+        lanes.append(lane_samples(fc_doc, lane))
+    return lanes
+
+
+#hours after which the workset sample locations of a project in --workset-cache are queried again
+WORKSET_CACHE_TTL = 24
+
+
+def workset_sample_locations(workset_project_view, projects, cache_path=None, cache_ttl=WORKSET_CACHE_TTL):
+    """Build, for each project, a lookup sample -> [(workset id, plate location), ...]
+
+    The project/ws_proj view is queried at most once per project. If cache_path is
+    given the lookups are read from and saved to that JSON file, so projects queried
+    less than cache_ttl hours ago are not queried again and new worksets show up
+    once the lookup of their project has expired.
+
+    :param workset_project_view: the project/ws_proj view of the worksets database
+    :param projects: the projects for which a lookup is needed
+    :param str cache_path: optional JSON file caching the lookups
+    :param float cache_ttl: hours a cached lookup is used for
+    :returns: a dict project -> {sample: [(ws_id, location), ...]}
+    """
+    #project -> {'fetched': time, 'samples': {sample: [[ws_id, location], ...]}}
+    cached = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as cache:
+            cached = json.load(cache)
+    locations = {}
+    missing = []
+    for project in sorted(projects):
+        entry = cached.get(project)
+        #entries without a fetch time come from caches written without expiry, query them again
+        if entry is not None and 'fetched' in entry and time.time() - entry['fetched'] < cache_ttl * 3600:
+            locations[project] = dict((sample, [tuple(ws_location) for ws_location in ws_locations])
+                                      for sample, ws_locations in entry['samples'].items())
+        else:
+            missing.append(project)
+    for project in missing:
+        samples = {}
+        for row in workset_project_view[project].rows:
+            ws_id = list(row.value.keys())[0] #I am pretty sure that for each row I have a sinlge entry
+            for sample, sample_info in row.value[ws_id]['samples'].items():
+                samples.setdefault(sample, []).append((ws_id, sample_info['location']))
+        locations[project] = samples
+        cached[project] = {'fetched': time.time(), 'samples': samples}
+    if cache_path is not None and missing:
+        with open(cache_path, 'w') as cache:
+            json.dump(cached, cache)
+    return locations
+
+
+def undet_index_to_projects(undet_lanes, cache_path=None, output=None, cache_ttl=WORKSET_CACHE_TTL):
+    """Report for each workset the FC, lanes and samples (with their plate position) affected by the undetermined index
+
+    :param list undet_lanes: lane_samples tuples of the affected lanes
+    :param str cache_path: optional JSON file caching the workset sample locations
+    :param ReportOutput output: where to write the report, stdout by default
+    :param float cache_ttl: hours after which the cached locations of a project are queried again
+    """
+    status_db = setupServer(CONFIG)
+    workset_db = status_db['worksets']
+    workset_project_view = workset_db.view('project/ws_proj')
+    projects = set()
+    for FCid, lane, samples_with_undet_in_lane, projects_with_undet_in_lane in undet_lanes:
+        projects.update(projects_with_undet_in_lane)
+    sample_locations = workset_sample_locations(workset_project_view, projects, cache_path, cache_ttl)
+
+    worksets_with_undet_in_fc     = {}
+    for FCid, lane, samples_with_undet_in_lane, projects_with_undet_in_lane in undet_lanes:
+        #find out which workset contains these samples
+        for project in projects_with_undet_in_lane:
+            #for each proejct look which workset has been involved
+            for sample in samples_with_undet_in_lane:
+                #a sample might be in more than one WS as samples might be pooled
+                for ws_id, location in sample_locations[project].get(sample, []):
+                    #now I know that this sample in this lane in this FC was affected by index presence and I know the position
+                    if ws_id not in worksets_with_undet_in_fc:
+                        worksets_with_undet_in_fc[ws_id] = {}
+                    if FCid not in  worksets_with_undet_in_fc[ws_id]:
+                        worksets_with_undet_in_fc[ws_id][FCid] = {}
+                    if lane not in worksets_with_undet_in_fc[ws_id][FCid]:
+                        worksets_with_undet_in_fc[ws_id][FCid][lane] = set()
+                    worksets_with_undet_in_fc[ws_id][FCid][lane].add((sample,location))
+
+    rows = []
+    for ws_id in sorted(worksets_with_undet_in_fc):
+        for run_id in sorted(worksets_with_undet_in_fc[ws_id]):
+            for lane in sorted(worksets_with_undet_in_fc[ws_id][run_id]):
+                for sample, location in worksets_with_undet_in_fc[ws_id][run_id][lane]:
+                    rows.append((ws_id, run_id, lane, sample, location))
+    table = pd.DataFrame(rows, columns=['workset', 'flowcell', 'lane', 'sample', 'location'])
+
+    def render(table):
+        text = []
+        previous = (None, None, None)
+        for ws_id, run_id, lane, sample, location in table.itertuples(index=False):
+            if (ws_id, run_id, lane) != previous and previous[2] is not None:
+                #end the line of the previous lane
+                text.append("\n")
+            if ws_id != previous[0]:
+                text.append("{}\n".format(ws_id))
+            if (ws_id, run_id) != previous[:2]:
+                text.append("\t{}\n".format(run_id))
+            if (ws_id, run_id, lane) != previous:
+                text.append("\t\t{}: ".format(lane))
+            text.append("({},{}) ".format(sample, location))
+            previous = (ws_id, run_id, lane)
+        if previous[2] is not None:
+            text.append("\n")
+        return "".join(text)
+    (output or ReportOutput()).write([('workset_undet', table)], render)
+
+
+
+
+
+
+def undetermined_lanes_of(fc_doc):
+    """Extract, for most_undet, the undetermined barcodes of each lane of a flowcell
+
+    Only lanes with more than one undetermined entry are kept (a single entry is the
+    NoIndex case) and TOTAL entries are dropped.
+    Returns None for flowcells without undetermined statistics, otherwise
+    (FCid, FC_type, instrument, year, month, [(lane, [(barcode, count), ...]), ...])
+    """
+    # first check that I have all necessary info to extract information
+    if "Undetermined" not in fc_doc:
+        return None
+    FCid = fc_doc["RunInfo"]["Id"]
+    run_date = fc_doc["RunInfo"].get("Date", "")
+    year = int("20" + run_date[0:2]) if len(run_date) >= 4 else None
+    month = int(run_date[2:4]) if len(run_date) >= 4 else None
+    lanes = []
+    for lane, undetermined in fc_doc["Undetermined"].items():
+        if len(undetermined) <= 1: # if there are elements (there is the NoIndex case)
             continue
-        demux_stats = flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
-        for lane in ['1','2','3','4','5','6','7','8']:
-            samples_in_lane =  [entry['Sample'] for entry in demux_stats if entry['Lane'] == lane and not(entry['Sample'] == 'unknown' or entry['Sample'] == 'Undetermined') ]
-            if len(samples_in_lane) > 1:
-                #it means pooled
-                projects = set( entry['Project'] for entry in demux_stats if entry['Lane'] == lane and not(entry['Sample'] == 'unknown' or entry['Sample'] == 'Undetermined') )
-                samples_concat= ""
-                for sample in sorted(samples_in_lane):
-                    samples_concat += sample + " "
-                for project in projects:
-                    if project not in projects_pooled:
-                        projects_pooled[project] = set()
-                    projects_pooled[project].add(samples_concat)
-
-    for project in projects_pooled:
-        print(project)
-        for pool in projects_pooled[project]:
-            print("\t{}".format(pool))
+        lanes.append((lane, [(barcode, count) for barcode, count in undetermined.items() if barcode != 'TOTAL']))
+    return FCid, get_FC_type(FCid), fc_doc["RunInfo"].get("Instrument"), year, month, lanes
 
 
-def main(args):
-    configuration_file = args.config
-    load_yaml_config(configuration_file)
+def undetermined_table(undetermined_lanes):
+    """Flatten the undetermined statistics of all flowcells into columnar tables
 
-    if args.mode == 'most_undet':
-        fetch_undermined_stats()
+    :param list undetermined_lanes: the undetermined_lanes_of results, in document order
+    :returns: a tuple (flowcells, barcodes) of pandas DataFrames. flowcells has one row
+              per flowcell with undetermined statistics (flowcell, instrument_type);
+              barcodes has one row per lane and undetermined barcode (lane_id, flowcell,
+              instrument_type, instrument, year, month, lane, barcode, count), where
+              lane_id numbers the lanes in the order they are seen.
+    """
+    flowcells = {'flowcell': [], 'instrument_type': []}
+    barcodes = {'lane_id': [], 'flowcell': [], 'instrument_type': [], 'instrument': [],
+                'year': [], 'month': [], 'lane': [], 'barcode': [], 'count': []}
+    lane_id = 0
+    for FCid, FC_type, instrument, year, month, lanes in undetermined_lanes:
+        flowcells['flowcell'].append(FCid)
+        flowcells['instrument_type'].append(FC_type)
+        for lane, lane_barcodes in lanes:
+            for barcode, count in lane_barcodes:
+                barcodes['lane_id'].append(lane_id)
+                barcodes['flowcell'].append(FCid)
+                barcodes['instrument_type'].append(FC_type)
+                barcodes['instrument'].append(instrument)
+                barcodes['year'].append(year)
+                barcodes['month'].append(month)
+                barcodes['lane'].append(lane)
+                barcodes['barcode'].append(barcode)
+                barcodes['count'].append(count)
+            lane_id += 1
+    barcodes = pd.DataFrame(barcodes)
+    barcodes['count'] = barcodes['count'].astype(np.int64)
+    return pd.DataFrame(flowcells), barcodes
+
+
+def most_occurring_per_lane(barcodes):
+    """Keep for each lane only its most occurring undetermined barcode (first one on ties)"""
+    if barcodes.empty:
+        return barcodes
+    return barcodes.loc[barcodes.groupby('lane_id', sort=False)['count'].idxmax().values]
+
+
+def top_k(counts, k):
+    """Positions of the k largest values in counts, largest first, ties kept in their original order
+
+    Only the values not smaller than the k-th largest one (found with a linear
+    time partition) are sorted.
+    """
+    counts = np.asarray(counts)
+    if k <= 0:
+        return np.array([], dtype=int)
+    if len(counts) > k:
+        threshold = np.partition(counts, len(counts) - k)[len(counts) - k]
+        candidates = np.flatnonzero(counts >= threshold)
+    else:
+        candidates = np.arange(len(counts))
+    order = np.argsort(-counts[candidates], kind='stable')
+    return candidates[order][:k]
 
-    if args.mode == 'check_undet_index':
-        if args.index is None:
-            sys.exit("in this mode --index must be specified")
-        find_undetermined_index_over_time(args.index, args.instrument_type)
 
-    if args.mode == 'workset_undet':
-        if args.index is None:
-            sys.exit("in this mode --index must be specified")
-        undet_index_to_projects(args.index, args.instrument_type, args.min_occurences)
+def most_undetermined_by(top_lanes, by, k=10):
+    """Rank, within each group, the barcodes by the number of lanes where they are the most occurring one
+
+    :param pandas.DataFrame top_lanes: the output of most_occurring_per_lane
+    :param list by: columns of top_lanes defining the groups, e.g. ['instrument_type', 'year']
+    :param int k: number of barcodes to report per group
+    :returns: a dict group key (tuple) -> (number of lanes in the group, [(barcode, lanes), ...])
+    """
+    result = {}
+    if top_lanes.empty:
+        return result
+    #sort=False keeps barcodes in the order they are first seen, which decides ties
+    lanes_per_barcode = top_lanes.groupby(by + ['barcode'], sort=False).size().reset_index(name='lanes')
+    for group, group_counts in lanes_per_barcode.groupby(by, sort=True):
+        if not isinstance(group, tuple):
+            group = (group,)
+        positions = top_k(group_counts['lanes'].values, k)
+        top = [(group_counts['barcode'].values[i], int(group_counts['lanes'].values[i])) for i in positions]
+        result[group] = (int(group_counts['lanes'].sum()), top)
+    return result
+
+
+def fetch_undermined_stats(undetermined_lanes, group_by=None, top=10, output=None):
+    """Report the undetermined indexes that most often are the most occurring one of a lane
+
+    :param list undetermined_lanes: the undetermined_lanes_of results, in document order
+    :param list group_by: additional grouping columns to report on, see most_undetermined_by
+    :param int top: number of indexes reported per group
+    :param ReportOutput output: where to write the report, stdout by default
+    """
+    flowcells, barcodes = undetermined_table(undetermined_lanes)
+    top_lanes = most_occurring_per_lane(barcodes)
+    FC_per_type = flowcells['instrument_type'].value_counts()
+    lanes_per_type = top_lanes['instrument_type'].value_counts()
+    FC_types = ["HiSeqX", "HiSeq2500", "MiSeq"]
+
+    summary = pd.DataFrame([("All", len(flowcells), len(top_lanes))] +
+                           [(FC_type, FC_per_type.get(FC_type, 0), lanes_per_type.get(FC_type, 0)) for FC_type in FC_types],
+                           columns=['instrument_type', 'flowcells', 'lanes'])
+
+    groups = [("All", most_undetermined_by(top_lanes.assign(total="Total"), ['total'], top).get(("Total",)))]
+    per_type = most_undetermined_by(top_lanes, ['instrument_type'], top)
+    for FC_type in FC_types:
+        groups.append((FC_type, per_type.get((FC_type,))))
+    rows = []
+    for name, group in groups:
+        if group is None:
+            continue
+        group_lanes, most_occuring = group
+        for barcode, lanes in most_occuring:
+            rows.append((name, barcode, lanes, lanes/float(group_lanes)))
+    most_undet = pd.DataFrame(rows, columns=['group', 'barcode', 'lanes', 'fraction'])
+    tables = [('most_undet_summary', summary), ('most_undet', most_undet)]
+
+    if group_by:
+        rows = []
+        for group, (group_lanes, most_occuring) in sorted(most_undetermined_by(top_lanes, group_by, top).items()):
+            for barcode, lanes in most_occuring:
+                rows.append(group + (barcode, lanes, lanes/float(group_lanes)))
+        tables.append(('most_undet_by_group', pd.DataFrame(rows, columns=group_by + ['barcode', 'lanes', 'fraction'])))
+
+    def render(summary, most_undet, most_undet_by_group=None):
+        text = []
+        for FC_type, FC_num, lanes_num in summary.itertuples(index=False):
+            text.append("{} (lanes): {} ({})\n".format("Flowcells" if FC_type == "All" else FC_type, FC_num, lanes_num))
+        text.append("Most occuring undetermined (seen in #lanes)\n")
+        for name in ["All"] + FC_types:
+            text.append("All {}:\n".format("Flowcells" if name == "All" else name))
+            for row in most_undet[most_undet['group'] == name].itertuples(index=False):
+                text.append("{}\t{}\t{}\n".format(row.barcode, row.lanes, row.fraction))
+        if most_undet_by_group is not None:
+            text.append("Most occuring undetermined by {} (seen in #lanes)\n".format(", ".join(group_by)))
+            previous = None
+            for row in most_undet_by_group.itertuples(index=False):
+                group = tuple(row[:len(group_by)])
+                if group != previous:
+                    text.append("{}:\n".format(" ".join(str(key) for key in group)))
+                    previous = group
+                text.append("{}\t{}\t{}\n".format(row.barcode, row.lanes, row.fraction))
+        return "".join(text)
+    (output or ReportOutput()).write(tables, render)
+
+
+
+
+def pooled_samples_of(fc_doc, instrument_type):
+    """Extract, for fetch_pooled_projects, the pools of a flowcell
+
+    Returns None if the flowcell is not considered, otherwise a list of
+    (project, space separated names of the samples in the pool)
+    """
+    if 'RunInfo' not in fc_doc:
+        return None
+    FCid = fc_doc["RunInfo"]["Id"]
+    # first check that I have all necessary info to extract information
+    FC_type = get_FC_type(FCid)
+    #if a instrument type is specifed process only FCs run on that instrument
+    if instrument_type is not None:
+        if instrument_type != FC_type:
+            return None
+    if 'illumina' not in fc_doc:
+        print("Not illumina field found in doc")
+        return None
+    if 'Demultiplex_Stats' not in  fc_doc['illumina']:
+        print("Not Demultiplex_Stats field found in doc")
+        return None
+    if 'Barcode_lane_statistics' not in fc_doc['illumina']['Demultiplex_Stats']:
+        print("Not Barcode_lane_statistics field found in doc")
+        return None
+    demux_stats = fc_doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
+    pools = []
+    for lane in ['1','2','3','4','5','6','7','8']:
+        samples_in_lane =  [entry['Sample'] for entry in demux_stats if entry['Lane'] == lane and not(entry['Sample'] == 'unknown' or entry['Sample'] == 'Undetermined') ]
+        if len(samples_in_lane) > 1:
+            #it means pooled
+            projects = set( entry['Project'] for entry in demux_stats if entry['Lane'] == lane and not(entry['Sample'] == 'unknown' or entry['Sample'] == 'Undetermined') )
+            samples_concat= ""
+            for sample in sorted(samples_in_lane):
+                samples_concat += sample + " "
+            for project in projects:
+                pools.append((project, samples_concat))
+    return pools
+
+
+def fetch_pooled_projects(pooled_samples, output=None):
+    """Report for each project the pools it has been run in
+
+    :param list pooled_samples: the pooled_samples_of results, in document order
+    :param ReportOutput output: where to write the report, stdout by default
+    """
+    projects_pooled = {}
+    for pools in pooled_samples:
+        for project, samples_concat in pools:
+            if project not in projects_pooled:
+                projects_pooled[project] = set()
+            projects_pooled[project].add(samples_concat)
+    table = pd.DataFrame([(project, pool) for project in projects_pooled for pool in projects_pooled[project]],
+                         columns=['project', 'pool'])
+
+    def render(table):
+        text = []
+        previous = None
+        for project, pool in table.itertuples(index=False):
+            if project != previous:
+                text.append("{}\n".format(project))
+                previous = project
+            text.append("\t{}\n".format(pool))
+        return "".join(text)
+    (output or ReportOutput()).write([('fetch_pooled_projects', table)], render)
+
+
+def print_index_collisions(indexes, max_distance=2, output=None):
+    """Report the pairs of known indexes that are at most max_distance apart, with the kits using them
+
+    :param Indexes indexes: the indexes loaded from the --indexes file
+    :param int max_distance: the largest Hamming distance reported
+    :param ReportOutput output: where to write the report, stdout by default
+    """
+    table = pd.DataFrame([(index_seq, other_index_seq, variant, hamming_dist, indexes.kits_of(index_seq), indexes.kits_of(other_index_seq))
+                          for index_seq, other_index_seq, variant, hamming_dist in indexes.collisions(max_distance)],
+                         columns=['index', 'other_index', 'variant', 'distance', 'kits', 'other_kits'])
+
+    def render(table):
+        return "".join("{} {} {} {} {} {}\n".format(*row) for row in table.itertuples(index=False))
+    (output or ReportOutput()).write([('index_collisions', table)], render)
 
 
-    if args.mode == 'single_sample_lanes':
-        check_single_sample_lanes("HiSeqX")
+def classify_undetermined(undetermined_lanes, indexes, max_mismatches=1, output=None):
+    """Report every undetermined barcode ever seen with the known indexes it most likely comes from
 
-    if args.mode == 'fetch_pooled_projects':
-        fetch_pooled_projects(args.instrument_type)
+    Barcodes are reported by decreasing total count, with the number of lanes they
+    were seen in. Each part of a dual barcode is annotated with kit:name of the
+    closest known index, the orientation it was read in and the number of mismatches,
+    or with ambiguous/unknown.
+
+    :param list undetermined_lanes: the undetermined_lanes_of results, in document order
+    :param Indexes indexes: the indexes loaded from the --indexes file
+    :param int max_mismatches: the largest Hamming distance accepted
+    :param ReportOutput output: where to write the report, stdout by default
+    """
+    flowcells, barcodes = undetermined_table(undetermined_lanes)
+    rows = []
+    if not barcodes.empty:
+        totals = barcodes.groupby('barcode').agg(count=('count', 'sum'), lanes=('lane_id', 'nunique'))
+        totals = totals.sort_values('count', ascending=False, kind='mergesort')
+        for barcode, count, lanes in zip(totals.index, totals['count'], totals['lanes']):
+            annotations = []
+            for match in indexes.classify(barcode, max_mismatches):
+                if match is None:
+                    annotations.append("unknown")
+                elif match[0] is None:
+                    annotations.append("ambiguous")
+                else:
+                    index_seq, mismatches, orientation = match
+                    annotations.append("{}/{}/{}".format(indexes.kits_of(index_seq), orientation, mismatches))
+            rows.append((barcode, count, lanes, " + ".join(annotations), "unknown" not in annotations))
+    table = pd.DataFrame(rows, columns=['barcode', 'count', 'lanes', 'annotation', 'classified'])
+
+    def render(table):
+        if table.empty:
+            return ""
+        text = ["{}\t{}\t{}\t{}\n".format(barcode, count, lanes, annotation)
+                for barcode, count, lanes, annotation, classified in table.itertuples(index=False)]
+        text.append("Undetermined reads matching known indexes: {} of {}\n".format(table['count'][table['classified']].sum(), table['count'].sum()))
+        return "".join(text)
+    (output or ReportOutput()).write([('classify_undet', table)], render)
+
+
+MODES = ('check_undet_index', 'most_undet', 'single_sample_lanes', 'workset_undet', 'fetch_pooled_projects', 'index_collisions', 'classify_undet')
+#modes that need the --indexes file
+INDEXES_FILE_MODES = ('index_collisions', 'classify_undet')
+#modes that search a specific --index
+INDEX_MODES = ('check_undet_index', 'workset_undet')
+
+#per document extractor of each mode, called as extractor(fc_doc, args)
+EXTRACTORS = {
+    'most_undet': lambda fc_doc, args: undetermined_lanes_of(fc_doc),
+    'classify_undet': lambda fc_doc, args: undetermined_lanes_of(fc_doc),
+    'check_undet_index': lambda fc_doc, args: undetermined_index_lanes_of(fc_doc, args.index, args.instrument_type),
+    'workset_undet': lambda fc_doc, args: lanes_with_undet_index_of(fc_doc, args.index, args.instrument_type, args.min_occurences),
+    'single_sample_lanes': lambda fc_doc, args: single_sample_lanes_of(fc_doc, "HiSeqX", args.since or SINGLE_SAMPLE_LANES_SINCE),
+    'fetch_pooled_projects': lambda fc_doc, args: pooled_samples_of(fc_doc, args.instrument_type),
+}
+
+
+def extract_modes(fc_doc, modes, args):
+    """Run the extractor of each mode on a document, returns a dict mode -> extracted data"""
+    return dict((mode, EXTRACTORS[mode](fc_doc, args)) for mode in modes)
+
+
+def run_modes(modes, args, output=None):
+    """Run several analyses over a single pass on x_flowcells
+
+    Each document is handed to the extractor of every requested mode, optionally
+    in a pool of args.processes worker processes, and the extracted data is
+    collected per mode before writing the reports in the requested order to
+    output (stdout by default).
+    With a snapshot, the index searching modes are answered from its inverted
+    index and do not take part in the scan.
+    """
+    output = output or ReportOutput()
+    snapshot = None
+    scanned_modes = [mode for mode in modes if mode in EXTRACTORS]
+    if any(mode in INDEX_MODES for mode in modes):
+        snapshot = flowcell_snapshot("x_flowcells")
+        if snapshot is not None:
+            scanned_modes = [mode for mode in scanned_modes if mode not in INDEX_MODES]
+        elif args.mismatches or args.index_prefix:
+            sys.exit("--mismatches and --index-prefix require --snapshot")
+        if args.index_prefix and not args.index:
+            sys.exit("--index-prefix requires a non-empty --index")
+
+    extracted = dict((mode, []) for mode in scanned_modes)
+    if scanned_modes:
+        instrument_type, since = args.instrument_type, args.since
+        if scanned_modes == ['single_sample_lanes']:
+            #other runs would not be reported, do not download them
+            instrument_type = instrument_type or "HiSeqX"
+            since = since or SINGLE_SAMPLE_LANES_SINCE
+        fc_docs = flowcell_docs("x_flowcells", instrument_type, since, args.until)
+        extract = functools.partial(extract_modes, modes=scanned_modes, args=args)
+        pool = None
+        if args.processes > 1:
+            pool = multiprocessing.Pool(args.processes)
+            #imap keeps the document order, that some reports rely on
+            per_document = pool.imap(extract, fc_docs, chunksize=16)
+        else:
+            per_document = (extract(fc_doc) for fc_doc in fc_docs)
+        try:
+            for document_data in per_document:
+                for mode, data in document_data.items():
+                    if data is not None:
+                        extracted[mode].append(data)
+        except BaseException:
+            #do not leave the workers running on the remaining documents
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    try:
+        for mode in modes:
+            if len(modes) > 1 and output.is_text:
+                print("### {}".format(mode))
+            if mode == 'most_undet':
+                fetch_undermined_stats(extracted[mode], args.group_by, args.top, output)
+            elif mode == 'check_undet_index':
+                if snapshot is not None:
+                    time_line = undetermined_time_line_from_index(snapshot, args.index, args.instrument_type, args.mismatches, args.index_prefix, args.since, args.until)
+                else:
+                    time_line = undetermined_time_line(extracted[mode])
+                find_undetermined_index_over_time(time_line, output)
+            elif mode == 'workset_undet':
+                if snapshot is not None:
+                    undet_lanes = lanes_with_undet_index_from_index(snapshot, args.index, args.instrument_type, args.min_occurences, args.mismatches, args.index_prefix, args.since, args.until)
+                else:
+                    undet_lanes = [lane for lanes in extracted[mode] for lane in lanes]
+                undet_index_to_projects(undet_lanes, args.workset_cache, output, args.workset_cache_ttl)
+            elif mode == 'single_sample_lanes':
+                check_single_sample_lanes(extracted[mode], output)
+            elif mode == 'fetch_pooled_projects':
+                fetch_pooled_projects(extracted[mode], output)
+            elif mode == 'index_collisions':
+                print_index_collisions(Indexes(args.indexes), output=output)
+            elif mode == 'classify_undet':
+                classify_undetermined(extracted[mode], Indexes(args.indexes), args.classify_mismatches, output)
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+
+
+def positive_int(value):
+    """Convert a command line value to an int of at least 1, for use as an argparse type"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive number".format(value))
+    return number
+
+
+def main(args):
+    configuration_file = args.config
+    load_yaml_config(configuration_file)
+    if args.snapshot is not None:
+        CONFIG['snapshot'] = {'path': args.snapshot, 'offline': args.offline}
+    elif args.offline:
+        sys.exit("--offline requires --snapshot")
+
+    modes = []
+    for mode in args.mode:
+        if mode == 'all':
+            #the modes searching a specific index are only included if one is given,
+            #the ones using the indexes file only if one is given
+            modes.extend(mode for mode in MODES if (args.index is not None or mode not in INDEX_MODES)
+                         and (args.indexes is not None or mode not in INDEXES_FILE_MODES))
+        else:
+            modes.append(mode)
+    #each mode is run once, in the order first requested
+    modes = [mode for position, mode in enumerate(modes) if mode not in modes[:position]]
+    if any(mode in INDEX_MODES for mode in modes) and args.index is None:
+        sys.exit("in this mode --index must be specified")
+    if any(mode in INDEXES_FILE_MODES for mode in modes) and args.indexes is None:
+        sys.exit("in this mode --indexes must be specified")
+    run_modes(modes, args, ReportOutput(args.output_format, args.output_dir))
 
 
 
@@ -517,16 +1132,32 @@ if __name__ == '__main__':
         - most_undet: outputs a summary about undetermiend indexes, printing the most 20 most occurring indexes for each instrument type
         - single_sample_lanes: prints stats about HiSeqX lanes run with a single sample in it
         - workset_undet: prints for each workset the FC, lanes and samples where the specified index has been found in undet. For each sample the plate position is printed.
+        - index_collisions: prints all pairs of indexes in the --indexes file, across kits, at Hamming distance 2 or less (also reverse complemented or left shifted)
+        - classify_undet: prints every undetermined index with the closest known index and kit from the --indexes file
         """)
     parser.add_argument('--config', help="configuration file", type=str,  required=True)
     parser.add_argument('--indexes', help="yamls file containing indexes we want to analyse", type=str)
+    parser.add_argument('--workset-cache', help="JSON file caching the sample plate positions of the worksets in workset_undet mode", type=str, default=None)
+    parser.add_argument('--workset-cache-ttl', help="hours after which the worksets of a project in --workset-cache are queried again (default %(default)s)", type=float, default=WORKSET_CACHE_TTL)
     parser.add_argument('--min_occurences', help="minimum number of occurences in undet in workset_undet mode", type=int, default=0)
 
 
-    parser.add_argument('--mode', help="define what action needs to be executed", type=str, required=True, choices=('check_undet_index', 'most_undet', 'single_sample_lanes', 'workset_undet', 'fetch_pooled_projects'))
+    parser.add_argument('--mode', help="define what action needs to be executed, can be repeated to run several analyses over a single scan of x_flowcells ('all' runs all of them)", type=str, required=True, action='append', choices=MODES + ('all',))
+    parser.add_argument('--processes', help="number of worker processes extracting data from the flowcell documents", type=int, default=1)
 
 
     parser.add_argument('--index', help="a specifc index (e.g., CTTGTAAT) to be searched across lanes and FCs", type=str)
-    parser.add_argument('--instrument-type', help="type of instrument", type=str, default=None, choices=('HiSeqX', 'MiSeq', 'HiSeq2500'))
+    parser.add_argument('--group-by', help="in most_undet mode, also report the most occurring undetermined indexes grouped by these columns", nargs='+', default=None, choices=('instrument_type', 'instrument', 'year', 'month', 'lane'))
+    parser.add_argument('--top', help="number of undetermined indexes reported per group in most_undet mode", type=positive_int, default=10)
+    parser.add_argument('--mismatches', help="with --snapshot, also match undetermined indexes at this Hamming distance from --index (0 or 1)", type=int, default=0, choices=(0, 1))
+    parser.add_argument('--classify-mismatches', help="in classify_undet mode, maximum number of mismatches between an undetermined index and a known index", type=int, default=1, choices=(0, 1, 2))
+    parser.add_argument('--index-prefix', help="with --snapshot, match all undetermined indexes starting with --index", action='store_true')
+    parser.add_argument('--instrument-type', help="only consider runs on this type of instrument", type=str, default=None, choices=('HiSeqX', 'MiSeq', 'HiSeq2500'))
+    parser.add_argument('--since', help="only consider runs from this date on (YYYY-MM-DD)", type=parse_run_date, default=None)
+    parser.add_argument('--until', help="only consider runs before this date (YYYY-MM-DD)", type=parse_run_date, default=None)
+    parser.add_argument('--output-format', help="write the reports as text on stdout (default) or as one file per report table in this format", type=str, default='text', choices=OUTPUT_FORMATS)
+    parser.add_argument('--output-dir', help="directory where the report files are written, with --output-format", type=str, default='.')
+    parser.add_argument('--snapshot', help="local snapshot file of x_flowcells, only documents changed since the last run are downloaded", type=str, default=None)
+    parser.add_argument('--offline', help="run against the local snapshot without contacting statusdb (requires --snapshot)", action='store_true')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,514 @@
+"""Local on-disk snapshot of StatusDB flowcell databases.
+
+Finished flowcell documents are practically immutable, yet the analytics scripts
+(compute_undet_index_stats.py, compute_production_stats.py, repooler.py) used to
+download every one of them on each invocation. A FlowcellSnapshot keeps a copy of
+the documents in a single SQLite file, keyed by database name and document id,
+together with the last _changes sequence seen for each database. Refreshing the
+snapshot only transfers the documents changed since the previous run, and with
+offline=True reports can be rerun against the snapshot without contacting StatusDB.
+
+The snapshot also maintains an inverted index of the undetermined barcodes of
+every flowcell (barcode -> flowcell, lane, count, run date), kept up to date as
+documents are stored or removed, so a single barcode can be looked up without
+scanning the flowcells.
+
+Reports restricted to an instrument type or a range of run dates do not need the
+whole database: the flowcell_views.json design document, installed in each
+flowcell database, provides a view keyed on [instrument_type, run_date] and only
+the flowcells in the requested key ranges are transferred. Snapshots index the
+same key, so offline runs are filtered the same way.
+
+Reports that only need a small part of each document can also keep it in the
+snapshot: the contributions table stores, per report, the result of a function
+of each document together with the revision it was computed from. Only the
+documents added or changed since the previous run are decompressed and computed
+again, the others are served from the stored results.
+"""
+import datetime
+import json
+import re
+import sqlite3
+import zlib
+
+#number of documents fetched per _all_docs/_changes request
+BATCH_SIZE = 500
+#seconds a connection waits for another one writing to the same snapshot file,
+#e.g. when several databases are refreshed concurrently
+LOCK_TIMEOUT = 300
+
+#view keyed on [instrument_type, run_date] defined in flowcell_views.json
+RUN_VIEW = 'flowcell_stats/by_instrument_date'
+#view keyed on the project ids (P1234) of the samples of each flowcell, with the run id as value
+PROJECT_VIEW = 'flowcell_stats/by_project'
+#all the instrument types instrument_type_of can return, in view key order
+INSTRUMENT_TYPES = ('HiSeq2500', 'HiSeqX', 'MiSeq')
+
+
+def instrument_type_of(fc_id):
+    """Return the instrument type of a run from its id, as the by_instrument_date view does"""
+    if "ST-" in fc_id:
+        return "HiSeqX"
+    elif "000000000-" in fc_id:
+        return "MiSeq"
+    return "HiSeq2500"
+
+
+def run_key(doc):
+    """Return the (instrument_type, run_date) key of a flowcell document, None if it has no run id or date"""
+    run_info = doc.get('RunInfo', {})
+    if not run_info.get('Id') or not run_info.get('Date'):
+        return None
+    return instrument_type_of(run_info['Id']), run_info['Date']
+
+
+def parse_run_date(value):
+    """Convert a YYYY-MM-DD date to the YYMMDD format of RunInfo.Date, for use as an argparse type"""
+    return datetime.datetime.strptime(value, '%Y-%m-%d').strftime('%y%m%d')
+
+
+def is_filtered(instrument_types=None, since=None, until=None):
+    """Return True if any run filter is set"""
+    return instrument_types is not None or since is not None or until is not None
+
+
+def iter_docs(couch_db, batch_size=BATCH_SIZE):
+    """Stream all documents of a database in a single sequential pass
+
+    Documents are fetched in pages of batch_size through _all_docs?include_docs=true
+    and yielded one at a time, ordered by document id. Design documents are skipped.
+
+    :param couchdb.Database couch_db: the database to scan
+    :param int batch_size: number of documents fetched per request
+    :returns: a generator over the documents (dicts)
+    """
+    for row in couch_db.iterview('_all_docs', batch_size, include_docs=True):
+        if row.id.startswith('_design/'):
+            continue
+        yield row.doc
+
+
+def fetch_docs(couch_db, doc_ids, batch_size=BATCH_SIZE):
+    """Fetch documents by id with one _all_docs POST per batch_size ids
+
+    :param couchdb.Database couch_db: the database holding the documents
+    :param list doc_ids: ids of the documents
+    :param int batch_size: number of documents fetched per request
+    :returns: dict document id -> document, ids that do not exist are left out
+    """
+    doc_ids = list(doc_ids)
+    docs = {}
+    for start in range(0, len(doc_ids), batch_size):
+        for row in couch_db.view('_all_docs', keys=doc_ids[start:start + batch_size], include_docs=True):
+            if row.doc is not None:
+                docs[row.id] = row.doc
+    return docs
+
+
+def iter_run_docs(couch_db, instrument_types=None, since=None, until=None, batch_size=BATCH_SIZE):
+    """Stream the documents of the runs of the given instrument types within a range of run dates
+
+    The filter is evaluated by CouchDB through the by_instrument_date view (see
+    flowcell_views.json), one key range per instrument type, so only the matching
+    documents are transferred.
+
+    :param couchdb.Database couch_db: the database to scan
+    :param list instrument_types: instrument types to keep, None for all of them
+    :param str since: first run date (YYMMDD) to keep, None for no lower bound
+    :param str until: run date (YYMMDD) before which runs are kept, None for no upper bound
+    :param int batch_size: number of documents fetched per request
+    :returns: a generator over the documents (dicts), ordered by instrument type, run date and id
+    """
+    for instrument_type in sorted(instrument_types or INSTRUMENT_TYPES):
+        #{} sorts after all strings in CouchDB collation
+        startkey = [instrument_type, since if since is not None else ""]
+        endkey = [instrument_type, until if until is not None else {}]
+        for row in couch_db.iterview(RUN_VIEW, batch_size, include_docs=True,
+                                     startkey=startkey, endkey=endkey, inclusive_end=False):
+            yield row.doc
+
+
+class FlowcellSnapshot(object):
+    """SQLite backed copy of one or more flowcell databases
+
+    Documents are stored zlib compressed, one row per (database, document id),
+    along with their revision. The sync table records, per database, the last
+    _changes sequence that has been applied.
+
+    The undetermined table holds one row per key under which an undetermined
+    barcode can be found: the barcode itself and, for dual indexes such as
+    ACGTACGT+TTGGCCAA, each of its two parts. The undetermined_lanes table lists
+    the lanes of each flowcell that have undetermined statistics at all.
+    The runs table holds the run_key of each document. The contributions table
+    holds, per report, the JSON encoded result computed from each document and
+    the revision of the document it was computed from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS docs ("
+                          "db TEXT NOT NULL, id TEXT NOT NULL, rev TEXT, doc BLOB, "
+                          "PRIMARY KEY (db, id))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sync ("
+                          "db TEXT PRIMARY KEY, last_seq TEXT)")
+        tables = set(row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS undetermined ("
+                          "db TEXT NOT NULL, key TEXT NOT NULL, barcode TEXT NOT NULL, id TEXT NOT NULL, "
+                          "fc_id TEXT, lane TEXT, count INTEGER, run_date TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS undetermined_key ON undetermined (db, key)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS undetermined_id ON undetermined (db, id)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS undetermined_lanes ("
+                          "db TEXT NOT NULL, id TEXT NOT NULL, fc_id TEXT, lane TEXT, run_date TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS undetermined_lanes_id ON undetermined_lanes (db, id)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS runs ("
+                          "db TEXT NOT NULL, id TEXT NOT NULL, instrument_type TEXT, run_date TEXT, "
+                          "PRIMARY KEY (db, id))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS runs_key ON runs (db, instrument_type, run_date)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS contributions ("
+                          "db TEXT NOT NULL, id TEXT NOT NULL, report TEXT NOT NULL, rev TEXT, data TEXT, "
+                          "PRIMARY KEY (db, id, report))")
+        #snapshots created before an index existed are indexed once from the stored documents
+        if 'undetermined' not in tables or 'runs' not in tables:
+            for db_name, blob in self.conn.execute("SELECT db, doc FROM docs").fetchall():
+                doc = self._load(blob)
+                if 'undetermined' not in tables:
+                    self._index_undetermined(db_name, doc)
+                if 'runs' not in tables:
+                    self._index_run(db_name, doc)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def last_seq(self, db_name):
+        """Return the last _changes sequence applied for db_name, None if never synced"""
+        row = self.conn.execute("SELECT last_seq FROM sync WHERE db = ?", (db_name,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def refresh(self, couch_db, batch_size=BATCH_SIZE):
+        """Apply all changes made to couch_db since the last refresh
+
+        The first refresh downloads the whole database. Deleted documents are
+        removed from the snapshot, design documents are ignored.
+
+        :param couchdb.Database couch_db: the database to mirror
+        :param int batch_size: number of changes fetched per request
+        :returns: the number of documents added, updated or removed
+        """
+        db_name = couch_db.name
+        since = self.last_seq(db_name)
+        if since is None:
+            since = 0
+        updated = 0
+        while True:
+            changes = couch_db.changes(since=since, include_docs=True, limit=batch_size)
+            results = changes['results']
+            for change in results:
+                if change['id'].startswith('_design/'):
+                    continue
+                if change.get('deleted'):
+                    self.conn.execute("DELETE FROM docs WHERE db = ? AND id = ?", (db_name, change['id']))
+                    self.conn.execute("DELETE FROM runs WHERE db = ? AND id = ?", (db_name, change['id']))
+                    self.conn.execute("DELETE FROM contributions WHERE db = ? AND id = ?", (db_name, change['id']))
+                    self._unindex_undetermined(db_name, change['id'])
+                else:
+                    self._store(db_name, change['doc'])
+                updated += 1
+            since = changes['last_seq']
+            #commit each page together with its sequence so an interrupted refresh can resume
+            self.conn.execute("INSERT OR REPLACE INTO sync (db, last_seq) VALUES (?, ?)",
+                              (db_name, json.dumps(since)))
+            self.conn.commit()
+            if len(results) < batch_size:
+                break
+        return updated
+
+    def _store(self, db_name, doc):
+        blob = zlib.compress(json.dumps(doc).encode('utf-8'))
+        self.conn.execute("INSERT OR REPLACE INTO docs (db, id, rev, doc) VALUES (?, ?, ?, ?)",
+                          (db_name, doc['_id'], doc.get('_rev'), sqlite3.Binary(blob)))
+        self._index_run(db_name, doc)
+        self._index_undetermined(db_name, doc)
+
+    def _index_run(self, db_name, doc):
+        key = run_key(doc)
+        if key is None:
+            self.conn.execute("DELETE FROM runs WHERE db = ? AND id = ?", (db_name, doc['_id']))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO runs (db, id, instrument_type, run_date) VALUES (?, ?, ?, ?)",
+                              (db_name, doc['_id'], key[0], key[1]))
+
+    def _unindex_undetermined(self, db_name, doc_id):
+        self.conn.execute("DELETE FROM undetermined WHERE db = ? AND id = ?", (db_name, doc_id))
+        self.conn.execute("DELETE FROM undetermined_lanes WHERE db = ? AND id = ?", (db_name, doc_id))
+
+    def _index_undetermined(self, db_name, doc):
+        self._unindex_undetermined(db_name, doc['_id'])
+        if 'Undetermined' not in doc or 'RunInfo' not in doc:
+            return
+        fc_id = doc['RunInfo'].get('Id')
+        run_date = doc['RunInfo'].get('Date')
+        rows = []
+        lanes = []
+        for lane, barcodes in doc['Undetermined'].items():
+            lanes.append((db_name, doc['_id'], fc_id, lane, run_date))
+            for barcode, count in barcodes.items():
+                if barcode == 'TOTAL':
+                    continue
+                for key in barcode_keys(barcode):
+                    rows.append((db_name, key, barcode, doc['_id'], fc_id, lane, count, run_date))
+        self.conn.executemany("INSERT INTO undetermined_lanes (db, id, fc_id, lane, run_date) "
+                              "VALUES (?, ?, ?, ?, ?)", lanes)
+        self.conn.executemany("INSERT INTO undetermined (db, key, barcode, id, fc_id, lane, count, run_date) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    @staticmethod
+    def _load(blob):
+        return json.loads(zlib.decompress(bytes(blob)).decode('utf-8'))
+
+    def docs(self, db_name):
+        """Yield all stored documents of db_name ordered by document id"""
+        cursor = self.conn.execute("SELECT doc FROM docs WHERE db = ? ORDER BY id", (db_name,))
+        for row in cursor:
+            yield self._load(row[0])
+
+    @staticmethod
+    def _run_conditions(db_name, instrument_types=None, since=None, until=None):
+        conditions = ["r.db = ?"]
+        parameters = [db_name]
+        if instrument_types is not None:
+            conditions.append("r.instrument_type IN ({})".format(",".join("?" * len(instrument_types))))
+            parameters.extend(instrument_types)
+        if since is not None:
+            conditions.append("r.run_date >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("r.run_date < ?")
+            parameters.append(until)
+        return " AND ".join(conditions), parameters
+
+    def run_docs(self, db_name, instrument_types=None, since=None, until=None):
+        """Yield the stored documents of db_name selected as iter_run_docs does, in the same order"""
+        conditions, parameters = self._run_conditions(db_name, instrument_types, since, until)
+        cursor = self.conn.execute("SELECT d.doc FROM runs r JOIN docs d ON d.db = r.db AND d.id = r.id "
+                                   "WHERE {} ORDER BY r.instrument_type, r.run_date, r.id".format(conditions),
+                                   parameters)
+        for row in cursor:
+            yield self._load(row[0])
+
+    def contributions(self, db_name, report, compute, instrument_types=None, since=None, until=None):
+        """Yield compute(doc) for the documents docs or run_docs would yield, in the same order
+
+        The results are stored under report together with the revision of the
+        document, so compute only runs on the documents added or changed since
+        it last ran for report; the stored results of the other documents are
+        returned without loading them. compute must depend on the document only
+        and return JSON serializable data, and report must be renamed whenever
+        compute changes.
+
+        :param str db_name: name of the database, e.g. x_flowcells
+        :param str report: name under which the results are stored
+        :param compute: function of a document
+        :param list instrument_types: instrument types to keep, None for all of them
+        :param str since: first run date (YYMMDD) to keep, None for no lower bound
+        :param str until: run date (YYMMDD) before which runs are kept, None for no upper bound
+        """
+        #the document is only read when there is no result for its current revision
+        columns = "d.id, d.rev, c.data, CASE WHEN c.id IS NULL THEN d.doc END"
+        join = "LEFT JOIN contributions c ON c.db = d.db AND c.id = d.id AND c.report = ? AND c.rev IS d.rev"
+        if is_filtered(instrument_types, since, until):
+            conditions, parameters = self._run_conditions(db_name, instrument_types, since, until)
+            cursor = self.conn.execute("SELECT {} FROM runs r JOIN docs d ON d.db = r.db AND d.id = r.id {} "
+                                       "WHERE {} ORDER BY r.instrument_type, r.run_date, r.id".format(columns, join, conditions),
+                                       [report] + parameters)
+        else:
+            cursor = self.conn.execute("SELECT {} FROM docs d {} WHERE d.db = ? ORDER BY d.id".format(columns, join),
+                                       (report, db_name))
+        computed = []
+        try:
+            for doc_id, rev, data, blob in cursor:
+                if blob is None:
+                    yield json.loads(data)
+                else:
+                    contribution = compute(self._load(blob))
+                    computed.append((db_name, doc_id, report, rev, json.dumps(contribution)))
+                    yield contribution
+        finally:
+            #stored once the cursor is done with, even if the caller stops early
+            self.conn.executemany("INSERT OR REPLACE INTO contributions (db, id, report, rev, data) "
+                                  "VALUES (?, ?, ?, ?, ?)", computed)
+            self.conn.commit()
+
+    def get(self, db_name, doc_id):
+        """Return the stored document doc_id of db_name, None if not in the snapshot"""
+        row = self.conn.execute("SELECT doc FROM docs WHERE db = ? AND id = ?", (db_name, doc_id)).fetchone()
+        if row is None:
+            return None
+        return self._load(row[0])
+
+    def lookup_undetermined(self, db_name, index, mismatches=0, prefix=False):
+        """Find the flowcell lanes where index was seen among the undetermined barcodes
+
+        index matches a barcode if it is equal to the barcode or to one of the two
+        parts of a dual index barcode.
+
+        :param str db_name: name of the database, e.g. x_flowcells
+        :param str index: the index sequence to look for, e.g. CTTGTAAT
+        :param int mismatches: 0 for exact matches, 1 to also accept keys at Hamming distance 1
+        :param bool prefix: match all keys starting with index (cannot be combined with mismatches)
+        :returns: a list of (barcode, doc_id, fc_id, lane, count, run_date) tuples,
+                  one per matching barcode and lane, ordered by document id and lane
+        :raises ValueError: for unsupported mismatches, combining prefix and mismatches or an empty prefix
+        """
+        columns = "DISTINCT barcode, id, fc_id, lane, count, run_date"
+        if prefix:
+            if mismatches:
+                raise ValueError("prefix lookups only support exact matches")
+            if not index:
+                raise ValueError("prefix lookups need a non-empty index")
+            #all keys sorting between index and index with its last character incremented
+            upper = index[:-1] + chr(ord(index[-1]) + 1)
+            cursor = self.conn.execute("SELECT {} FROM undetermined WHERE db = ? AND key >= ? AND key < ? "
+                                       "ORDER BY id, lane".format(columns), (db_name, index, upper))
+            return cursor.fetchall()
+        if mismatches == 0:
+            keys = [index]
+        elif mismatches == 1:
+            keys = hamming_neighbours(index)
+        else:
+            raise ValueError("only 0 or 1 mismatches are supported, got {}".format(mismatches))
+        placeholders = ",".join("?" * len(keys))
+        cursor = self.conn.execute("SELECT {} FROM undetermined WHERE db = ? AND key IN ({}) "
+                                   "ORDER BY id, lane".format(columns, placeholders), [db_name] + keys)
+        return cursor.fetchall()
+
+    def undetermined_lanes(self, db_name):
+        """Return (doc_id, fc_id, lane, run_date) for every lane with undetermined statistics"""
+        cursor = self.conn.execute("SELECT id, fc_id, lane, run_date FROM undetermined_lanes "
+                                   "WHERE db = ? ORDER BY id, lane", (db_name,))
+        return cursor.fetchall()
+
+    def __contains__(self, db_name):
+        return self.last_seq(db_name) is not None
+
+
+def barcode_keys(barcode):
+    """Return the keys an undetermined barcode is found under: the barcode and each part of a dual index"""
+    keys = set([barcode])
+    keys.update(re.split('[+-]', barcode))
+    return keys
+
+
+def undetermined_count(barcodes, index):
+    """Sum the counts of the undetermined barcodes of a lane matching index, as lookup_undetermined does
+
+    :param dict barcodes: the Undetermined statistics of a lane, barcode -> count
+    :param str index: the index sequence to look for
+    """
+    return sum(count for barcode, count in barcodes.items()
+               if barcode != 'TOTAL' and index in barcode_keys(barcode))
+
+
+def hamming_neighbours(index):
+    """Return index together with all sequences at Hamming distance 1 from it"""
+    neighbours = [index]
+    for position, base in enumerate(index):
+        if base not in 'ACGTN':
+            #keep separators of dual indexes in place
+            continue
+        for other in 'ACGTN':
+            if other != base:
+                neighbours.append(index[:position] + other + index[position + 1:])
+    return neighbours
+
+
+def open_snapshot(couch, db_name, snapshot_path, offline=False, batch_size=BATCH_SIZE):
+    """Open the snapshot at snapshot_path, refreshing db_name first unless offline
+
+    :param couchdb.Server couch: the StatusDB server, can be None when offline
+    :param str db_name: name of the database, e.g. x_flowcells
+    :param str snapshot_path: path to the snapshot file
+    :param bool offline: do not refresh the snapshot, only use what is stored
+    :param int batch_size: number of changes fetched per request
+    :returns: an open FlowcellSnapshot, to be closed by the caller
+    :raises ValueError: if offline and the snapshot has never been synced for db_name
+    """
+    snapshot = FlowcellSnapshot(snapshot_path)
+    if offline:
+        if db_name not in snapshot:
+            snapshot.close()
+            raise ValueError("snapshot {} holds no copy of {}, run once without offline mode".format(snapshot_path, db_name))
+    else:
+        snapshot.refresh(couch[db_name], batch_size)
+    return snapshot
+
+
+def stream_docs(couch, db_name, snapshot_path=None, offline=False, batch_size=BATCH_SIZE,
+                instrument_types=None, since=None, until=None):
+    """Yield the documents of db_name, through the snapshot if one is given
+
+    If instrument_types, since or until are given only the matching runs are
+    yielded, see iter_run_docs.
+
+    :param couchdb.Server couch: the StatusDB server, can be None when offline
+    :param str db_name: name of the database, e.g. x_flowcells
+    :param str snapshot_path: path to the snapshot file, None streams from StatusDB
+    :param bool offline: do not refresh the snapshot, only read what is stored
+    :param int batch_size: number of documents fetched per request
+    :param list instrument_types: instrument types to keep, None for all of them
+    :param str since: first run date (YYMMDD) to keep, None for no lower bound
+    :param str until: run date (YYMMDD) before which runs are kept, None for no upper bound
+    :returns: a generator over the documents (dicts) ordered by document id, or by
+              instrument type, run date and id when filtered
+    :raises ValueError: if offline is requested without a snapshot, or the snapshot
+                        has never been synced for db_name
+    """
+    filtered = is_filtered(instrument_types, since, until)
+    if snapshot_path is None:
+        if offline:
+            raise ValueError("offline mode requires a snapshot file")
+        if filtered:
+            docs = iter_run_docs(couch[db_name], instrument_types, since, until, batch_size)
+        else:
+            docs = iter_docs(couch[db_name], batch_size)
+        for doc in docs:
+            yield doc
+        return
+    snapshot = open_snapshot(couch, db_name, snapshot_path, offline, batch_size)
+    try:
+        if filtered:
+            docs = snapshot.run_docs(db_name, instrument_types, since, until)
+        else:
+            docs = snapshot.docs(db_name)
+        for doc in docs:
+            yield doc
+    finally:
+        snapshot.close()
+
+
+def stream_contributions(couch, db_name, report, compute, snapshot_path=None, offline=False, batch_size=BATCH_SIZE,
+                         instrument_types=None, since=None, until=None):
+    """Yield compute(doc) for the documents stream_docs would yield, in the same order
+
+    With a snapshot the results are stored per document revision (see
+    FlowcellSnapshot.contributions), so only the documents added or changed since
+    the previous run are computed. Without one every document is streamed and computed.
+
+    :param str report: name under which the results are stored in the snapshot
+    :param compute: function of a document returning JSON serializable data
+    :returns: a generator over the results of compute
+    :raises ValueError: as stream_docs does
+    """
+    if snapshot_path is None:
+        for doc in stream_docs(couch, db_name, None, offline, batch_size, instrument_types, since, until):
+            yield compute(doc)
+        return
+    snapshot = open_snapshot(couch, db_name, snapshot_path, offline, batch_size)
+    try:
+        for contribution in snapshot.contributions(db_name, report, compute, instrument_types, since, until):
+            yield contribution
+    finally:
+        snapshot.close()
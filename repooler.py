@@ -2,12 +2,12 @@
 
 import re
 import math
-import unicodedata
 import csv
 import copy
 import sys
 import os
 import yaml
+import json
 
 import couchdb
 import numpy
@@ -19,7 +19,9 @@ from datetime import datetime
 
 from genologics.config import BASEURI, USERNAME, PASSWORD
 from genologics.lims import Lims
-from genologics.entities import Process
+from genologics.entities import Process, Project
+
+from flowcell_snapshot import PROJECT_VIEW, fetch_docs, open_snapshot
 
 def credentials():
     try:
@@ -54,34 +56,36 @@ def connection():
     return couch
 
 
-def proj_struct(couch, project, target_clusters):
-    """"Fetches the structure of a project"""
+def proj_struct(couch, projects, target_clusters, snapshot_path=None):
+    """"Fetches the structure of the projects
+    The flowcells of all projects are listed by a single query of the by_project view
+    (see flowcell_views.json) and fetched with a single _all_docs request.
+    If snapshot_path is given, flowcell documents are read from the local snapshot,
+    after downloading only the documents changed since its last refresh"""
     db = couch['x_flowcells']
-    view = db.view('names/project_ids_list')
-    fc_track = defaultdict(set)
-
-    #Adds flowcells to ALL projects. Due to interactions its easier to just get FCs for ALL projects
-    for rec in view.rows:
-        fc = ''.join(rec.key)
-        fc = unicodedata.normalize('NFKD', fc).encode('ascii','ignore')
-        id = ''.join(rec.id)
-        id = unicodedata.normalize('NFKD', id).encode('ascii','ignore')
-        for projs in rec.value:
-            projs = ''.join(projs)
-            projs = unicodedata.normalize('NFKD', projs).encode('ascii','ignore')
-            if fc_track[projs] == set([]):
-                fc_track[projs] = dict()
-            fc_track[projs][fc] = id
+    fc_ids = dict()
+    found = set()
+    for rec in db.view(PROJECT_VIEW, keys=list(projects)):
+        fc_ids[rec.value or rec.id] = rec.id
+        found.add(rec.key)
+    missing = [project for project in projects if project not in found]
+    if missing:
+        raise Exception('Error: Project {} not logged in x_flowcells database!'.format(', '.join(missing)))
+    if snapshot_path is not None:
+        snapshot = open_snapshot(couch, 'x_flowcells', snapshot_path)
+        fc_docs = dict((id, snapshot.get('x_flowcells', id)) for id in fc_ids.values())
+        snapshot.close()
+    else:
+        fc_docs = fetch_docs(db, fc_ids.values())
 
     #Adds lanes and samples to flowcells, includes samples from other projects if they share lane
-    if fc_track[project] == set([]):
-        raise Exception('Error: Project not logged in x_flowcells database!')
-    for fc, id in fc_track[project].items():
-        try:
-            entry = db[id]['illumina']
-        except KeyError:
+    fc_track = defaultdict(dict)
+    for fc, id in fc_ids.items():
+        fc_doc = fc_docs.get(id)
+        if fc_doc is None or 'illumina' not in fc_doc:
             print("Error: Illumina table for db entry" , id, "doesn't exist!")
-        entry = db[id]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
+            continue
+        entry = fc_doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
         for index in range(0, len(entry)):
             lane = entry[index]['Lane']
             sample = entry[index]['Sample']
@@ -92,199 +96,254 @@ def proj_struct(couch, project, target_clusters):
             clusters = int(re.sub(r",", "", clusters))
 
 
-            if not isinstance(fc_track[project][fc], dict):
-                fc_track[project][fc] = dict()
-            if not lane in fc_track[project][fc]:
-                fc_track[project][fc][lane] = dict()
-            #Only counts samples for the given project, other samples are "auto-filled"
-            if project in sample or sample in "Undetermined":
-                fc_track[project][fc][lane][sample] = clusters
+            if not lane in fc_track[fc]:
+                fc_track[fc][lane] = dict()
+            #Only counts samples for the given projects, other samples are "auto-filled"
+            if any(project in sample for project in projects) or sample in "Undetermined":
+                fc_track[fc][lane][sample] = clusters
             else:
-                fc_track[project][fc][lane][sample] = target_clusters
+                fc_track[fc][lane][sample] = target_clusters
     #Removes any lanes that don't have any part project samples
-    for fc, lanes in fc_track[project].items():
-        for lane,sample in lanes.items():
-            if not any(project in s for s in list(sample.keys())):
-                   del fc_track[project][fc][lane]
-    return fc_track[project]
-
+    for fc, lanes in fc_track.items():
+        for lane,sample in list(lanes.items()):
+            if not any(project in s for s in list(sample.keys()) for project in projects):
+                   del fc_track[fc][lane]
+    return fc_track
+
+
+class LaneStructures(object):
+    """Unique lane structures of a project, as matrices over a global sample index
+    samples: names of all samples, sorted in reverse so that Undetermined comes first in a structure
+    clusters: structure x sample matrix of the average clusters per lane of the structure
+    members: structure x sample boolean matrix, the samples of each structure
+    remaining: clusters each sample still needs, by sample index
+    Structures are numbered in the order they are first seen; columns[s] holds the sample
+    indexes of structure s, in the order of its samples."""
+
+    def __init__(self, samples, clusters, members, remaining):
+        self.samples = samples
+        self.clusters = clusters
+        self.members = members
+        self.remaining = remaining
+        self.columns = [numpy.flatnonzero(row) for row in members]
+        #Samples that can't be in two chosen structures
+        self.unique = members.copy()
+        if 'Undetermined' in samples:
+            self.unique[:, samples.index('Undetermined')] = False
+
+    def __len__(self):
+        return len(self.columns)
+
+    def sample_names(self, structure):
+        return [self.samples[index] for index in self.columns[structure]]
 
 def parse_indata(struct, target_clusters):
-    """Takes in data and finds unique lane structure, clusters per sample and lane division"""
-    clusters_rem = dict() #Total remaining clusters
-    lane_maps = dict() #All possible structs. Sample-aggregate is a string, values are average expression
-    sample_struct = dict() #All possible structs. Values are a list of samples per lane
-    copies = dict() #Keeps track of duplicates of each structure
+    """Takes in data and finds unique lane structure, clusters per sample and lane division
+    Returns the LaneStructures of the lanes"""
+    samples = sorted(set(sample for lanes in struct.values() for lane in lanes.values() for sample in lane), reverse=True)
+    index = dict((sample, position) for position, sample in enumerate(samples))
+    structures = dict() #Structure id of the sample indexes of a lane
+    totals = [] #Summed clusters of each structure
+    copies = [] #Keeps track of duplicates of each structure
+    sequenced = numpy.zeros(len(samples), dtype=numpy.int64)
 
     for fc, lanes in struct.items():
-        for lane, samples in lanes.items():
-            #Concats the structure into a set of unique structures
-            mapp = sorted(samples, reverse=True)
-            map_names = str(mapp)
-            map_values = [value for (key, value) in sorted(samples.items(), reverse=True)]
-
-            if not map_names in lane_maps:
-                sample_struct[map_names] = mapp
-                lane_maps[map_names] = numpy.array(map_values)
-                copies[map_names] = 1
-            else:
-                lane_maps[map_names] = lane_maps[map_names] + numpy.array(map_values)
-                copies[map_names] = copies[map_names]+1
-
-            #Calculate remaining clusters for each sample
-            for sample, value in samples.items():
-                if not sample in clusters_rem:
-                    clusters_rem[sample] = target_clusters
-                clusters_rem[sample] -= value
-
-                if clusters_rem[sample] < 0:
-                    clusters_rem[sample] = 0
-
+        for lane, lane_samples in lanes.items():
+            columns = tuple(sorted(index[sample] for sample in lane_samples))
+            values = numpy.array([lane_samples[samples[column]] for column in columns], dtype=numpy.int64)
+            if not columns in structures:
+                structures[columns] = len(totals)
+                totals.append(numpy.zeros(len(samples), dtype=numpy.int64))
+                copies.append(0)
+            totals[structures[columns]][list(columns)] += values
+            copies[structures[columns]] += 1
+            sequenced[list(columns)] += values
+
+    members = numpy.zeros((len(totals), len(samples)), dtype=bool)
+    for columns, structure in structures.items():
+        members[structure, list(columns)] = True
     #Calculate average output of sample for each structure type
-    for names, values in lane_maps.items():
-        values = numpy.array(values)
-        #Explicit typecast
-        values = values.astype(float)
-        #Calculate average
-        lane_maps[names] = values/copies[names]
-        #Manually overwrites undetermined to exclude them
-        #lane_maps[names][0] = 0
+    clusters = numpy.array(totals, dtype=float).reshape(len(totals), len(samples))/numpy.array(copies, dtype=float).reshape(-1, 1)
+    #Total remaining clusters
+    remaining = numpy.maximum(target_clusters - sequenced, 0)
+    return LaneStructures(samples, clusters, members, remaining)
 
-    return [lane_maps, clusters_rem, sample_struct]
 
-
-def simple_unique_set(sample_struct, clusters_rem, target_clusters):
+def simple_unique_set(lanes, target_clusters):
     """Creates a set where every sample uniquely appears once and only once
-    Prioritizes lanes with most unsequenced samples first"""
+    Prioritizes lanes with most unsequenced samples first
+    Returns the chosen structure ids"""
 
-    #Inline function to calculate number of unfinished samples per lane
-    def f(x):
-        count = 0
-        for sample in x:
-            if clusters_rem[sample] < target_clusters:
-                count = count + 1
-        #print count
-        return count
+    #Number of unfinished samples per lane
+    unfinished = lanes.members[:, lanes.remaining < target_clusters].sum(axis=1)
 
     #Best = Most samples in need of sequencing = End of lists
-    top_lanes = OrderedDict(sorted(sample_struct.items(), key=lambda t: f(t[1])))
-    confirmed_best = dict()
-    while not list(top_lanes.keys()) == []:
+    top_lanes = sorted(range(len(lanes)), key=lambda structure: unfinished[structure])
+    confirmed_best = list()
+    covered = numpy.zeros(len(lanes.samples), dtype=bool)
+    while top_lanes:
         #pop the best candidate
-        prime = top_lanes.popitem()
+        prime = top_lanes.pop()
         #Check that including the prime doesn't induce duplicates
-        sample_ok = True
-        for p_sample in prime[1]:
-            for keys, values in confirmed_best.items():
-                if p_sample in values and p_sample != "Undetermined":
-                    #print("DEBUG: {} is already present in final set, auto-discarding {}".format(p_sample, keys))
-                    sample_ok = False
-                    break
+        if (lanes.unique[prime] & covered).any():
+            continue
         #Part 2
-        if sample_ok:
-            #Check that including prime doesn't block a remaining lane with uniques.
-            #Tally up blocked lanes & samples from them
-            blocked_lanes = list()
-            blocked_samples = list()
-            for p_sample in prime[1]:
-                for t_key, t_sample in top_lanes.items():
-                    if p_sample in t_sample and p_sample != "Undetermined":
-                        blocked_lanes.append(t_key)
-                        blocked_samples.extend(top_lanes[t_key])
-            #Break if all instances of a sample end up in blocked lanes
-            #Must handle case where no blocked samples happen
-            sample_killed = False
-            for b_sample in set(blocked_samples):
-                sample_killed = True
-                for r_key, r_values in top_lanes.items():
-                    if (b_sample in r_values or b_sample in prime[1]) and r_key not in blocked_lanes:
-                        sample_killed = False
-                        break
-            if not sample_killed:
-                confirmed_best[prime[0]] = prime[1]
-                #DEBUG: Remove blocked lanes from top_lanes
-                for b_lane in set(blocked_lanes):
-                    #print ("DEBUG: {} was blocked by another sample's inclusion!".format(b_lane))
-                    del top_lanes[b_lane]
-
-    validate_samples_unique(confirmed_best)
-    validate_all_samples_present(confirmed_best, sample_struct, clusters_rem)
+        #Check that including prime doesn't block a remaining lane with uniques.
+        blocked = lanes.unique[top_lanes].dot(lanes.unique[prime]) if top_lanes else numpy.zeros(0, dtype=bool)
+        blocked_lanes = [structure for structure, block in zip(top_lanes, blocked) if block]
+        free_lanes = [structure for structure, block in zip(top_lanes, blocked) if not block]
+        #Fail if all instances of a sample end up in blocked lanes
+        blocked_samples = lanes.members[blocked_lanes].any(axis=0)
+        free_samples = lanes.members[free_lanes].any(axis=0)
+        #Samples of prime are kept as long as another lane is left
+        if free_lanes:
+            free_samples |= lanes.members[prime]
+        if not (blocked_samples & ~free_samples & (lanes.remaining > 0)).any():
+            confirmed_best.append(prime)
+            covered |= lanes.unique[prime]
+            top_lanes = free_lanes
+
+    validate_samples_unique(lanes, confirmed_best)
+    validate_all_samples_present(lanes, confirmed_best)
 
     return confirmed_best
 
-def validate_samples_unique(lane_maps):
+#Seconds optimal_unique_set spends searching for the structures needing the fewest lanes
+OPTIMIZER_TIME_BUDGET = 10
+
+class SearchTimeout(Exception):
+    pass
+
+def optimal_unique_set(lanes, target_clusters, clusters_per_lane, time_budget=OPTIMIZER_TIME_BUDGET):
+    """Creates a set where every sample uniquely appears once and only once, using as few lanes as possible
+    Every sample with remaining clusters has to be in exactly one chosen structure, no other sample may be
+    in two of them, and each structure costs the lanes sample_distributor will give it: an exact cover.
+    It is solved by branch and bound starting from the simple_unique_set solution, branching on the
+    uncovered sample with the fewest usable structures and pruning with the lanes the uncovered clusters
+    need at least. If the search runs out of time_budget seconds the best set found so far is kept.
+    Returns the chosen structure ids"""
+    #Samples as bits of integer masks, in the order of their names
+    samples = list(reversed(range(len(lanes.samples))))
+    needed = 0
+    for sample in samples:
+        if lanes.remaining[sample] > 0:
+            needed |= 1 << int(sample)
+    masks = [sum(1 << int(sample) for sample in columns) for columns in lanes.columns]
+    #Samples that can't be in another chosen structure
+    conflicts = [sum(1 << int(sample) for sample in numpy.flatnonzero(row)) for row in lanes.unique]
+    #Remaining clusters, as counted by sample_distributor
+    clusters = [int(total) for total in lanes.unique.dot(lanes.remaining)]
+    lanes_needed = [int(math.ceil(total/float(clusters_per_lane))) for total in clusters]
+    #Cheapest structures first, to find good solutions early
+    candidates = OrderedDict()
+    for sample in samples:
+        if needed & (1 << int(sample)):
+            candidates[sample] = sorted(numpy.flatnonzero(lanes.members[:, sample]).tolist(),
+                                        key=lambda key: (lanes_needed[key], -clusters[key]))
+
+    best = {'lanes': None, 'keys': None}
+    try:
+        greedy = simple_unique_set(lanes, target_clusters)
+        best['lanes'] = sum(lanes_needed[key] for key in greedy)
+        best['keys'] = list(greedy)
+    except Exception as e:
+        print("Greedy structure selection failed ({}), searching for an exact one".format(e))
+    greedy_lanes = best['lanes']
+
+    deadline = time() + time_budget
+    def expand(chosen, covered, blocked, cost, clusters_left):
+        """Record chosen if it covers every sample, else return the structures to branch on"""
+        uncovered = needed & ~covered
+        if not uncovered:
+            if best['lanes'] is None or cost < best['lanes']:
+                best['lanes'] = cost
+                best['keys'] = list(chosen)
+            return []
+        if best['lanes'] is not None and cost + int(math.ceil(clusters_left/float(clusters_per_lane))) >= best['lanes']:
+            return []
+        #Branch on the uncovered sample with the fewest structures left
+        branch = None
+        for sample, keys in candidates.items():
+            if uncovered & (1 << int(sample)):
+                options = [key for key in keys if not conflicts[key] & blocked]
+                if branch is None or len(options) < len(branch):
+                    branch = options
+                    if not branch:
+                        return []
+        return branch
+
+    def search(total_clusters):
+        #Depth first with an explicit stack, one structure is chosen per level so
+        #large projects would exceed the recursion limit.
+        chosen = []
+        stack = [(0, 0, 0, total_clusters, iter(expand(chosen, 0, 0, 0, total_clusters)))]
+        while stack:
+            if time() > deadline:
+                raise SearchTimeout()
+            covered, blocked, cost, clusters_left, options = stack[-1]
+            key = next(options, None)
+            if key is None:
+                stack.pop()
+                #Every level but the first added a structure
+                if stack:
+                    chosen.pop()
+                continue
+            chosen.append(key)
+            state = (covered | masks[key], blocked | conflicts[key], cost + lanes_needed[key], clusters_left - clusters[key])
+            stack.append(state + (iter(expand(chosen, *state)),))
+
+    total_clusters = int(lanes.remaining[lanes.unique.any(axis=0)].sum())
+    try:
+        search(total_clusters)
+    except SearchTimeout:
+        print("Structure search stopped after {}s, keeping the best set found".format(time_budget))
+    if best['keys'] is None:
+        raise Exception('Error: No set of structures holds every sample once and only once!')
+    if greedy_lanes is not None and best['lanes'] < greedy_lanes:
+        print("Structure search: {} lanes instead of {} with the greedy selection".format(best['lanes'], greedy_lanes))
+
+    validate_samples_unique(lanes, best['keys'])
+    validate_all_samples_present(lanes, best['keys'])
+    return best['keys']
+
+def validate_samples_unique(lanes, chosen):
     """Crude way to check that no samples are in different TYPES of lanes"""
-    tempList = list()
-
-    #Put all values in a list
-    for k, v in lane_maps.items():
-        for index in range(1,len(v)):
-            if not v[index] == 'Undetermined':
-                tempList.append(v[index])
-
-    #Count instances of all items in the list
-    counter = Counter(tempList)
-    for values in counter.values():
-        if values > 1:
-            raise Exception('Error: Sample present in multiple structures. Unhandled exception!')
-
-def validate_all_samples_present(subset_struct, sample_struct, clusters_rem):
-    """Takes sample_struct and a subset of sample_struct, and checks that all present in sample_struct with remaining clusters
-    also exist in subset_struct"""
-    #Form a list of all samples in sample_struct
-    tempList = list()
-    for key, samplelist in sample_struct.items():
-        for element in samplelist:
-            if not element in tempList and clusters_rem[element] > 0:
-                tempList.append(element)
-
-    #Verify that all samples exist in subset_struct
-    for element in tempList:
-        found = False
-        for key, samplelist in subset_struct.items():
-            if element in samplelist:
-                found = True
-                break
-        if not found:
-            raise Exception('Error: Sample missing after subset was generated! {} is one of these'.format(element))
+    if (lanes.unique[chosen].sum(axis=0) > 1).any():
+        raise Exception('Error: Sample present in multiple structures. Unhandled exception!')
+
+def validate_all_samples_present(lanes, chosen):
+    """Checks that all samples with remaining clusters are in one of the chosen structures"""
+    missing = numpy.flatnonzero((lanes.remaining > 0) & ~lanes.members[chosen].any(axis=0))
+    if len(missing):
+        raise Exception('Error: Sample missing after subset was generated! {} is one of these'.format(lanes.samples[missing[0]]))
 
-def sample_distributor(sample_struct, clusters_rem, clusters_per_lane):
+def sample_distributor(lanes, chosen, clusters_per_lane):
     """Gives the percentage volume each sample should have in a lane, BEFORE accounting
     for concentration offsets"""
     desired_ratios = dict()
-    # Key: string of samples. values: Percentage, sample order as sample_struct.values()
+    # Key: structure id. values: Percentage, sample order as lanes.columns
     ideal_lanes = dict()
     needed_lanes = dict()
 
-    for s_key, s_val in sample_struct.items():
-        #Calculate lane total (sum)
-        lane_total = 0
-        corrected_total = 0
-        for entry in sample_struct[s_key]:
-            if clusters_rem[entry] > 0:
-                lane_total += clusters_rem[entry]
-                if entry != "Undetermined":
-                    corrected_total += clusters_rem[entry]
-
-        #Ignores Undetermined in clusters remaining. Idealy this would be ignored everywher
-        #but the calculations are complex.
-        ideal_lanes[s_key] = corrected_total/float(clusters_per_lane)
+    #Lane total (sum) of the remaining clusters
+    lane_totals = lanes.members[chosen].dot(lanes.remaining)
+    #Ignores Undetermined in clusters remaining. Idealy this would be ignored everywher
+    #but the calculations are complex.
+    corrected_totals = lanes.unique[chosen].dot(lanes.remaining)
+    for s_key, lane_total, corrected_total in zip(chosen, lane_totals, corrected_totals):
+        ideal_lanes[s_key] = int(corrected_total)/float(clusters_per_lane)
         needed_lanes[s_key] = math.ceil(ideal_lanes[s_key])
 
         #Populate output sample rates
-        desired_ratios[s_key] = []
-        for entry in sample_struct[s_key]:
-            if lane_total == 0:
-                desired_ratios[s_key].append(0)
-            elif clusters_rem[entry] > 0:
-                desired_ratios[s_key].append(clusters_rem[entry]/float(lane_total))
-            else:
-                desired_ratios[s_key].append(0/float(lane_total))
+        if lane_total == 0:
+            desired_ratios[s_key] = numpy.zeros(len(lanes.columns[s_key]))
+        else:
+            desired_ratios[s_key] = lanes.remaining[lanes.columns[s_key]]/float(lane_total)
 
     #desired ratios = desired clusters per lane (for given sample) / clusters per lane
     return [desired_ratios, needed_lanes, ideal_lanes]
 
-def integrate_conc_diff(lane_maps, desired_ratios):
+def integrate_conc_diff(lanes, desired_ratios):
     """Since some samples are strong and some weaksauce
     10% in desired_ratios does not mean 10% of lane volume
     Ignores undetermined clusters in calculation
@@ -295,14 +354,15 @@ def integrate_conc_diff(lane_maps, desired_ratios):
 
     #FROM HERE NEEDS HEAVY REVISION
     for key in desired_ratios:
+        lane_map = lanes.clusters[key, lanes.columns[key]]
         #Assumes no samples had unequal volume in structure
         #TODO: Use LIMS integration to avoid this assumption
-        actual_output = lane_maps[key]/sum(lane_maps[key])
+        actual_output = lane_map/sum(lane_map)
 
         expect_output = []
         expect_output.append(0.0) #Expect 0 undetermined
-        for index in range(1, len(lane_maps[key])):
-            expect_output.append(1/float(len(lane_maps[key]) -1))#-1 Removes undetermined
+        for index in range(1, len(lane_map)):
+            expect_output.append(1/float(len(lane_map) -1))#-1 Removes undetermined
         #TODO: One could include undetermined here
         #Overriding errstate since expected is 0 for undetermined
         with numpy.errstate(divide='ignore'):
@@ -318,70 +378,71 @@ def integrate_conc_diff(lane_maps, desired_ratios):
             volume_ratios[key] = numpy.zeros(len(volume_ratios[key]))
     return volume_ratios, conc_factor
 
-def realize_numbers(lane_maps, best_sample_struct, volume_ratios, conc_factor, clusters_rem, total_lanes, pool_excess, lane_volume, min_pipette):
+def pipette_ratios(values, conc_factor, lane_clusters, remaining, lanes, poolsize, min_pipette):
+    """Rounds the volume ratios of one structure to pipettable volumes summing to at most 100%
+    Ratios are rounded down to steps of 0.1 ul, with min_pipette as minimum volume. While the sum
+    exceeds 100%, one step is removed from the most over-expressed sample, as long as it stays
+    above the pipette minimum and over-expressed. The removed steps are exactly the ones with the
+    highest over-expression before their removal, so all of them are selected at once.
+    Returns None if the ratios can't be brought down to 100% with this number of lanes.
+    """
+    minTres = round(min_pipette/poolsize, 6)
+    minAdd = round(0.1/poolsize, 6)
+
+    values = numpy.asarray(values, dtype=float)
+    uprounded = numpy.where(values <= minTres, minTres, values - values % minAdd)
+    #Handles problems with Undetermined
+    uprounded[values == 0] = 0.0
+    excess = sum(uprounded) - 1.0
+    if excess <= 0:
+        return uprounded
+    #Tolerates float noise, e.g. 1.04 - 1.0 is slightly above two steps of 0.02
+    needed = int(math.ceil(excess/minAdd - 1e-9))
+
+    #Overexpression per sample (expressed - remaining), and how much a single step lowers it
+    scale = conc_factor*lane_clusters*lanes
+    over = uprounded*scale - remaining
+    step = minAdd*scale
+    #Steps per sample keeping it at minTres or above, and over-expressed after the removal
+    by_pipette = numpy.floor((uprounded - minTres)/minAdd + 1e-9)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        by_expression = numpy.where(step > 0, numpy.ceil(over/step) - 1, numpy.where(over > 0, numpy.inf, 0))
+    removable = numpy.minimum(by_pipette, by_expression).clip(0).astype(int)
+    if removable.sum() < needed:
+        return None
+
+    #Over-expression of every removable step before it is taken, highest first
+    sample = numpy.repeat(numpy.arange(len(uprounded)), removable)
+    taken = numpy.arange(len(sample)) - numpy.repeat(numpy.cumsum(removable) - removable, removable)
+    priority = over[sample] - taken*step[sample]
+    chosen = sample[numpy.argsort(-priority, kind='stable')[:needed]]
+    return uprounded - numpy.bincount(chosen, minlength=len(uprounded))*minAdd
+
+def realize_numbers(lanes, volume_ratios, conc_factor, total_lanes, pool_excess, lane_volume, min_pipette):
     """Actual numbers need to be offset to:
     Work with a pipette minimum and pipette threshold in relation to pool size (5 ul) + excess.
-    Lanesum is then downsized to sub 100% with as equal coverage as possible.
-    If impossible entire process is rerun with an extra lane for that struct.
+    Lanesum is then downsized to sub 100% with as equal coverage as possible (see pipette_ratios).
+    If impossible an extra lane is added for that struct, until the ratios fit.
     """
     extra_lanes=dict()
     rounded_ratios = dict()
     final_pool_sizes = dict()
 
-    #Remaining clusters for structure
-    rem_list = dict()
-    for key, values in best_sample_struct.items():
-        t_list = []
-        for name in best_sample_struct[key]:
-            t_list.append(clusters_rem[name])
-        rem_list[key] = numpy.array(t_list)
-
     #For each structure
     for key, values in volume_ratios.items():
-        calculations_done = False
-        while not calculations_done:
+        #Sets 'Undetermined's factor to 0, helps out later.
+        conc_factor[key][0] = 0
+        #Remaining clusters for structure
+        rem_list = lanes.remaining[lanes.columns[key]]
+        lane_clusters = sum(lanes.clusters[key, lanes.columns[key]])
+        while True:
             poolsize = lane_volume*total_lanes[key] + pool_excess
-            minTres = round(min_pipette/poolsize, 6)
-            minAdd = round(0.1/poolsize, 6)
-
-            #Rounds all values up
-            uprounded = []
-            for sample in values:
-                #Handles problems with Undetermined
-                if sample == 0:
-                    uprounded.append(0.0)
-                elif sample <= minTres:
-                    uprounded.append(minTres)
-                else:
-                    sample = sample-(sample%minAdd)
-                    uprounded.append(sample)
-            uprounded = numpy.array(uprounded)
-
-            #Sets 'Undetermined's factor to 0, helps out later.
-            conc_factor[key][0] = 0
-            calculations_done = True
-            while sum(uprounded) > 1.0:
-                #Overexpression per sample (expressed - remaining). Expressed = ratio * clusters_per_lane * lanes
-                #Uprounded*conc_factor[key] SHOULD even out itself; since it only offsets ratios. Sum still 1
-                oe_list = (uprounded*conc_factor[key])*sum(lane_maps[key])*total_lanes[key] - rem_list[key]
-                #Order indexes in oe_list by value (descending)
-                max_index = oe_list.argsort()[::-1]
-
-                stuck = True
-                for most_oe in max_index:
-                    #Remove one minAdd IF greater than minTres+minAdd AND (ratio-minAdd)*factor > remaining_clusters
-                    if uprounded[most_oe] >= minAdd + minTres and (uprounded[most_oe] - minAdd)*conc_factor[key][most_oe]*sum(lane_maps[key])*total_lanes[key] > rem_list[key][most_oe]:
-                        uprounded[most_oe] = uprounded[most_oe] - minAdd
-                        stuck = False
-                        break
-                #Add extra lane, restart the loop for the whole structure (new pool size)
-                if stuck:
-                    total_lanes[key] = total_lanes[key] + 1
-                    if not key in extra_lanes:
-                        extra_lanes[key] = 0
-                    extra_lanes[key] = extra_lanes[key] + 1
-                    calculations_done = False
-                    break
+            uprounded = pipette_ratios(values, conc_factor[key], lane_clusters, rem_list, total_lanes[key], poolsize, min_pipette)
+            if uprounded is not None:
+                break
+            #Add extra lane (new pool size)
+            total_lanes[key] = total_lanes[key] + 1
+            extra_lanes[key] = extra_lanes.get(key, 0) + 1
 
         final_pool_sizes[key] = poolsize*float(sum(uprounded))
         ##TODO: Sum of output rounded_ratios is less than 100% before normalizing; weird but likely correct.
@@ -392,41 +453,81 @@ def realize_numbers(lane_maps, best_sample_struct, volume_ratios, conc_factor, c
     return [rounded_ratios, final_pool_sizes, extra_lanes]
 
 
-def generate_output(project_id, dest_plate_list, best_sample_struct,total_lanes, req_lanes, lane_maps, rounded_ratios,
-                    target_clusters, clusters_per_lane, extra_lanes, lane_volume, pool_excess, final_pool_sizes, volume_ratios, desired_ratios):
-    """"Gathers the container id and well name for all samples in project"""
-    timestamp = datetime.fromtimestamp(time()).strftime('%Y-%m-%d_%H:%M')
-
-    #Cred to Denis for providing a base epp
+#All normalization processes for project
+NORMALIZATION_PROCESSES = ['Library Normalization (MiSeq) 4.0', 'Library Normalization (Illumina SBS) 4.0','Library Normalization (HiSeq X) 1.0']
+#Artifacts per LIMS batch request
+LIMS_BATCH_SIZE = 500
+#Hours after which the locations in --location_cache are fetched again from LIMS
+LOCATION_CACHE_TTL = 24
+
+def fetch_project_locations(lims, project_id):
+    """Name of a project and the container id and well of its normalized samples, keyed by sample name
+    The project is loaded by id, and the output artifacts of its normalization processes
+    with batch requests instead of one request per artifact"""
+    projName = Project(lims, id=project_id).name
+    pros = lims.get_processes(type=NORMALIZATION_PROCESSES, projectname=projName)
+    outputs = [p.all_outputs() for p in pros]
+    artifacts = [o for process_outputs in outputs for o in process_outputs]
+    for start in range(0, len(artifacts), LIMS_BATCH_SIZE):
+        lims.get_batch(artifacts[start:start + LIMS_BATCH_SIZE])
+
+    #Later processes override earlier ones, container ids are read from the artifact without loading the container
     location = dict()
-    lims = Lims(BASEURI, USERNAME, PASSWORD)
-    allProjects = lims.get_projects()
-    for proj in allProjects:
-        if proj.id == project_id:
-            projName = proj.name
-            break
-
-    #Sets up source id
-    #All normalization processes for project
-    norms=['Library Normalization (MiSeq) 4.0', 'Library Normalization (Illumina SBS) 4.0','Library Normalization (HiSeq X) 1.0']
-    pros=lims.get_processes(type=norms, projectname=projName)
-    #For all processes
-    for p in pros:
-        #For all artifacts in process
-        for o in p.all_outputs():
+    for process_outputs in outputs:
+        for o in process_outputs:
             #If artifact is analyte type and has project name in sample
             if o.type=="Analyte" and project_id in o.name:
-                location[o.name.split()[0]] = list()
-                location[o.name.split()[0]].append(o.location[0].id)
-                location[o.name.split()[0]].append(o.location[1])
+                location[o.name.split()[0]] = [o.location[0].id, o.location[1]]
+    return projName, location
+
+def project_locations(project_ids, cache_path=None, cache_ttl=LOCATION_CACHE_TTL):
+    """Names and sample locations of the projects, see fetch_project_locations
+    If cache_path is given, projects fetched less than cache_ttl hours ago are read from that JSON file,
+    and the others are fetched from LIMS and added to it"""
+    cached = dict()
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as cache:
+            cached = json.load(cache)
+    lims = None
+    for project_id in project_ids:
+        if project_id in cached and time() - cached[project_id]['fetched'] < cache_ttl*3600:
+            continue
+        if lims is None:
+            lims = Lims(BASEURI, USERNAME, PASSWORD)
+        projName, location = fetch_project_locations(lims, project_id)
+        cached[project_id] = {'fetched': time(), 'name': projName, 'locations': location}
+        if cache_path is not None:
+            with open(cache_path, 'w') as cache:
+                json.dump(cached, cache)
+
+    projNames = dict()
+    location = dict()
+    for project_id in project_ids:
+        projNames[project_id] = cached[project_id]['name']
+        location.update(cached[project_id]['locations'])
+    return projNames, location
+
+def generate_output(project_ids, dest_plate_list, lanes, chosen, total_lanes, req_lanes, rounded_ratios,
+                    target_clusters, clusters_per_lane, extra_lanes, lane_volume, pool_excess, final_pool_sizes, volume_ratios, desired_ratios,
+                    location_cache=None, location_cache_ttl=LOCATION_CACHE_TTL):
+    """"Gathers the container id and well name for all samples in the projects
+    A repool of several projects is written to one set of files, named after the project ids"""
+    timestamp = datetime.fromtimestamp(time()).strftime('%Y-%m-%d_%H:%M')
+
+    #Cred to Denis for providing a base epp
+    projNames, location = project_locations(project_ids, location_cache, location_cache_ttl)
+    if len(project_ids) == 1:
+        projName = projNames[project_ids[0]]
+    else:
+        projName = '_'.join(project_ids)
 
     #Continue coding from here
-    generate_summary(projName, best_sample_struct, timestamp, project_id, dest_plate_list, total_lanes, req_lanes,
-                     lane_maps, rounded_ratios, target_clusters, clusters_per_lane, extra_lanes, volume_ratios, desired_ratios, lane_volume, pool_excess)
-    generate_csv(projName, timestamp, location, dest_plate_list, total_lanes, best_sample_struct, rounded_ratios, lane_volume, pool_excess, final_pool_sizes)
-    generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lanes, best_sample_struct, rounded_ratios, lane_volume, pool_excess, final_pool_sizes)
+    generate_summary(projName, lanes, chosen, timestamp, project_ids, dest_plate_list, total_lanes, req_lanes,
+                     rounded_ratios, target_clusters, clusters_per_lane, extra_lanes, volume_ratios, desired_ratios, lane_volume, pool_excess)
+    generate_csv(projName, timestamp, location, dest_plate_list, total_lanes, lanes, chosen, rounded_ratios, lane_volume, pool_excess, final_pool_sizes)
+    generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lanes, lanes, chosen, rounded_ratios, lane_volume, pool_excess, final_pool_sizes)
 
-def generate_summary(projName, best_sample_struct, timestamp, project_id, dest_plate_list, total_lanes, req_lanes, lane_maps, rounded_ratios,
+def generate_summary(projName, lanes, chosen, timestamp, project_ids, dest_plate_list, total_lanes, req_lanes, rounded_ratios,
                      target_clusters, clusters_per_lane, extra_lanes, volume_ratios, desired_ratios, lane_volume, pool_excess):
     """Print stats including duplicates"""
 
@@ -447,7 +548,7 @@ def generate_summary(projName, best_sample_struct, timestamp, project_id, dest_p
 
         output = 'Target clusters per sample: {}, Expected clusters per lane: {}\n'.format(str(target_clusters), str(clusters_per_lane))
         output = output + 'Lane volume: {} microliter(s), Pool excess: {} microliter(s)\n'.format(lane_volume, pool_excess)
-        output = output + 'Project ID: {}, Destination plate name list: {}\n'.format(project_id, str(dest_plate_list))
+        output = output + 'Project ID: {}, Destination plate name list: {}\n'.format(', '.join(project_ids), str(dest_plate_list))
         output = (output + 'Ideal lanes (same schema): {}, Total lanes: {}, Expression over theoretical ideal (OPT): {}x\n'
                   .format(str(round(sum(req_lanes.values()),3)), str(sum(total_lanes.values())), str(round(OPT,3))))
         output = output + 'Lanes added due to pipette limitations: {} (this can be mitigated with bigger pools).\n'.format(sum(extra_lanes.values()))
@@ -456,7 +557,8 @@ def generate_summary(projName, best_sample_struct, timestamp, project_id, dest_p
         summary.write( output )
 
         bin = 0
-        for key, value in best_sample_struct.items():
+        for key in chosen:
+            value = lanes.sample_names(key)
             if total_lanes[key] > 0:
                 bin  += 1
                 if key in extra_lanes:
@@ -475,12 +577,12 @@ def generate_summary(projName, best_sample_struct, timestamp, project_id, dest_p
                             lane_ratio = req_lanes[key]/(total_lanes[key]+extra_lanes[key])
                         else:
                             lane_ratio = req_lanes[key]/(total_lanes[key])
-                        output = '{:11}{:>22}%{:>25}%{:>16}%{:>11}%\n'.format(str(best_sample_struct[key][sample]), str(round(rounded_ratios[key][sample]*100,2)),
+                        output = '{:11}{:>22}%{:>25}%{:>16}%{:>11}%\n'.format(str(value[sample]), str(round(rounded_ratios[key][sample]*100,2)),
                                                            str(round(volume_ratios[key][sample]*100*lane_ratio,2)),
                                                            str(round(volume_ratios[key][sample]*100,2)),str(round(desired_ratios[key][sample]*100,2)))
                         summary.write( output )
 
-def generate_csv(projName, timestamp, location, dest_plate_list, total_lanes, best_sample_struct, rounded_ratios, lane_volume, pool_excess, final_pool_sizes):
+def generate_csv(projName, timestamp, location, dest_plate_list, total_lanes, lanes, chosen, rounded_ratios, lane_volume, pool_excess, final_pool_sizes):
     """Creates the output csv file"""
 
     name = '{}_repool_{}.csv'.format(projName, timestamp)
@@ -492,7 +594,8 @@ def generate_csv(projName, timestamp, location, dest_plate_list, total_lanes, be
 
     with open(name, 'w') as csvfile:
         writer = csv.writer(csvfile)
-        for key, value in best_sample_struct.items():
+        for key in chosen:
+            value = lanes.sample_names(key)
             #If a structure is unused, don't include it in the csv
             if not final_pool_sizes[key] == 0:
                 try:
@@ -506,7 +609,7 @@ def generate_csv(projName, timestamp, location, dest_plate_list, total_lanes, be
 
                 for instance in range(1, len(value)):
                     #<source plate ID>,<source well>,<volume>,<destination plate ID>,<destination well>
-                    sample = best_sample_struct[key][instance]
+                    sample = value[instance]
                     position = '{}:{}'.format(wells[wellIndex[1]], str(wellIndex[0]))
                     try:
                         out_pool = round(rounded_ratios[key][instance]*final_pool_sizes[key],2)
@@ -526,7 +629,7 @@ def generate_csv(projName, timestamp, location, dest_plate_list, total_lanes, be
                         else:
                             wellIndex[0] = 1
                             destNo += 1
-def generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lanes, best_sample_struct, rounded_ratios, lane_volume, pool_excess, final_pool_sizes):
+def generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lanes, lanes, chosen, rounded_ratios, lane_volume, pool_excess, final_pool_sizes):
     """Dumps output to a crappy csvfile. Because I'm awesome like that"""
 
     name = '{}_dumpfile_{}.csv'.format(projName, timestamp)
@@ -540,7 +643,8 @@ def generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lane
         writer = csv.writer(csvfile)
         headers = "<samplename>","<source plate ID>","<source well>","<volume>","<destination plate ID>","<destination well>"
         writer.writerow(headers)
-        for key, value in best_sample_struct.items():
+        for key in chosen:
+            value = lanes.sample_names(key)
             #If a structure is unused, don't include it in the csv
             if not final_pool_sizes[key] == 0:
                 try:
@@ -554,7 +658,7 @@ def generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lane
 
                 for instance in range(1, len(value)):
                     #samplename,<source plate ID>,<source well>,<volume>,<destination plate ID>,<destination well>
-                    sample = best_sample_struct[key][instance]
+                    sample = value[instance]
                     position = '{}:{}'.format(wells[wellIndex[1]], str(wellIndex[0]))
                     try:
                         out_pool = round(rounded_ratios[key][instance]*final_pool_sizes[key],2)
@@ -576,7 +680,8 @@ def generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lane
                             destNo += 1
 
 @click.command()
-@click.option('--project_id', required=True,help='ID of project to repool. \nExamples: P2652, P1312 etc.')
+@click.option('--project_id', required=True, multiple=True,
+              help='ID of project to repool, repeat it to repool several projects together in one robot file. \nExamples: P2652, P1312 etc.')
 @click.option('--dest_plate_list', default=['dp_1'],
               help='List of destination plates for the robot\'s csv file. Include too many rather than too few; excess will be unused. Default: [dp_1]')
 @click.option('--target_clusters', default=320*1000000, help='Threshold of clusters per sample. \nDefault:320*1000000')
@@ -584,22 +689,30 @@ def generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lane
 @click.option('--lane_volume', default=5, help='Lane volume. \nDefault:5 (uL)')
 @click.option('--pool_excess', default=2, help='Excess pool volume when creating a pool. \nDefault:2 (uL)')
 @click.option('--min_pipette', default=1, help='Minimum pipette volume. \nDefault:1 (uL)')
+@click.option('--snapshot', default=None, help='Local snapshot file of x_flowcells; only documents changed since the last run are downloaded.')
+@click.option('--time_budget', default=OPTIMIZER_TIME_BUDGET, help='Seconds spent searching for the lane structures needing the fewest lanes, 0 keeps the greedy selection. \nDefault:10')
+@click.option('--location_cache', default=None, help='JSON file caching the container and well of the samples of each project, instead of fetching them from LIMS on every run.')
+@click.option('--location_cache_ttl', default=LOCATION_CACHE_TTL, help='Hours after which the locations of a project in --location_cache are fetched again. \nDefault:24')
 
-def main(target_clusters, clusters_per_lane, project_id, dest_plate_list, lane_volume, pool_excess, min_pipette):
+def main(target_clusters, clusters_per_lane, project_id, dest_plate_list, lane_volume, pool_excess, min_pipette, snapshot, time_budget,
+         location_cache, location_cache_ttl):
     """Application that calculates samples under threshold for a project, then calculate the optimal composition for reaching the threshold
-    without altering concentrations nor the structure of the pools. Outputs both a summary as well as a functional csv file."""
+    without altering concentrations nor the structure of the pools. Outputs both a summary as well as a functional csv file.
+    Several projects are planned jointly: lanes shared by them are repooled once for the samples of all of them."""
     print("\nWARNING: Output from repooler is experimental. Remember to review all numbers before re-sequencing.\n")
 
     couch = connection()
-    structure = proj_struct(couch, project_id, target_clusters)
-    [lane_maps, clusters_rem, sample_struct] = parse_indata(structure, target_clusters)
-    best_sample_struct = simple_unique_set(sample_struct, clusters_rem, target_clusters)
-    [desired_ratios, total_lanes, req_lanes] = sample_distributor(best_sample_struct, clusters_rem, clusters_per_lane)
-    [volume_ratios, conc_factor] = integrate_conc_diff(lane_maps, desired_ratios)
-    [rounded_ratios, final_pool_sizes, extra_lanes] = realize_numbers(lane_maps, best_sample_struct, volume_ratios, conc_factor,
-                                                                      clusters_rem, total_lanes, pool_excess, lane_volume, min_pipette)
-
-    generate_output(project_id, dest_plate_list, best_sample_struct, total_lanes, req_lanes, lane_maps, rounded_ratios,
-                    target_clusters, clusters_per_lane, extra_lanes,lane_volume,pool_excess, final_pool_sizes, volume_ratios, desired_ratios)
+    project_ids = sorted(set(project_id))
+    structure = proj_struct(couch, project_ids, target_clusters, snapshot)
+    lanes = parse_indata(structure, target_clusters)
+    chosen = optimal_unique_set(lanes, target_clusters, clusters_per_lane, time_budget)
+    [desired_ratios, total_lanes, req_lanes] = sample_distributor(lanes, chosen, clusters_per_lane)
+    [volume_ratios, conc_factor] = integrate_conc_diff(lanes, desired_ratios)
+    [rounded_ratios, final_pool_sizes, extra_lanes] = realize_numbers(lanes, volume_ratios, conc_factor, total_lanes,
+                                                                      pool_excess, lane_volume, min_pipette)
+
+    generate_output(project_ids, dest_plate_list, lanes, chosen, total_lanes, req_lanes, rounded_ratios,
+                    target_clusters, clusters_per_lane, extra_lanes,lane_volume,pool_excess, final_pool_sizes, volume_ratios, desired_ratios,
+                    location_cache, location_cache_ttl)
 if __name__ == '__main__':
     main()
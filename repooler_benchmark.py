@@ -0,0 +1,274 @@
+#!/usr/bin/env python2.7
+"""Benchmark of the repooler on synthetic projects
+
+Generates the x_flowcells documents of synthetic projects, serves them from an
+in-memory stand-in of CouchDB and runs the repooler pipeline on them, recording
+the wall time (and with --memory the peak memory) of every stage and the lanes of
+the resulting repool. With --results the records are appended as JSON lines, so
+the speed and the quality of the solutions can be followed over time.
+"""
+import copy
+import json
+import os
+import random
+import re
+import subprocess
+
+import click
+import numpy
+
+from collections import namedtuple
+from datetime import datetime
+from time import time
+
+try:
+    import tracemalloc
+except ImportError:
+    #Python 2, peak memory is not recorded
+    tracemalloc = None
+
+from repooler import (proj_struct, parse_indata, simple_unique_set, optimal_unique_set, sample_distributor,
+                      integrate_conc_diff, realize_numbers, OPTIMIZER_TIME_BUDGET)
+from flowcell_snapshot import PROJECT_VIEW
+
+
+Row = namedtuple('Row', ['id', 'key', 'value', 'doc'])
+
+class MemoryDatabase(dict):
+    """Documents of a database, answering the view queries of repooler.proj_struct"""
+
+    def __init__(self, docs):
+        super(MemoryDatabase, self).__init__(docs)
+        self.requests = 0
+
+    def view(self, name, key=None, keys=None, include_docs=False):
+        self.requests += 1
+        if keys is None:
+            keys = [key]
+        if name == '_all_docs':
+            return [Row(id, id, None, self.get(id) if include_docs else None) for id in keys]
+        if name == PROJECT_VIEW:
+            #Same rows as the by_project view of flowcell_views.json
+            rows = []
+            for id, doc in sorted(self.items()):
+                projects = set()
+                for entry in doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']:
+                    match = re.match(r'^(P[0-9]+)_', entry['Sample'])
+                    if match:
+                        projects.add(match.group(1))
+                rows.extend(Row(id, project, doc['RunInfo']['Id'], None) for project in keys if project in projects)
+            return sorted(rows, key=lambda row: (keys.index(row.key), row.id))
+        raise KeyError('view {} is not available in memory'.format(name))
+
+class MemoryCouch(dict):
+    """Stand-in of a couchdb.Server holding MemoryDatabases"""
+
+    @property
+    def requests(self):
+        return sum(db.requests for db in self.values())
+
+
+def synthetic_flowcells(project, n_samples, pool_size, repools, shared, seed):
+    """x_flowcells documents of a synthetic project
+    Samples are split in pools of pool_size samples on average, each pool is sequenced
+    on one lane, then repools merge 2 to 4 random pools on new lanes. A fraction shared
+    of the lanes also holds samples of another project. Lanes fill flowcells of 8 lanes."""
+    rand = random.Random(seed)
+    samples = ['{}_{:04d}'.format(project, index) for index in range(1, n_samples + 1)]
+    rand.shuffle(samples)
+    pools = []
+    while samples:
+        size = rand.randint(max(1, pool_size//2), max(1, pool_size*3//2))
+        pools.append(samples[:size])
+        samples = samples[size:]
+    lanes = list(pools)
+    for repool in range(int(len(pools)*repools)):
+        merged = rand.sample(pools, min(len(pools), rand.randint(2, 4)))
+        lanes.append(sorted(set(sum(merged, []))))
+
+    docs = dict()
+    other = 0
+    for index, lane in enumerate(lanes):
+        lane = list(lane)
+        if rand.random() < shared:
+            for sample in range(rand.randint(1, max(1, pool_size//4))):
+                other += 1
+                lane.append('P9999_{:04d}'.format(other))
+        fc_name = '170101_ST-E00201_{:04d}_AFC{:05d}CCXX'.format(index//8, index//8)
+        doc = docs.setdefault('fc{:05d}'.format(index//8), {'RunInfo': {'Id': fc_name},
+                                                            'illumina': {'Demultiplex_Stats': {'Barcode_lane_statistics': []}}})
+        stats = doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
+        #Varying library concentrations give uneven yields within a lane
+        for sample in lane:
+            stats.append({'Lane': str(index%8 + 1), 'Sample': sample, 'Clusters': '{:,}'.format(rand.randint(10, 90)*1000000)})
+        stats.append({'Lane': str(index%8 + 1), 'Sample': 'Undetermined', 'Clusters': '{:,}'.format(rand.randint(1, 20)*1000000)})
+    return docs
+
+def stepwise_realize_numbers(lanes, volume_ratios, conc_factor, total_lanes, pool_excess, lane_volume, min_pipette):
+    """Original rounding of realize_numbers, kept as reference"""
+    extra_lanes=dict()
+    rounded_ratios = dict()
+    final_pool_sizes = dict()
+
+    rem_list = dict()
+    lane_maps = dict()
+    for key in volume_ratios:
+        rem_list[key] = lanes.remaining[lanes.columns[key]]
+        lane_maps[key] = lanes.clusters[key, lanes.columns[key]]
+
+    for key, values in volume_ratios.items():
+        calculations_done = False
+        while not calculations_done:
+            poolsize = lane_volume*total_lanes[key] + pool_excess
+            minTres = round(min_pipette/poolsize, 6)
+            minAdd = round(0.1/poolsize, 6)
+
+            uprounded = []
+            for sample in values:
+                if sample == 0:
+                    uprounded.append(0.0)
+                elif sample <= minTres:
+                    uprounded.append(minTres)
+                else:
+                    sample = sample-(sample%minAdd)
+                    uprounded.append(sample)
+            uprounded = numpy.array(uprounded)
+
+            conc_factor[key][0] = 0
+            calculations_done = True
+            while sum(uprounded) > 1.0:
+                oe_list = (uprounded*conc_factor[key])*sum(lane_maps[key])*total_lanes[key] - rem_list[key]
+                max_index = oe_list.argsort()[::-1]
+
+                stuck = True
+                for most_oe in max_index:
+                    if uprounded[most_oe] >= minAdd + minTres and (uprounded[most_oe] - minAdd)*conc_factor[key][most_oe]*sum(lane_maps[key])*total_lanes[key] > rem_list[key][most_oe]:
+                        uprounded[most_oe] = uprounded[most_oe] - minAdd
+                        stuck = False
+                        break
+                if stuck:
+                    total_lanes[key] = total_lanes[key] + 1
+                    if not key in extra_lanes:
+                        extra_lanes[key] = 0
+                    extra_lanes[key] = extra_lanes[key] + 1
+                    calculations_done = False
+                    break
+
+        final_pool_sizes[key] = poolsize*float(sum(uprounded))
+        if sum(uprounded) == 0:
+            rounded_ratios[key] = uprounded
+        else:
+            rounded_ratios[key] = uprounded/float(sum(uprounded))
+    return [rounded_ratios, final_pool_sizes, extra_lanes]
+
+
+class Stages(object):
+    """Runs the stages of the pipeline, recording their wall time and peak memory"""
+
+    def __init__(self, memory):
+        self.memory = memory and tracemalloc is not None
+        self.records = []
+
+    def run(self, name, function, *args):
+        if self.memory:
+            tracemalloc.start()
+        start = time()
+        result = function(*args)
+        seconds = time() - start
+        peak = None
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.records.append({'stage': name, 'seconds': round(seconds, 4), 'peak_bytes': peak})
+        return result
+
+def benchmark(docs, project, target_clusters, clusters_per_lane, lane_volume, pool_excess, min_pipette, time_budget, stepwise, memory):
+    """Runs the repooler pipeline on the documents, returns the record of the run"""
+    couch = MemoryCouch(x_flowcells=MemoryDatabase(docs))
+    stages = Stages(memory)
+    structure = stages.run('proj_struct', proj_struct, couch, [project], target_clusters)
+    lanes = stages.run('parse_indata', parse_indata, structure, target_clusters)
+    try:
+        greedy = stages.run('simple_unique_set', simple_unique_set, lanes, target_clusters)
+        greedy_lanes = sum(sample_distributor(lanes, greedy, clusters_per_lane)[1].values())
+    except Exception:
+        greedy_lanes = None
+    chosen = stages.run('optimal_unique_set', optimal_unique_set, lanes, target_clusters, clusters_per_lane, time_budget)
+    [desired_ratios, total_lanes, req_lanes] = stages.run('sample_distributor', sample_distributor, lanes, chosen, clusters_per_lane)
+    structure_lanes = sum(total_lanes.values())
+    [volume_ratios, conc_factor] = stages.run('integrate_conc_diff', integrate_conc_diff, lanes, desired_ratios)
+    rounding_inputs = copy.deepcopy((volume_ratios, conc_factor, total_lanes))
+    [rounded_ratios, final_pool_sizes, extra_lanes] = stages.run('realize_numbers', realize_numbers, lanes, volume_ratios, conc_factor, total_lanes,
+                                                                 pool_excess, lane_volume, min_pipette)
+    record = {
+        'samples': len([sample for sample in lanes.samples if project in sample]),
+        'structures': len(lanes),
+        'chosen_structures': len(chosen),
+        'requests': couch.requests,
+        'greedy_lanes': greedy_lanes,
+        'structure_lanes': structure_lanes,
+        'lanes': sum(total_lanes.values()),
+        'extra_lanes': sum(extra_lanes.values()),
+        'ideal_lanes': round(sum(req_lanes.values()), 3),
+        #Expression over theoretical ideal, as in the summary of repooler.py
+        'opt': round(sum(total_lanes.values())/sum(req_lanes.values()), 3) if sum(req_lanes.values()) else None,
+    }
+    if stepwise:
+        stepwise_lanes = rounding_inputs[-1]
+        stages.run('stepwise_realize_numbers', stepwise_realize_numbers, lanes, *(rounding_inputs + (pool_excess, lane_volume, min_pipette)))
+        record['stepwise_lanes'] = sum(stepwise_lanes.values())
+    record['stages'] = stages.records
+    return record
+
+def revision():
+    """Git revision of the benchmarked code, None outside of a git checkout"""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@click.command()
+@click.option('--samples', default=[10, 100, 500, 2000], multiple=True, help='Number of samples of a synthetic project, repeatable. \nDefault:10, 100, 500, 2000')
+@click.option('--pool_size', default=[8, 24, 96], multiple=True, help='Average number of samples per lane, repeatable. \nDefault:8, 24, 96')
+@click.option('--repools', default=1.0, help='Repooled lanes per original pool. \nDefault:1.0')
+@click.option('--shared', default=0.2, help='Fraction of the lanes also holding samples of another project. \nDefault:0.2')
+@click.option('--seed', default=[1], multiple=True, help='Seed of the synthetic projects, repeatable. \nDefault:1')
+@click.option('--target_clusters', default=320*1000000, help='Threshold of clusters per sample. \nDefault:320*1000000')
+@click.option('--clusters_per_lane', default=380*1000000, help='Expected clusters generated by a single lane/well. \nDefault:380*1000000')
+@click.option('--lane_volume', default=5, help='Lane volume. \nDefault:5 (uL)')
+@click.option('--pool_excess', default=2, help='Excess pool volume when creating a pool. \nDefault:2 (uL)')
+@click.option('--min_pipette', default=1, help='Minimum pipette volume. \nDefault:1 (uL)')
+@click.option('--time_budget', default=OPTIMIZER_TIME_BUDGET, help='Seconds of the structure search per project. \nDefault:10')
+@click.option('--stepwise', is_flag=True, help='Also time the original stepwise rounding of realize_numbers.')
+@click.option('--memory', is_flag=True, help='Record the peak memory of every stage (Python 3 only, slows the stages down).')
+@click.option('--results', default=None, help='JSON lines file the records of the runs are appended to.')
+
+def main(samples, pool_size, repools, shared, seed, target_clusters, clusters_per_lane, lane_volume, pool_excess, min_pipette,
+         time_budget, stepwise, memory, results):
+    """Runs the repooler pipeline on synthetic projects of every combination of --samples, --pool_size and --seed,
+    and prints the time of every stage and the lanes of the repool."""
+    run = {'timestamp': datetime.now().isoformat(), 'revision': revision()}
+    for n_samples in samples:
+        for size in pool_size:
+            for project_seed in seed:
+                docs = synthetic_flowcells('P1000', n_samples, size, repools, shared, project_seed)
+                record = benchmark(docs, 'P1000', target_clusters, clusters_per_lane, lane_volume, pool_excess, min_pipette,
+                                   time_budget, stepwise, memory)
+                record.update(run, pool_size=size, repools=repools, shared=shared, seed=project_seed, time_budget=time_budget)
+
+                print('\nSamples: {}, pool size: {}, seed: {}, structures: {} ({} chosen), CouchDB requests: {}'.format(
+                    n_samples, size, project_seed, record['structures'], record['chosen_structures'], record['requests']))
+                print('Lanes: {} (greedy structures: {}, chosen structures: {}, pipette: +{}), ideal: {}, OPT: {}'.format(
+                    record['lanes'], record['greedy_lanes'], record['structure_lanes'], record['extra_lanes'], record['ideal_lanes'], record['opt']))
+                if stepwise:
+                    print('Lanes with the stepwise rounding: {}'.format(record['stepwise_lanes']))
+                for stage in record['stages']:
+                    peak = '' if stage['peak_bytes'] is None else '{:>10.1f} MB'.format(stage['peak_bytes']/1e6)
+                    print('  {:<26}{:>9.3f}s{}'.format(stage['stage'], stage['seconds'], peak))
+                if results is not None:
+                    with open(results, 'a') as out:
+                        out.write(json.dumps(record, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Output of the statistics reports as text or as machine readable files
+
+Each report of compute_undet_index_stats.py and compute_production_stats.py is
+built as one or more pandas DataFrames. A ReportOutput either renders them as the
+usual text report on stdout, in a single write, or writes every table to its own
+file (CSV, JSON lines or Parquet) so dashboards can load the results directly
+instead of parsing the text.
+"""
+import os
+import sys
+
+#file extension and writer of each machine readable format
+FORMATS = {
+    'csv': ('csv', lambda table, path: table.to_csv(path, index=False)),
+    'jsonl': ('jsonl', lambda table, path: table.to_json(path, orient='records', lines=True)),
+    #requires pyarrow or fastparquet
+    'parquet': ('parquet', lambda table, path: table.to_parquet(path, index=False)),
+}
+OUTPUT_FORMATS = ('text',) + tuple(sorted(FORMATS))
+
+
+class ReportOutput(object):
+    """Destination of the report tables
+
+    :param str output_format: text (stdout) or one of FORMATS
+    :param str output_dir: directory where the files are written
+    :raises ValueError: for an unknown output format
+    :raises ImportError: for parquet, if neither pyarrow nor fastparquet is installed
+    """
+
+    def __init__(self, output_format='text', output_dir='.'):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("unknown output format {}, expected one of {}".format(output_format, ", ".join(OUTPUT_FORMATS)))
+        if output_format == 'parquet':
+            #fail before computing the reports rather than when writing them
+            try:
+                import pyarrow
+            except ImportError:
+                try:
+                    import fastparquet
+                except ImportError:
+                    raise ImportError("the parquet output format requires pyarrow or fastparquet")
+        self.output_format = output_format
+        self.output_dir = output_dir
+
+    @property
+    def is_text(self):
+        return self.output_format == 'text'
+
+    def write(self, tables, render):
+        """Output the tables of a report
+
+        :param list tables: (name, pandas.DataFrame) pairs, the name is used as file name
+        :param render: function called with the DataFrames, returning the text report
+        :returns: the paths of the written files, an empty list for text output
+        """
+        if self.is_text:
+            sys.stdout.write(render(*[table for name, table in tables]))
+            return []
+        extension, writer = FORMATS[self.output_format]
+        paths = []
+        for name, table in tables:
+            path = os.path.join(self.output_dir, "{}.{}".format(name, extension))
+            writer(table, path)
+            paths.append(path)
+        return paths
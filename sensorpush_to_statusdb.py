@@ -13,18 +13,59 @@ import datetime
 import numpy as np
 import pandas as pd
 import logging
+import queue
+import sqlite3
+import threading
 import time
+from collections import Counter, defaultdict
 from ibmcloudant import CouchDbSessionAuthenticator, cloudant_v1
 
 
+# The SensorPush API allows one request per minute
+REQUEST_INTERVAL = 60
+# Samples asked for in one request, a full day of one sensor as recommended by sensorpush support
+MAX_SAMPLES_PER_REQUEST = 1440
+# Sensors keep their readings while the gateway is offline and upload them later,
+# so samples are asked for again from the last one stored, at most this long before
+# the end of the previous fetch
+BACKFILL_WINDOW = datetime.timedelta(hours=6)
+
+
+class TokenBucket(object):
+    """Rate limiter allowing `rate` requests per second, with at most `capacity` requests in a burst."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request is allowed and take its token."""
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
 class SensorPushConnection(object):
-    def __init__(self, email, password, verbose):
+    def __init__(self, email, password, verbose, rate_limit=True):
         self.email = email
         self.password = password
         self._authorized = False
         self.base_url = "https://api.sensorpush.com/api/v1"
         self.access_token = None
         self.verbose = verbose
+        # Shared by all API requests, authorization excepted
+        self.bucket = TokenBucket(1.0 / REQUEST_INTERVAL) if rate_limit else None
 
     def _authorize(self):
         url_ending = "oauth/authorize"
@@ -51,6 +92,8 @@ class SensorPushConnection(object):
         attempt = 1
         max_attempts = 3
         while attempt <= max_attempts:
+            if self.bucket is not None:
+                self.bucket.acquire()
             try:
                 resp = requests.post(url, json=body_data, headers=auth_headers)
                 if self.verbose:
@@ -62,12 +105,16 @@ class SensorPushConnection(object):
                 logger.warning(
                     f"Error fetching sensorpush data: {resp.text}, attempt {attempt} of {max_attempts}"
                 )
-                if attempt > max_attempts:
+                if attempt >= max_attempts:
                     # Log to error here so that crontab can email the error
                     logger.error(
                         f"Error fetching sensorpush data: {resp.text}, attempt {attempt} of {max_attempts}"
                     )
                     resp.raise_for_status()
+                    # Not an HTTP error status, but not the 200 expected either
+                    raise Exception(
+                        f"Error fetching sensorpush data: status code {resp.status_code}"
+                    )
             attempt += 1
         return resp
 
@@ -94,6 +141,183 @@ class SensorPushConnection(object):
         r = self._make_request(url, body_data)
         return r.json()
 
+    def iter_samples(self, planned_requests):
+        """Fetch the samples of the planned (sensors, start, stop) requests in a background thread.
+
+        Yields (request, samples json) for every request as soon as it is answered,
+        so the caller processes a batch while the next request waits for the rate limit.
+        """
+        fetched = queue.Queue()
+        # Set when the caller stops consuming, so no more requests use up the rate limit
+        stop = threading.Event()
+
+        def fetch():
+            try:
+                for sensors, start, stop_time in planned_requests:
+                    if stop.is_set():
+                        return
+                    samples_json = self.get_samples(
+                        samples_in_window(start, stop_time),
+                        sensors,
+                        startTime=api_time(start),
+                        stopTime=api_time(stop_time),
+                    )
+                    fetched.put(((sensors, start, stop_time), samples_json))
+            except Exception as e:
+                fetched.put((None, e))
+
+        fetcher = threading.Thread(target=fetch, daemon=True)
+        fetcher.start()
+        try:
+            for _ in planned_requests:
+                request, samples_json = fetched.get()
+                if request is None:
+                    raise samples_json
+                yield request, samples_json
+        finally:
+            stop.set()
+        fetcher.join()
+
+
+def api_time(time_point):
+    """Format a UTC datetime the way the SensorPush API expects it"""
+    return time_point.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def samples_in_window(start, stop):
+    """Nr of samples a sensor can have observed from start to stop, at one sample per minute"""
+    return int((stop - start).total_seconds() // 60) + 1
+
+
+def plan_requests(since, until, sensors_per_request=None):
+    """Group the sensors into sample requests covering each sensor from since[sensor] to until.
+
+    Sensors fetched from about the same time share a request as long as it asks for at most
+    MAX_SAMPLES_PER_REQUEST samples and sensors_per_request sensors. A sensor lagging behind
+    more than a request can hold is fetched alone, in consecutive windows.
+    Returns a list of (sensor ids, start, stop) requests.
+    """
+    planned = []
+
+    def add_batch(batch):
+        start = since[batch[0]]
+        if samples_in_window(start, until) <= MAX_SAMPLES_PER_REQUEST:
+            planned.append((batch, start, until))
+            return
+        window = datetime.timedelta(minutes=MAX_SAMPLES_PER_REQUEST - 1)
+        while start < until:
+            stop = min(start + window, until)
+            planned.append((batch, start, stop))
+            start = stop
+
+    batch = []
+    # Earliest first, so that each batch is as long as the window of its first sensor allows
+    for sensor in sorted((s for s in since if since[s] < until), key=lambda s: since[s]):
+        if batch and (
+            (len(batch) + 1) * samples_in_window(since[batch[0]], until)
+            <= MAX_SAMPLES_PER_REQUEST
+        ) and (sensors_per_request is None or len(batch) < sensors_per_request):
+            batch.append(sensor)
+            continue
+        if batch:
+            add_batch(batch)
+        batch = [sensor]
+    if batch:
+        add_batch(batch)
+    return planned
+
+
+class SampleStore(object):
+    """Local SQLite store of the temperature samples fetched from SensorPush.
+
+    Keeps every sample (sensor id, observed time, temperature in Celsius) together with
+    the time each sensor has been fetched until, so each run only asks the API for the
+    samples since the previous one, hours missed while the script or a gateway was down
+    are fetched on the next run, and the daily documents are summarized from the samples
+    stored locally. The default ':memory:' store keeps nothing between runs.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS samples (
+                sensor_id TEXT,
+                observed INTEGER,
+                temperature REAL,
+                PRIMARY KEY (sensor_id, observed)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS sensors (
+                sensor_id TEXT PRIMARY KEY,
+                fetched_until INTEGER
+            );
+            """
+        )
+
+    def close(self):
+        self.conn.close()
+
+    def fetch_start(self, sensor_id, default):
+        """Return the time to fetch the samples of the sensor from, default if it was never fetched"""
+        row = self.conn.execute(
+            "SELECT fetched_until FROM sensors WHERE sensor_id = ?", (sensor_id,)
+        ).fetchone()
+        if row is None:
+            return default
+        start = from_timestamp(row[0]) - BACKFILL_WINDOW
+        (last_observed,) = self.conn.execute(
+            "SELECT MAX(observed) FROM samples WHERE sensor_id = ?", (sensor_id,)
+        ).fetchone()
+        if last_observed is not None:
+            start = max(start, from_timestamp(last_observed))
+        return start
+
+    def add_samples(self, sensor_id, samples, fetched_until):
+        """Store the samples returned by the API for a sensor, fetched up to fetched_until.
+
+        Samples already stored are replaced. Returns the set of days (midnight datetimes)
+        the samples were observed on.
+        """
+        rows = []
+        days = set()
+        for sample in samples:
+            time_point = datetime.datetime.strptime(
+                sample["observed"], "%Y-%m-%dT%H:%M:%S.%fZ"
+            )
+            # Make datetime aware of timezone
+            time_point = time_point.replace(tzinfo=datetime.timezone.utc)
+            rows.append(
+                (sensor_id, int(time_point.timestamp()), to_celsius(sample["temperature"]))
+            )
+            days.add(time_point.replace(hour=0, minute=0, second=0, microsecond=0))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO samples VALUES (?, ?, ?)", rows
+            )
+            self.conn.execute(
+                "INSERT INTO sensors VALUES (?, ?) ON CONFLICT (sensor_id) "
+                "DO UPDATE SET fetched_until = MAX(fetched_until, excluded.fetched_until)",
+                (sensor_id, int(fetched_until.timestamp())),
+            )
+        return days
+
+    def samples(self, sensor_id, start, stop):
+        """Return the samples of the sensor observed from start to stop as a Series indexed by time"""
+        rows = self.conn.execute(
+            "SELECT observed, temperature FROM samples "
+            "WHERE sensor_id = ? AND observed >= ? AND observed < ? ORDER BY observed",
+            (sensor_id, int(start.timestamp()), int(stop.timestamp())),
+        ).fetchall()
+        return pd.Series(
+            [temperature for _, temperature in rows],
+            index=pd.to_datetime([observed for observed, _ in rows], unit="s", utc=True),
+            dtype=float,
+        )
+
+
+def from_timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, tz=datetime.timezone.utc)
+
 
 class SensorDocument(object):
     def __init__(
@@ -314,94 +538,157 @@ def to_celsius(temp):
     return ((temp - 32) * 5) / 9
 
 
-def samples_to_df(samples_dict):
-    data_d = {}
-    for sensor_id, samples_json in samples_dict.items():
-        if sensor_id not in samples_json["sensors"]:
-            logging.warning(f"Sensor {sensor_id} did not return any data.")
-            continue
-        samples = samples_json["sensors"][
-            sensor_id
-        ]  # Slightly weird but due to 1 request per sensor
-        sensor_d = {}
-        logging.info(f"Found {len(samples)} samples for sensor {sensor_id}")
-        for sample in samples:
-            time_point = datetime.datetime.strptime(
-                sample["observed"], "%Y-%m-%dT%H:%M:%S.%fZ"
-            )
-            # Make datetime aware of timezone
-            time_point = time_point.replace(tzinfo=datetime.timezone.utc)
-            sensor_d[time_point] = to_celsius(sample["temperature"])
-        data_d[sensor_id] = sensor_d
-    logging.info(f"Data_d has {len(data_d.keys())} nr of keys")
-    df = pd.DataFrame.from_dict(data_d)
-    df = df.sort_index(ascending=True)
-    # convert pandas index to datetime index
-    return df
-
-
-def process_data(sensors_json, samples_dict, start_time, nr_samples_requested):
-    df = samples_to_df(samples_dict)
+def process_data(sensors_json, store, sensor_days):
+    """Summarize the stored samples of each sensor into one SensorDocument per day.
 
+    sensor_days maps each sensor id to the days (midnight datetimes) to summarize.
+    """
     sensor_documents = []
-    for sensor_id, sensor_info in sensors_json.items():
-        # Check if any samples available for the sensor
-        if sensor_id not in df.columns:
-            continue
-
+    for sensor_id, days in sensor_days.items():
+        sensor_info = sensors_json[sensor_id]
         sensor_limit_lower, sensor_limit_upper = sensor_limits(sensor_info)
         if (sensor_limit_lower is None) and (sensor_limit_upper is None):
             logger.warning(
                 f'Temperature alert not set for sensor {sensor_info["name"]}'
             )
 
-        sensor_samples = df[sensor_id].dropna()
-
-        # TODO, samples are in Fahrenheit and UTC
-        sd = SensorDocument(
-            sensor_id,
-            sensor_samples,
-            sensor_info["name"],
-            start_time,
-            sensor_limit_lower,
-            sensor_limit_upper,
-        )
+        for day in sorted(days):
+            sensor_samples = store.samples(
+                sensor_id, day, day + datetime.timedelta(days=1)
+            )
+            # Check if any samples available for the sensor
+            if sensor_samples.empty:
+                continue
+
+            # TODO, samples are in Fahrenheit and UTC
+            sd = SensorDocument(
+                sensor_id,
+                sensor_samples,
+                sensor_info["name"],
+                sensor_samples.index[0].floor("h").to_pydatetime(),
+                sensor_limit_lower,
+                sensor_limit_upper,
+            )
 
-        # Check if there are samples outside of limits
-        if sensor_limit_lower is not None:
-            samples_too_low = sensor_samples[sensor_samples < sensor_limit_lower]
-            # Collect the exact intervals outside of limits
-            if not samples_too_low.empty:
-                (
-                    sd.intervals_lower,
-                    sd.intervals_lower_extended,
-                ) = sd.summarize_intervals(samples_too_low, "low")
-                sd.add_samples_from_intervals_lower()
-
-        if sensor_limit_upper is not None:
-            samples_too_high = sensor_samples[sensor_samples > sensor_limit_upper]
-            # Collect the exact intervals outside of limits
-            if not samples_too_high.empty:
-                (
-                    sd.intervals_higher,
-                    sd.intervals_higher_extended,
-                ) = sd.summarize_intervals(samples_too_high, "high")
-                sd.add_samples_from_intervals_higher()
-
-        # The dropna is needed since sometimes we get sparse samples
-        # and might have hours without samples.
-        hourly_mean = sensor_samples.resample("1h").mean().dropna()
-        for hour, mean_val in hourly_mean.items():
-            # Don't add any hourly mean values where we've saved more detailed info
-            if not sd.time_in_any_extended_interval(hour):
-                sd.saved_samples[hour.strftime("%Y-%m-%dT%H:%M:%S")] = round(
-                    mean_val, 3
-                )
+            # Check if there are samples outside of limits
+            if sensor_limit_lower is not None:
+                samples_too_low = sensor_samples[sensor_samples < sensor_limit_lower]
+                # Collect the exact intervals outside of limits
+                if not samples_too_low.empty:
+                    (
+                        sd.intervals_lower,
+                        sd.intervals_lower_extended,
+                    ) = sd.summarize_intervals(samples_too_low, "low")
+                    sd.add_samples_from_intervals_lower()
+
+            if sensor_limit_upper is not None:
+                samples_too_high = sensor_samples[sensor_samples > sensor_limit_upper]
+                # Collect the exact intervals outside of limits
+                if not samples_too_high.empty:
+                    (
+                        sd.intervals_higher,
+                        sd.intervals_higher_extended,
+                    ) = sd.summarize_intervals(samples_too_high, "high")
+                    sd.add_samples_from_intervals_higher()
+
+            # The dropna is needed since sometimes we get sparse samples
+            # and might have hours without samples.
+            hourly_mean = sensor_samples.resample("1h").mean().dropna()
+            for hour, mean_val in hourly_mean.items():
+                # Don't add any hourly mean values where we've saved more detailed info
+                if not sd.time_in_any_extended_interval(hour):
+                    sd.saved_samples[hour.strftime("%Y-%m-%dT%H:%M:%S")] = round(
+                        mean_val, 3
+                    )
 
-        sensor_documents.append(sd)
+            sensor_documents.append(sd)
     return sensor_documents
 
 
+def fetch_existing_documents(couch, keys):
+    """Fetch the StatusDB documents of the [sensor_id, date] keys with a single view request.
+
+    Returns a dict (sensor_id, date) -> document, keys without a document are left out.
+    """
+    view_call = couch.post_view(
+        db="sensorpush",
+        ddoc="entire_document",
+        view="by_sensor_id_and_date",
+        keys=[list(key) for key in keys],
+    ).get_result()
+    existing = {}
+    for row in view_call["rows"]:
+        existing.setdefault(tuple(row["key"]), row["value"])
+    return existing
+
+
+def upload_documents(couch, sensor_documents, push, max_attempts=3):
+    """Merge the sensor documents with the ones already in StatusDB and save them, or print them unless `push`.
+
+    The existing documents are fetched with one view request and all documents are saved
+    with one _bulk_docs request. Documents rejected with a conflict, e.g. updated by
+    another run in between, are merged again with their current revision and saved again.
+    """
+    if not sensor_documents:
+        return
+    new_docs = {
+        (sd.sensor_id, sd.start_date_midnight): sd.format_for_statusdb()
+        for sd in sensor_documents
+    }
+    # Check if there already are documents for the sensor & date combinations
+    existing = fetch_existing_documents(couch, new_docs.keys())
+
+    attempt = 1
+    while new_docs:
+        merged_docs = {}
+        for key, sd_dict in new_docs.items():
+            # merge_with updates the document it is given, keep the fresh one for a retry
+            sd_dict = dict(sd_dict)
+            if key in existing:
+                sd_dict = SensorDocument.merge_with(sd_dict, existing[key])
+            merged_docs[key] = sd_dict
+
+        if not push:
+            for sd_dict in merged_docs.values():
+                logging.info(f'Printing {sd_dict["sensor_name"]} to stderr')
+                print(sd_dict)
+            return
+
+        logging.info(f"Saving {len(merged_docs)} documents to statusdb")
+        results = couch.post_bulk_docs(
+            db="sensorpush",
+            bulk_docs=cloudant_v1.BulkDocs(docs=list(merged_docs.values())),
+        ).get_result()
+
+        conflicts = []
+        errors = []
+        # Results are in the same order as the documents
+        for key, result in zip(merged_docs, results):
+            sensor_name = merged_docs[key]["sensor_name"]
+            if result.get("ok"):
+                logging.info(f"Saved {sensor_name} to statusdb")
+            elif result.get("error") == "conflict":
+                conflicts.append(key)
+            else:
+                logging.error(
+                    f"Error saving {sensor_name} to statusdb: {result.get('error')} {result.get('reason')}"
+                )
+                errors.append(sensor_name)
+        if errors:
+            raise Exception(f"Error saving {', '.join(errors)} to statusdb")
+        if conflicts and attempt >= max_attempts:
+            raise Exception(
+                f"Conflicts saving {len(conflicts)} documents to statusdb after {max_attempts} attempts"
+            )
+        if conflicts:
+            logging.warning(
+                f"Conflicts saving {len(conflicts)} documents to statusdb, merging them again"
+            )
+            existing = fetch_existing_documents(couch, conflicts)
+        new_docs = {key: new_docs[key] for key in conflicts}
+        attempt += 1
+
+
 def main(
     nr_samples_requested,
     arg_start_date,
@@ -410,29 +697,30 @@ def main(
     push,
     verbose,
     no_wait,
+    sensors_per_request=None,
+    sample_store=None,
 ):
     try:
+        now = datetime.datetime.now(datetime.UTC)
         if arg_start_date is None:
-            # Start time is the start of the previous hour
-            start_date_datetime = datetime.datetime.now(datetime.UTC) - datetime.timedelta(
-                hours=1
-            )
+            # Sensors not fetched before start from the start of the previous hour
+            start_date_datetime = now - datetime.timedelta(hours=1)
             start_date_datetime = start_date_datetime.replace(
                 minute=0, second=0, microsecond=0
             )
+            end_time_datetime = now
 
         else:
             start_date_datetime = datetime.datetime.strptime(
                 arg_start_date, "%Y-%m-%d:%H:%M"
             ).replace(tzinfo=datetime.timezone.utc)
-
-        # Get the midnight time, to use as enddate in order to not get samples from the next day
-        day_after = start_date_datetime + datetime.timedelta(days=1)
-        end_time_datetime = day_after.replace(hour=0, minute=0, second=0, microsecond=0)
-
-        # Need to use UTC timezone for the API call
-        start_time = start_date_datetime.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        end_time = end_time_datetime.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            # Get the midnight time, to use as enddate in order to not get samples from the next day
+            day_after = start_date_datetime + datetime.timedelta(days=1)
+            end_time_datetime = min(
+                now,
+                day_after.replace(hour=0, minute=0, second=0, microsecond=0),
+                start_date_datetime + datetime.timedelta(minutes=nr_samples_requested),
+            )
 
         with open(os.path.expanduser(sensorpush_config), "r") as sp_config_file:
             sp_config = yaml.safe_load(sp_config_file)
@@ -441,31 +729,9 @@ def main(
             raise Exception("Credentials missing in SensorPush config")
 
         sp = SensorPushConnection(
-            sp_config["email"], sp_config["password"], verbose=verbose
+            sp_config["email"], sp_config["password"], verbose=verbose, rate_limit=not no_wait
         )
 
-        logging.info(
-            f"Fetching {nr_samples_requested} samples from {start_time} to {end_time} (absolute max)"
-        )
-        # Request sensor data
-        sensors = sp.get_sensors()
-
-        samples = {}
-        for sensor in sensors.keys():
-            if not no_wait:
-                time.sleep(61)  # Sensorpush api recommends 1 request per minute
-            # Request only samples for one sensor at a time to limit the size of the payload,
-            # by recommendation from sensorpush support
-            samples[sensor] = sp.get_samples(
-                nr_samples_requested, [sensor], startTime=start_time, stopTime=end_time
-            )
-
-        # Summarize data and put into documents suitable for upload
-        sensor_documents = process_data(
-            sensors, samples, start_date_datetime, nr_samples_requested
-        )
-
-        # Upload to StatusDB
         with open(statusdb_config) as settings_file:
             server_settings = yaml.load(settings_file, Loader=yaml.SafeLoader)
 
@@ -476,34 +742,47 @@ def main(
         )
         couch.set_service_url(server_settings["statusdb"].get("url"))
 
-        for sd in sensor_documents:
-            # Check if there already is a document for the sensor & date combination
-            view_call = couch.post_view(
-                db="sensorpush",
-                ddoc="entire_document",
-                view="by_sensor_id_and_date",
-                key=[sd.sensor_id, sd.start_date_midnight],
-            ).get_result()
-
-            sd_dict = sd.format_for_statusdb()
-
-            if view_call["rows"]:
-                sd_dict = SensorDocument.merge_with(sd_dict, view_call["rows"][0]["value"])
-
-            if push:
-                logging.info(f'Saving {sd_dict["sensor_name"]} to statusdb')
-                try:
-                    couch.post_document(
-                        db="sensorpush", document=sd_dict
-                    ).get_result()
-                except Exception as e:
-                    logging.error(
-                        f"Error saving {sd_dict['sensor_name']} to statusdb: {e}"
-                    )
-                    raise e
-            else:
-                logging.info(f'Printing {sd_dict["sensor_name"]} to stderr')
-                print(sd_dict)
+        store = SampleStore(sample_store or ":memory:")
+        # Request sensor data
+        sensors = sp.get_sensors()
+
+        # Each sensor is fetched from where the previous run stopped, unless a start time is given
+        if arg_start_date is None:
+            since = {
+                sensor: store.fetch_start(sensor, start_date_datetime)
+                for sensor in sensors
+            }
+        else:
+            since = dict.fromkeys(sensors, start_date_datetime)
+        planned = plan_requests(since, end_time_datetime, sensors_per_request)
+        logging.info(
+            f"Fetching samples of {len(sensors)} sensors up to {api_time(end_time_datetime)} "
+            f"in {len(planned)} requests"
+        )
+
+        pending = Counter(sensor for batch, _, _ in planned for sensor in batch)
+        sensor_days = defaultdict(set)
+        # Each batch is summarized and uploaded while the next request waits for the rate limit
+        for (batch, start, stop), samples_json in sp.iter_samples(planned):
+            fetched = []
+            for sensor in batch:
+                if sensor not in samples_json["sensors"]:
+                    logging.warning(f"Sensor {sensor} did not return any data.")
+                samples = samples_json["sensors"].get(sensor, [])
+                logging.info(f"Found {len(samples)} samples for sensor {sensor}")
+                sensor_days[sensor] |= store.add_samples(sensor, samples, stop)
+                pending[sensor] -= 1
+                if not pending[sensor]:
+                    fetched.append(sensor)
+            # Summarize the days with new samples of the sensors that are fully fetched
+            # and put into documents suitable for upload
+            sensor_documents = process_data(
+                sensors,
+                store,
+                {sensor: sensor_days.pop(sensor) for sensor in fetched},
+            )
+            upload_documents(couch, sensor_documents, push)
+        store.close()
     except Exception as e:
         logging.exception(f"Error in main: {e}")
         raise
@@ -516,7 +795,10 @@ if __name__ == "__main__":
         "-s",
         type=int,
         default=60,
-        help=("Nr of samples that will be fetched" "default value is 60 e.g. 1 hour."),
+        help=(
+            "Nr of samples that will be fetched from --start_time, "
+            "default value is 60 e.g. 1 hour."
+        ),
     )
     parser.add_argument(
         "--start_time",
@@ -524,7 +806,8 @@ if __name__ == "__main__":
         default=None,
         help=(
             "Collect samples starting from this UTC(!) time, "
-            "by default, yesterday at midnight is used."
+            "by default, each sensor is fetched from where the previous run stopped, "
+            "or from the start of the previous hour."
         ),
     )
     parser.add_argument(
@@ -561,6 +844,23 @@ if __name__ == "__main__":
         action="store_true",
         help="Do not wait for 60 seconds between requests, useful for testing.",
     )
+    parser.add_argument(
+        "--sensors-per-request",
+        type=int,
+        default=None,
+        help=(
+            "Nr of sensors whose samples are fetched in one request, "
+            f"by default as many as fit in {MAX_SAMPLES_PER_REQUEST} samples."
+        ),
+    )
+    parser.add_argument(
+        "--sample_store",
+        default=None,
+        help=(
+            "SQLite file keeping the fetched samples between runs, so that only new "
+            "samples are fetched. By default nothing is kept."
+        ),
+    )
 
     args = parser.parse_args()
     logging.basicConfig(
@@ -587,4 +887,6 @@ if __name__ == "__main__":
         args.push,
         args.verbose,
         args.no_wait,
+        args.sensors_per_request,
+        os.path.abspath(os.path.expanduser(args.sample_store)) if args.sample_store else None,
     )
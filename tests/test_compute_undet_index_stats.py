@@ -0,0 +1,111 @@
+import pytest
+
+import compute_undet_index_stats
+from flowcell_snapshot import FlowcellSnapshot
+
+
+class ChangesDatabase(object):
+    """Documents of a database, answering the _changes requests of FlowcellSnapshot.refresh"""
+
+    def __init__(self, name, docs):
+        self.name = name
+        self.docs = docs
+
+    def changes(self, since=0, include_docs=False, limit=None):
+        results = [{'id': doc['_id'], 'seq': seq, 'doc': doc}
+                   for seq, doc in enumerate(self.docs, 1) if seq > since][:limit]
+        return {'results': results, 'last_seq': results[-1]['seq'] if results else since}
+
+
+def flowcell(doc_id, fc_id, undetermined):
+    samplesheet = [{'Lane': lane, 'SampleName': 'P{}_{}'.format(100 + int(lane), n)}
+                   for lane in undetermined for n in range(2)]
+    return {'_id': doc_id, '_rev': '1-a', 'RunInfo': {'Id': fc_id, 'Date': fc_id[:6]},
+            'Undetermined': undetermined, 'samplesheet_csv': samplesheet}
+
+
+DOCS = [
+    flowcell('a1', '170101_ST-E00201_0001_AHXXXXCCXX', {
+        '1': {'CTTGTAAT': 700, 'CTTGTAATGG': 50, 'TOTAL': 800},
+        '2': {'CTTGTAAT-AGATCTCG': 400, 'TTTTTTTT+CTTGTAAT': 300, 'GGGGGGGG': 5},
+        '3': {'ACGTACGT': 900}}),
+    flowcell('a2', '170202_D00456_0002_BHYYYYBCXX', {
+        '4': {'CTTGTAAT': 200, 'NCTTGTAAT': 900},
+        '5': {'AGATCTCG-CTTGTAAT': 650}}),
+    flowcell('a3', '170303_ST-E00202_0003_AHZZZZCCXX', {}),
+]
+
+
+def scan_and_snapshot(tmp_path):
+    snapshot = FlowcellSnapshot(str(tmp_path / 'snapshot.sqlite'))
+    snapshot.refresh(ChangesDatabase('x_flowcells', DOCS))
+    return snapshot
+
+
+def test_check_undet_index_scan_matches_snapshot(tmp_path):
+    snapshot = scan_and_snapshot(tmp_path)
+    for index in ['CTTGTAAT', 'AGATCTCG', 'ACGTACGT', 'TTTTTTTT']:
+        for instrument_type in [None, 'HiSeqX', 'HiSeq2500']:
+            scanned = compute_undet_index_stats.undetermined_time_line(
+                result for result in (compute_undet_index_stats.undetermined_index_lanes_of(doc, index, instrument_type)
+                                      for doc in DOCS) if result is not None)
+            looked_up = compute_undet_index_stats.undetermined_time_line_from_index(snapshot, index, instrument_type)
+            assert scanned == looked_up
+    assert looked_up != {}
+    assert compute_undet_index_stats.undetermined_time_line_from_index(snapshot, 'CTTGTAAT', None)[
+        '170101_ST-E00201_0001_AHXXXXCCXX'] == [['1', 700], ['2', 700], ['3', 0]]
+
+
+def test_workset_undet_scan_matches_snapshot(tmp_path):
+    snapshot = scan_and_snapshot(tmp_path)
+    for index in ['CTTGTAAT', 'AGATCTCG', 'ACGTACGT']:
+        for min_occurences in [0, 500, 650, 699]:
+            scanned = []
+            for doc in DOCS:
+                scanned.extend(compute_undet_index_stats.lanes_with_undet_index_of(doc, index, None, min_occurences) or [])
+            looked_up = compute_undet_index_stats.lanes_with_undet_index_from_index(snapshot, index, None, min_occurences)
+            assert scanned == looked_up
+    lanes = compute_undet_index_stats.lanes_with_undet_index_from_index(snapshot, 'CTTGTAAT', None, 600)
+    assert [(fc_id, lane) for fc_id, lane, samples, projects in lanes] == [
+        ('170101_ST-E00201_0001_AHXXXXCCXX', '1'), ('170101_ST-E00201_0001_AHXXXXCCXX', '2'),
+        ('170202_D00456_0002_BHYYYYBCXX', '5')]
+
+
+def test_prefix_lookup_rejects_empty_index(tmp_path):
+    snapshot = scan_and_snapshot(tmp_path)
+    with pytest.raises(ValueError):
+        snapshot.lookup_undetermined('x_flowcells', '', prefix=True)
+    assert [row[0] for row in snapshot.lookup_undetermined('x_flowcells', 'CTTGTAATG', prefix=True)] == ['CTTGTAATGG']
+
+
+def test_top_k():
+    assert list(compute_undet_index_stats.top_k([3, 1, 3, 2], 2)) == [0, 2]
+    assert list(compute_undet_index_stats.top_k([3, 1, 3, 2], 10)) == [0, 2, 3, 1]
+    assert list(compute_undet_index_stats.top_k([3, 1, 3, 2], 0)) == []
+
+
+class WorksetView(object):
+    """project/ws_proj view answering view[project].rows, counting the queries"""
+
+    def __init__(self, worksets):
+        self.worksets = worksets
+        self.queries = []
+
+    def __getitem__(self, project):
+        self.queries.append(project)
+        rows = [type('Row', (object,), {'value': {ws_id: {'samples': samples}}})
+                for ws_id, samples in self.worksets.get(project, {}).items()]
+        return type('Result', (object,), {'rows': rows})
+
+
+def test_workset_cache_expires(tmp_path):
+    cache = str(tmp_path / 'worksets.json')
+    view = WorksetView({'P101': {'24-1': {'P101_0': {'location': 'A:1'}}}})
+    first = compute_undet_index_stats.workset_sample_locations(view, ['P101'], cache)
+    assert first == {'P101': {'P101_0': [('24-1', 'A:1')]}}
+    view.worksets['P101']['24-2'] = {'P101_1': {'location': 'B:1'}}
+    assert compute_undet_index_stats.workset_sample_locations(view, ['P101'], cache) == first
+    assert view.queries == ['P101']
+    refreshed = compute_undet_index_stats.workset_sample_locations(view, ['P101'], cache, cache_ttl=0)
+    assert refreshed['P101']['P101_1'] == [('24-2', 'B:1')]
+    assert view.queries == ['P101', 'P101']
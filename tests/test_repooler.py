@@ -0,0 +1,33 @@
+import sys
+
+import repooler
+import repooler_benchmark
+
+TARGET_CLUSTERS = 320 * 10**6
+CLUSTERS_PER_LANE = 380 * 10**6
+
+
+def synthetic_lanes(n_samples, pool_size, repools, seed=1):
+    docs = repooler_benchmark.synthetic_flowcells('P1000', n_samples, pool_size, repools, 0.3, seed)
+    couch = repooler_benchmark.MemoryCouch(x_flowcells=repooler_benchmark.MemoryDatabase(docs))
+    struct = repooler.proj_struct(couch, ['P1000'], TARGET_CLUSTERS)
+    return repooler.parse_indata(struct, TARGET_CLUSTERS)
+
+
+def test_optimal_unique_set_deeper_than_recursion_limit():
+    lanes = synthetic_lanes(600, 1, 0.2)
+    assert len(lanes) >= 300
+    greedy = repooler.simple_unique_set(lanes, TARGET_CLUSTERS)
+    limit = sys.getrecursionlimit()
+    #One structure is chosen per search level, a recursive search would need more frames
+    sys.setrecursionlimit(150)
+    try:
+        chosen = repooler.optimal_unique_set(lanes, TARGET_CLUSTERS, CLUSTERS_PER_LANE, 2)
+    finally:
+        sys.setrecursionlimit(limit)
+    assert len(chosen) > 150
+    repooler.validate_samples_unique(lanes, chosen)
+    repooler.validate_all_samples_present(lanes, chosen)
+    desired, needed_lanes, ideal = repooler.sample_distributor(lanes, chosen, CLUSTERS_PER_LANE)
+    greedy_desired, greedy_lanes, greedy_ideal = repooler.sample_distributor(lanes, greedy, CLUSTERS_PER_LANE)
+    assert sum(needed_lanes.values()) <= sum(greedy_lanes.values())